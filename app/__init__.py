@@ -1,18 +1,37 @@
 # -*- coding:utf-8 -*-
 
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_mail import Mail
 from flask_wtf.csrf import CsrfProtect
 from config import config
+from .database import Database
+from .cache import MenuCache, UserCache
+from .fragments import FragmentCache
+from .httpcache import HttpCache
+from .storage import Storage
+from .profiler import SQLProfiler
+from .feed import OrderFeed
+from .notify import Notifier
+from .geo import ZipcodeIndex
+from .search import MealSearch
 
-db = SQLAlchemy()
+db = Database()
 login_manager = LoginManager()
 login_manager.session_protection = 'strong'
 login_manager.login_view = 'auth.login'
 csrf = CsrfProtect()
 mail = Mail()
+menu_cache = MenuCache()
+user_cache = UserCache()
+fragment_cache = FragmentCache()
+http_cache = HttpCache()
+storage = Storage()
+profiler = SQLProfiler()
+order_feed = OrderFeed()
+notifier = Notifier()
+zipcode_index = ZipcodeIndex()
+meal_search = MealSearch()
 
 
 def create_app(config_name):
@@ -24,6 +43,16 @@ def create_app(config_name):
     login_manager.init_app(app)
     csrf.init_app(app)
     mail.init_app(app)
+    menu_cache.init_app(app)
+    user_cache.init_app(app)
+    fragment_cache.init_app(app)
+    http_cache.init_app(app)
+    storage.init_app(app)
+    profiler.init_app(app)
+    order_feed.init_app(app)
+    notifier.init_app(app)
+    zipcode_index.init_app(app)
+    meal_search.init_app(app)
 
     from .client import client as client_blueprint
     app.register_blueprint(client_blueprint)
@@ -38,5 +67,6 @@ def create_app(config_name):
     app.register_blueprint(auth_blueprint, url_prefix='/auth')
 
     from .api_1_0 import api as api_1_0_blueprint
+    csrf.exempt(api_1_0_blueprint)
     app.register_blueprint(api_1_0_blueprint, url_prefix='/api/v1.0')
     return app
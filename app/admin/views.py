@@ -1,12 +1,16 @@
 # -*- coding:utf-8 -*-
 
 from datetime import datetime
-from flask import render_template, request, redirect, url_for, flash
+from flask import render_template, request, redirect, url_for, flash, current_app
 from flask_login import current_user
 from sqlalchemy.orm.util import join
-from .. import csrf, db
-from ..decorators import superuser_required
-from ..models import Meal, MealZipcode, Zipcode, ChefApply, Role, get_or_create
+from .. import csrf, db, menu_cache, user_cache, profiler, meal_search
+from ..cache import CountingCache
+from ..decorators import superuser_required, read_replica
+from ..util import keyset_paginate, ranked_paginate, page_size
+from ..export import export_response
+from ..analytics import request_report
+from ..models import Meal, MealZipcode, Zipcode, ChefApply, Role, User, get_or_create
 from . import admin
 
 
@@ -18,15 +22,18 @@ def index():
 @csrf.exempt
 @admin.route('/meals/<order_status>')
 @superuser_required
+@read_replica
 def meals(order_status):
     """
-    根据zipcode查找meals，并按照日期排序
+    根据zipcode查找meals，并按照日期排序；?q= 按名字和描述搜索，按相关度排序，见 search.py
     :param order_status: all, selected, unselected
     :return: the admin's meal list page
     """
     order_status_dict = {'all': u'全部Meal', 'selected': u'推荐的Meal', 'unselected': u'其他Meal'}
     zipcode = request.args.get('zipcode')
-    meals = Meal.query
+    q = request.args.get('q', '').strip()
+    meals = Meal.query.options(db.joinedload(Meal.chef))
+    selected = None
     if order_status in ('selected', 'unselected'):
         selected = True if order_status == 'selected' else False
         meals = meals.filter_by(is_selected=selected)
@@ -36,10 +43,19 @@ def meals(order_status):
             # meals = meals.select_from(join(Meal, MealZipcode)).filter(MealZipcode.zipcode_id==zipcode.id)
             meals = meals.filter(Meal.id == MealZipcode.meal_id).filter(MealZipcode.zipcode_id == zipcode.id)
         else:
-            meals = []
+            meals = None
+    if q:
+        # 按相关度排序，用 ?offset= 翻页；zipcode和是否推荐交给搜索过滤，每页的条数才是准的。
+        # search_ids 每次最多返回 max_results 个，多取的一个用来判断有没有下一页
+        zipcodes = [zipcode.zipcode] if zipcode else None
+        per_page = min(page_size(), meal_search.max_results - 1)
+        meals = ranked_paginate(meals, Meal.id, lambda limit, offset: meal_search.search_ids(
+            q, zipcodes, selected=selected, limit=limit, offset=offset), per_page=per_page)
+    else:
+        meals = keyset_paginate(meals, Meal.id)
     return render_template('admin/meals.html', meals=meals,
                            order_status=order_status_dict[order_status],
-                           zipcode=request.args.get('zipcode'))
+                           zipcode=request.args.get('zipcode'), q=q)
 
 
 @admin.route('/meal/<int:id>/edit')
@@ -56,25 +72,27 @@ def meal_edit(id):
         meal.is_selected = True
     elif selected == 'no':
         meal.is_selected = False
+    db.session.commit()
+    menu_cache.invalidate(zipcode.zipcode for zipcode in meal.zipcodes)
     return redirect(url_for('admin.meals', order_status='all'))
 
 
 @admin.route('/apply/list')
 @superuser_required
+@read_replica
 def apply_list():
     apply_status_dict = {'all': u'全部Apply', 'approved': u'批准的Apply',
                          'waiting': u'待处理的Apply', 'refused': u'拒绝的Apply'}
     apply_status = request.args.get('apply_status')
-    chefApplys = ChefApply.query
+    chefApplys = ChefApply.query.options(db.joinedload(ChefApply.applicant))
     if apply_status:
         apply_status_str = apply_status_dict[apply_status]
         if apply_status != 'all':
             chefApplys = chefApplys.filter(ChefApply.status == apply_status)
-            print(chefApplys)
     else:
         apply_status = 'all'
         apply_status_str = apply_status_dict[apply_status]
-    chefApplys = chefApplys.order_by(ChefApply.id.desc())
+    chefApplys = keyset_paginate(chefApplys, ChefApply.id)
     return render_template('admin/apply_list.html', applys=chefApplys,
                            apply_status=apply_status,
                            apply_status_str=apply_status_str)
@@ -92,6 +110,7 @@ def apply_approve(id):
     db.session.add(chefApply.applicant)
     db.session.add(chefApply)
     db.session.commit()
+    user_cache.invalidate(chefApply.applicant_id)
     return redirect(url_for('chef.chef_apply_status', id=id))
 
 
@@ -106,4 +125,39 @@ def apply_refuse(id):
         chefApply.applicant.roles.remove(chef_role)
     db.session.add(chefApply)
     db.session.commit()
+    user_cache.invalidate(chefApply.applicant_id)
     return redirect(url_for('chef.chef_apply_status', id=id))
+
+
+@admin.route('/orders/export.<fmt>')
+@superuser_required
+@read_replica
+def orders_export(fmt):
+    """导出所有订单，?chef_id= 按大厨过滤，fmt: csv, jsonl"""
+    return export_response(fmt, chef_id=request.args.get('chef_id', type=int))
+
+
+@admin.route('/analytics')
+@superuser_required
+@read_replica
+def analytics():
+    """所有大厨的订单统计，?chef_id= 只看一个大厨，?begin=&end= 日期范围（YYYY-MM-DD）"""
+    chef_id = request.args.get('chef_id', type=int)
+    chef = User.query.get_or_404(chef_id) if chef_id is not None else None
+    return render_template('admin/analytics.html', chef=chef,
+                           report=request_report(request.args, chef_id))
+
+
+@admin.route('/profiler')
+@superuser_required
+def profiler_report():
+    """最近请求的查询数、耗时和重复查询，需要打开PROFILER_ENABLED"""
+    if request.args.get('clear'):
+        profiler.clear()
+        return redirect(url_for('admin.profiler_report'))
+    profiles = sorted(profiler.recent, key=lambda p: p.started, reverse=True)
+    caches = sorted((cache.name, cache.stats()) for cache in current_app.extensions.values()
+                    if isinstance(cache, CountingCache))
+    return render_template('admin/profiler.html', profiler=profiler,
+                           report=profiler.report(), profiles=profiles, caches=caches,
+                           slow_queries=reversed(profiler.slow_queries))
@@ -0,0 +1,193 @@
+# -*- coding:utf-8 -*-
+"""
+订单统计
+
+order_daily_stats（models.OrderDailyStats）按 (大厨, 下单日期, meal, zipcode, 状态) 汇总订单数，
+大厨和管理员的统计页面（chef.analytics、admin.analytics）和API只读这张表，不对 order 做 GROUP BY：
+
+- 增量更新：下单（ordering.place_order）加一，状态变化（Order.transition、Order.bulk_transition）
+  旧状态减一、新状态加一。计数和订单在同一个事务里提交或者回滚；计数行先 insert_ignore 再
+  UPDATE orders = orders + n，和每日限量（meal_daily_count）一样，并发的下单不会丢失计数
+- 重建：rebuild 按下单日期分段，每段在一个事务里删除这些天的统计行，再用
+  INSERT ... SELECT ... GROUP BY 从 order 重新计算（走 order.create_date 的索引），网站运行时也可以执行。
+  上线这个功能之后、批量导入订单（seed 会自动重建）之后运行 python manage.py analytics_rebuild
+- 没有下单时间、大厨、meal或者zipcode的订单不统计
+
+日期是下单的日期：一个订单在它下单那天的统计里从“未处理”移到“已完成”或者“已取消”。
+"""
+
+import datetime
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy import select, literal
+
+from . import db
+from .models import Order, OrderDailyStats, Meal, Zipcode, User
+
+
+def parse_date(value):
+    """'2015-11-01' -> datetime.date，格式不对时抛出ValueError"""
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def window(begin=None, end=None, days=30, max_days=366):
+    """
+    统计的日期范围，默认是到今天为止的days天，超过max_days天时从end往前截断
+    :return: (第一天, 最后一天)
+    """
+    end = end or datetime.date.today()
+    begin = begin or end - datetime.timedelta(days=days - 1)
+    if begin > end:
+        begin, end = end, begin
+    return max(begin, end - datetime.timedelta(days=max_days - 1)), end
+
+
+def request_report(args, chef_id=None):
+    """
+    统计页面使用：?begin=&end= 日期范围，格式不对时忽略，默认最近 ANALYTICS_DAYS 天
+    :param args: request.args
+    :return: Report
+    """
+    config = current_app.config
+    begin, end = window(args.get('begin', type=parse_date), args.get('end', type=parse_date),
+                        days=config['ANALYTICS_DAYS'], max_days=config['ANALYTICS_MAX_DAYS'])
+    return Report(begin, end, chef_id=chef_id, limit=config['ANALYTICS_TOP'])
+
+
+def rebuild(connection, begin=None, end=None, chunk_days=7):
+    """
+    从 order 重新计算统计，每 chunk_days 天一个事务
+    :param connection: Connection，不能在事务里
+    :param begin: 第一天，默认是最早的订单
+    :param end: 最后一天，默认是最新的订单
+    :return: 每段完成后yield (第一天, 最后一天, 统计行数)
+    """
+    order = Order.__table__
+    stats = OrderDailyStats.__table__
+    if begin is None or end is None:
+        first, last = connection.execute(select([db.func.min(order.c.create_date),
+                                                 db.func.max(order.c.create_date)])).first()
+        if first is None:
+            return
+        begin = begin or first.date()
+        end = end or last.date()
+    day = db.func.date(order.c.create_date)
+    columns = [order.c.chef_id, day, order.c.meal_id, order.c.zip_id, order.c.status]
+    while begin <= end:
+        last = min(begin + datetime.timedelta(days=chunk_days - 1), end)
+        query = select(columns + [db.func.count()]) \
+            .where(order.c.create_date >= literal(begin, db.Date)) \
+            .where(order.c.create_date < literal(last + datetime.timedelta(days=1), db.Date)) \
+            .where(order.c.chef_id != None) \
+            .where(order.c.meal_id != None) \
+            .where(order.c.zip_id != None) \
+            .group_by(*columns)
+        with connection.begin():
+            connection.execute(stats.delete()
+                               .where(stats.c.date >= begin)
+                               .where(stats.c.date <= last))
+            rows = connection.execute(stats.insert().from_select(
+                list(OrderDailyStats.KEY) + ['orders'], query)).rowcount
+        yield begin, last, rows
+        begin = last + datetime.timedelta(days=1)
+
+
+class Counts(object):
+    """一组统计：每种状态的订单数"""
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+        self.statuses = OrderedDict((status, 0) for status in Order.STATUS_LABELS)
+
+    @property
+    def total(self):
+        return sum(self.statuses.values())
+
+    def to_json(self):
+        json_counts = dict((key, value) for key, value in self.__dict__.items()
+                           if key != 'statuses')
+        if isinstance(json_counts.get('date'), datetime.date):
+            json_counts['date'] = json_counts['date'].isoformat()
+        json_counts.update(statuses=self.statuses, total=self.total)
+        return json_counts
+
+
+class Report(object):
+    """
+    begin 到 end 的订单统计，chef_id 为空时是所有大厨的
+    :param limit: 订单最多的meal、zipcode、大厨各列出多少个
+    """
+    labels = Order.STATUS_LABELS
+
+    def __init__(self, begin, end, chef_id=None, limit=10):
+        self.begin = begin
+        self.end = end
+        self.chef_id = chef_id
+        self.limit = limit
+        self.totals = Counts()
+        for status, orders in self._query(OrderDailyStats.status).group_by(OrderDailyStats.status):
+            self._add(self.totals, status, orders)
+        self.days = self._days()
+        self.busiest = max([day.total for day in self.days] or [0])
+        self.meals = self._top(OrderDailyStats.meal_id, Meal.name, 'name')
+        self.zipcodes = self._top(OrderDailyStats.zip_id, Zipcode.zipcode, 'zipcode')
+        self.chefs = self._top(OrderDailyStats.chef_id, User.nickname, 'nickname') \
+            if chef_id is None else []
+
+    def _query(self, *columns):
+        query = db.session.query(*(columns + (db.func.sum(OrderDailyStats.orders),))) \
+            .filter(OrderDailyStats.date >= self.begin) \
+            .filter(OrderDailyStats.date <= self.end)
+        if self.chef_id is not None:
+            query = query.filter(OrderDailyStats.chef_id == self.chef_id)
+        return query
+
+    @staticmethod
+    def _add(counts, status, orders):
+        if status in counts.statuses:
+            counts.statuses[status] += int(orders or 0)
+
+    def _days(self):
+        """每一天的统计，没有订单的日期也列出"""
+        days = OrderedDict()
+        day = self.begin
+        while day <= self.end:
+            days[day] = Counts(date=day)
+            day += datetime.timedelta(days=1)
+        for date, status, orders in self._query(OrderDailyStats.date, OrderDailyStats.status) \
+                .group_by(OrderDailyStats.date, OrderDailyStats.status):
+            if date in days:
+                self._add(days[date], status, orders)
+        return list(days.values())
+
+    def _top(self, column, label, name):
+        """
+        订单最多的limit个meal（zipcode、大厨）的统计
+        :param column: OrderDailyStats 的列
+        :param label: 显示的名字，比如 Meal.name
+        """
+        total = db.func.sum(OrderDailyStats.orders)
+        ids = [id for id, orders in self._query(column).group_by(column)
+               .order_by(total.desc(), column).limit(self.limit)]
+        if not ids:
+            return []
+        model = label.class_
+        labels = dict(db.session.query(model.id, label).filter(model.id.in_(ids)))
+        rows = OrderedDict((id, Counts(**{'id': id, name: labels.get(id)})) for id in ids)
+        for id, status, orders in self._query(column, OrderDailyStats.status) \
+                .filter(column.in_(ids)).group_by(column, OrderDailyStats.status):
+            self._add(rows[id], status, orders)
+        return list(rows.values())
+
+    def to_json(self):
+        return {
+            'begin': self.begin.isoformat(),
+            'end': self.end.isoformat(),
+            'chef_id': self.chef_id,
+            'totals': self.totals.to_json(),
+            'days': [day.to_json() for day in self.days],
+            'meals': [meal.to_json() for meal in self.meals],
+            'zipcodes': [zipcode.to_json() for zipcode in self.zipcodes],
+            'chefs': [chef.to_json() for chef in self.chefs],
+        }
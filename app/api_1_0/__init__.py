@@ -4,4 +4,4 @@ from flask import Blueprint
 
 api = Blueprint('api', __name__)
 
-from . import dish
\ No newline at end of file
+from . import authentication, errors, dish, menus, meals, orders, analytics
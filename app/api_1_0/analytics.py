@@ -0,0 +1,44 @@
+# -*- coding:utf-8 -*-
+
+from flask import g, request, current_app, abort
+from ..analytics import Report, window
+from ..decorators import read_replica
+from ..exceptions import ValidationError
+from . import api
+from .authentication import auth
+from .utils import json_response, date_arg
+
+
+def report_response(chef_id):
+    config = current_app.config
+    begin, end = date_arg('begin'), date_arg('end')
+    if begin is not None and end is not None and end < begin:
+        raise ValidationError('end must not be before begin')
+    begin, end = window(begin, end, days=config['ANALYTICS_DAYS'],
+                        max_days=config['ANALYTICS_MAX_DAYS'])
+    limit = max(1, min(request.args.get('limit', type=int) or config['ANALYTICS_TOP'],
+                       config['THREEMEAL_MAX_PER_PAGE']))
+    return json_response(Report(begin, end, chef_id=chef_id, limit=limit).to_json())
+
+
+@api.route('/chef/analytics')
+@auth.login_required
+@read_replica
+def get_chef_analytics():
+    """
+    大厨自己的订单统计：每天、订单最多的meal和zipcode每种状态的订单数（按下单日期）；
+    ?begin=&end= 日期范围，默认最近 ANALYTICS_DAYS 天；?limit= meal和zipcode的个数
+    """
+    if not g.current_user.has_role('chef'):
+        abort(403)
+    return report_response(g.current_user.id)
+
+
+@api.route('/analytics')
+@auth.login_required
+@read_replica
+def get_analytics():
+    """所有大厨的订单统计，只有管理员可以访问；?chef_id= 只看一个大厨，其他参数同 /chef/analytics"""
+    if not g.current_user.has_role('superuser'):
+        abort(403)
+    return report_response(request.args.get('chef_id', type=int))
@@ -0,0 +1,46 @@
+# -*- coding:utf-8 -*-
+
+from flask import g, jsonify
+from flask_httpauth import HTTPBasicAuth
+from flask_login import current_user
+from ..models import User
+from . import api
+from .errors import unauthorized
+
+auth = HTTPBasicAuth()
+
+
+@auth.verify_password
+def verify_password(email_or_token, password):
+    """
+    支持三种认证：email+密码、token（密码为空）、网站登录后的session
+    """
+    if email_or_token == '':
+        if current_user.is_authenticated:
+            g.current_user = current_user._get_current_object()
+            return True
+        return False
+    if password == '':
+        g.current_user = User.verify_auth_token(email_or_token)
+        g.token_used = True
+        return g.current_user is not None
+    user = User.query.filter_by(email=email_or_token).first()
+    if not user:
+        return False
+    g.current_user = user
+    g.token_used = False
+    return user.verify_password(password)
+
+
+@auth.error_handler
+def auth_error():
+    return unauthorized('Invalid credentials')
+
+
+@api.route('/token')
+@auth.login_required
+def get_token():
+    if getattr(g, 'token_used', False):
+        return unauthorized('Invalid credentials')
+    return jsonify({'token': g.current_user.generate_auth_token(expiration=3600),
+                    'expiration': 3600})
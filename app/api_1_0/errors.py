@@ -0,0 +1,56 @@
+# -*- coding:utf-8 -*-
+
+from flask import jsonify
+from ..exceptions import ValidationError, SoldOut
+from . import api
+
+
+def bad_request(message):
+    response = jsonify({'error': 'bad request', 'message': message})
+    response.status_code = 400
+    return response
+
+
+def unauthorized(message):
+    response = jsonify({'error': 'unauthorized', 'message': message})
+    response.status_code = 401
+    return response
+
+
+def forbidden(message):
+    response = jsonify({'error': 'forbidden', 'message': message})
+    response.status_code = 403
+    return response
+
+
+def conflict(message):
+    response = jsonify({'error': 'conflict', 'message': message})
+    response.status_code = 409
+    return response
+
+
+def not_found(message):
+    response = jsonify({'error': 'not found', 'message': message})
+    response.status_code = 404
+    return response
+
+
+# 要在ValidationError之前注册，先注册的处理函数先匹配
+@api.errorhandler(SoldOut)
+def sold_out(e):
+    return conflict(e.args[0])
+
+
+@api.errorhandler(ValidationError)
+def validation_error(e):
+    return bad_request(e.args[0])
+
+
+@api.errorhandler(404)
+def page_not_found(e):
+    return not_found('resource not found')
+
+
+@api.errorhandler(403)
+def access_forbidden(e):
+    return forbidden('insufficient permissions')
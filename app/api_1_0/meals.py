@@ -0,0 +1,51 @@
+# -*- coding:utf-8 -*-
+
+from flask import url_for, request, current_app
+from .. import meal_search, zipcode_index
+from ..decorators import read_replica
+from ..exceptions import ValidationError
+from ..models import Meal
+from . import api
+from .utils import json_response, requested_fields, select_fields, date_arg
+
+
+@api.route('/meals/<int:id>')
+def get_meal(id):
+    meal = Meal.query.get_or_404(id)
+    fields = requested_fields()
+    return json_response(select_fields(meal.to_json(fields), fields), private=False)
+
+
+@api.route('/meals/search')
+@read_replica
+def search_meals():
+    """
+    按名字和描述搜索meal，按相关度（score）从高到低：
+    ?q= 搜索词，最后一个词按前缀匹配；?zipcode= 配送到这个zipcode和附近（?nearby=0 只要zipcode本身）；
+    ?date= 或者 ?begin=&end= 配送日期窗口有交集；?selected=all 包括没有被推荐的meal（默认只有推荐的）；
+    ?limit= ?offset= 分页
+    """
+    q = request.args.get('q', '')
+    zipcodes = None
+    zipcode = request.args.get('zipcode')
+    if zipcode:
+        zipcodes = [zipcode]
+        if request.args.get('nearby', '1') != '0':
+            zipcodes = [code for code, distance in zipcode_index.nearby(zipcode)] or zipcodes
+    begin = date_arg('date') or date_arg('begin')
+    end = date_arg('end')
+    if end is not None and begin is None:
+        raise ValidationError('end requires begin')
+    if end is not None and end < begin:
+        raise ValidationError('end must not be before begin')
+    selected = {'true': True, 'false': False, 'all': None}.get(request.args.get('selected', 'true'))
+    limit = request.args.get('limit', type=int) or current_app.config['THREEMEAL_PER_PAGE']
+    offset = request.args.get('offset', 0, type=int)
+    meals = meal_search.search(q, zipcodes=zipcodes, begin=begin, end=end, selected=selected,
+                               limit=limit, offset=offset)
+    fields = requested_fields()
+    items = []
+    for meal in meals:
+        meal = dict(meal, url=url_for('api.get_meal', id=meal['id'], _external=True))
+        items.append(select_fields(meal, fields))
+    return json_response({'q': q, 'meals': items}, private=False)
@@ -0,0 +1,42 @@
+# -*- coding:utf-8 -*-
+
+import datetime
+from flask import url_for, request
+from .. import menu_cache, zipcode_index
+from ..decorators import read_replica, read_primary
+from ..exceptions import ValidationError
+from ..models import Meal, Zipcode
+from . import api
+from .errors import not_found
+from .utils import json_response, requested_fields, select_fields
+
+
+@api.route('/menus/<zipcode>')
+@read_replica
+def get_menu(zipcode):
+    """zipcode和附近的zipcode某一天（默认今天）被推荐的meal，distance是配送zipcode的距离（英里）"""
+    if not Zipcode.is_valid(zipcode):
+        raise ValidationError('invalid zipcode')
+    date = request.args.get('date')
+    try:
+        date = datetime.datetime.strptime(date, '%Y-%m-%d').date() if date \
+            else datetime.date.today()
+    except ValueError:
+        raise ValidationError('date must be YYYY-MM-DD')
+    if date == datetime.date.today():
+        meals = menu_cache.get(zipcode, date,
+                               lambda: read_primary(Meal.load_menu)(
+                                   zipcode, date, zipcode_index.nearby(zipcode)))
+    else:
+        # MenuCache.invalidate 只删除今天的菜单，其他日期不缓存
+        meals = Meal.load_menu(zipcode, date, zipcode_index.nearby(zipcode))
+    if meals is None:
+        return not_found('no meals for this zipcode')
+    fields = requested_fields()
+    items = []
+    for meal in meals:
+        meal = dict(meal, url=url_for('api.get_meal', id=meal['id'], _external=True))
+        items.append(select_fields(meal, fields))
+    return json_response({'zipcode': zipcode,
+                          'date': date.isoformat(),
+                          'meals': items}, private=False)
@@ -0,0 +1,161 @@
+# -*- coding:utf-8 -*-
+
+from flask import g, request, url_for, abort
+from werkzeug.datastructures import MultiDict
+from .. import db
+from ..client.forms import ClientOrderForm
+from ..exceptions import ValidationError
+from ..models import Order, Meal
+from ..ordering import place_order
+from ..util import keyset_paginate, page_size
+from . import api
+from .authentication import auth
+from .utils import json_response, requested_fields, select_fields
+
+
+def order_list_response(query):
+    page = keyset_paginate(Order.load_relations(query), Order.id)
+    fields = requested_fields()
+    return json_response({
+        'orders': [select_fields(order.to_json(), fields) for order in page],
+        'next': page.next_url,
+    })
+
+
+def new_orders_response(query):
+    per_page = page_size()
+    orders = Order.load_relations(query).limit(per_page + 1).all()
+    next_url = None
+    if len(orders) > per_page:
+        orders = orders[:per_page]
+        args = request.args.to_dict()
+        args['after'] = orders[-1].id
+        next_url = url_for(request.endpoint, **args)
+    fields = requested_fields()
+    return json_response({
+        'orders': [select_fields(order.to_json(), fields) for order in orders],
+        'next': next_url,
+    })
+
+
+def get_json():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ValidationError('request body must be a JSON object')
+    return data
+
+
+@api.route('/orders')
+@auth.login_required
+def get_orders():
+    """当前用户作为客户的订单"""
+    return order_list_response(Order.query.filter_by(client_id=g.current_user.id))
+
+
+@api.route('/chef/orders')
+@auth.login_required
+def get_chef_orders():
+    """
+    大厨的订单队列，?status=unhandled 按状态过滤；
+    ?after=<订单id> 只返回这之后的新订单，按id从小到大，用于收到推送后取增量
+    """
+    if not g.current_user.has_role('chef'):
+        abort(403)
+    after = request.args.get('after', type=int)
+    if after is not None:
+        return new_orders_response(Order.created_after(g.current_user.id, after))
+    query = Order.query.filter_by(chef_id=g.current_user.id)
+    status = request.args.get('status')
+    if status:
+        if status.upper() not in Order.status.type.enums:
+            raise ValidationError('unknown status')
+        query = query.filter_by(status=status.upper())
+    return order_list_response(query)
+
+
+@api.route('/orders/<int:id>')
+@auth.login_required
+def get_order(id):
+    order = Order.query.get_or_404(id)
+    user = g.current_user
+    if user.id not in (order.client_id, order.chef_id) and not user.has_role('superuser'):
+        abort(403)
+    return json_response(select_fields(order.to_json(), requested_fields()),
+                         last_modified=order.update_date)
+
+
+@api.route('/orders', methods=['POST'])
+@auth.login_required
+def new_order():
+    """
+    下单，请求头 Idempotency-Key（或者字段 idempotency_key）相同的重试返回第一次创建的订单，状态码200
+    """
+    data = get_json()
+    meal = Meal.query.get(data.get('meal_id'))
+    if meal is None:
+        raise ValidationError('unknown meal')
+    if 'Idempotency-Key' in request.headers:
+        data['idempotency_key'] = request.headers['Idempotency-Key']
+    form = ClientOrderForm(MultiDict(data), csrf_enabled=False)
+    if not form.validate():
+        raise ValidationError(form.errors)
+    order, created = place_order(meal, data.get('zipcode'), g.current_user.id,
+                                 address=form.address.data,
+                                 phone=form.phone.data,
+                                 message=form.message.data,
+                                 idempotency_key=form.idempotency_key.data)
+    response = json_response(order.to_json(), status=201 if created else 200)
+    response.headers['Location'] = url_for('api.get_order', id=order.id, _external=True)
+    return response
+
+
+@api.route('/orders/<int:id>', methods=['PUT'])
+@auth.login_required
+def edit_order(id):
+    """
+    客户：未处理的订单可以修改address、phone、message，可以取消未处理的订单、确认收货；
+    大厨：处理或者取消未处理的订单，修改remark
+    """
+    order = Order.query.get_or_404(id)
+    user = g.current_user
+    data = get_json()
+    if order.chef_id == user.id or user.has_role('superuser'):
+        role = 'chef'
+        editable = ('remark',)
+    elif order.client_id == user.id:
+        role = 'client'
+        editable = ('address', 'phone', 'message') if order.status == 'UNHANDLED' else ()
+    else:
+        abort(403)
+    for field in data:
+        if field != 'status' and field not in editable:
+            raise ValidationError('field %s can not be changed' % field)
+    status = data.get('status')
+    if status is not None and status != order.status:
+        order.transition(status, role)
+    for field in editable:
+        if field in data:
+            setattr(order, field, data[field])
+    db.session.add(order)
+    db.session.commit()
+    return json_response(order.to_json(), last_modified=order.update_date)
+
+
+@api.route('/chef/orders/status', methods=['POST'])
+@auth.login_required
+def bulk_order_status():
+    """
+    大厨一次修改一批订单的状态，比如整批发货：{"ids": [1, 2, 3], "status": "HANDLED"}，
+    当前状态不允许修改的订单会被跳过
+    """
+    user = g.current_user
+    if not user.has_role('chef'):
+        abort(403)
+    data = get_json()
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not all(isinstance(id, int) for id in ids):
+        raise ValidationError('ids must be a list of order ids')
+    chef_id = None if user.has_role('superuser') else user.id
+    count = Order.bulk_transition(ids, data.get('status'), 'chef', chef_id=chef_id)
+    db.session.commit()
+    return json_response({'updated': count, 'skipped': len(set(ids)) - count})
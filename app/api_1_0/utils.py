@@ -0,0 +1,62 @@
+# -*- coding:utf-8 -*-
+
+import datetime
+import json
+from flask import current_app, request
+from ..exceptions import ValidationError
+
+
+def date_arg(name):
+    """
+    :return: 查询参数name（YYYY-MM-DD）的日期，没有时返回None
+    :raise ValidationError: 格式不对
+    """
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValidationError('%s must be YYYY-MM-DD' % name)
+
+
+def requested_fields():
+    """
+    ?fields=id,name 指定只返回哪些字段
+    :return: 字段集合，没有指定时返回None
+    """
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return set(field.strip() for field in fields.split(',') if field.strip())
+
+
+def select_fields(data, fields):
+    if fields is None:
+        return data
+    return dict((key, value) for key, value in data.items() if key in fields)
+
+
+def json_response(payload, last_modified=None, private=True, status=200):
+    """
+    生成带ETag和Last-Modified的JSON响应，If-None-Match或If-Modified-Since匹配时返回304
+    :param payload: 可以json序列化的对象
+    :param last_modified: 资源最后修改时间
+    :param private: 响应包含用户数据，不允许共享缓存
+    :param status: 状态码，只有200会做条件请求处理
+    :return: response
+    """
+    response = current_app.response_class(
+        json.dumps(payload, separators=(',', ':'), sort_keys=True),
+        status=status, mimetype='application/json')
+    if status != 200:
+        return response
+    response.add_etag()
+    if last_modified is not None:
+        response.last_modified = last_modified
+    if private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
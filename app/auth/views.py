@@ -42,9 +42,8 @@ def signup():
                      email=form.data['email'],
                      password=form.data['password'])
             db.session.add(u)
-            db.session.commit()
-
             send_email(u.email, u'欢迎加入每日三餐', 'email/welcome', user=u)
+            db.session.commit()
             flash(u'注册成功', 'info')
             login_user(u)
             return redirect(url_for('client.index'))
@@ -0,0 +1,202 @@
+# -*- coding:utf-8 -*-
+"""
+基准测试
+
+数据由 seed.Seeder 生成（或者使用已经有数据的数据库），Benchmark 通过 test client
+反复请求主要页面（client.menu、client.meal_detail下单、client.search_suggest、chef.orders、
+chef.analytics、admin.meals、auth.login），统计吞吐量、p50/p95/p99延迟、每个请求的查询数和各个缓存的命中率。结果是可以直接 json.dump
+的dict，保存下来就能比较不同版本的性能。
+
+入口是 python manage.py bench，见 manage.py。
+"""
+
+import time
+from collections import OrderedDict, Counter
+
+from flask import url_for
+from sqlalchemy import event
+
+from . import db
+from .cache import CountingCache
+from .models import User, Role, Zipcode, MealZipcode, Order
+from .seed import SEED_PASSWORD, ADMIN_EMAIL
+
+
+def percentile(values, p):
+    """
+    :param values: 排好序的列表
+    :param p: 0-100
+    :return: nearest-rank百分位数
+    """
+    if not values:
+        return None
+    rank = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def login(client, email):
+    response = client.post(url_for('auth.login'),
+                           data={'email': email, 'password': SEED_PASSWORD})
+    if response.status_code != 302:
+        raise RuntimeError('login as %s failed' % email)
+
+
+class QueryCounter(object):
+    """统计engine执行的SQL数量"""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+class Benchmark(object):
+    """在已经有数据的数据库上请求各个页面"""
+
+    def __init__(self, app, rng, requests=100, warmup=10):
+        self.app = app
+        self.rng = rng
+        self.requests = requests
+        self.warmup = warmup
+        self.queries = QueryCounter(db.engine)
+        self.scenarios = OrderedDict([
+            ('client.menu', self.client_menu),
+            ('client.meal_detail', self.client_meal_detail),
+            ('client.search', self.client_search),
+            ('chef.orders', self.chef_orders),
+            ('chef.analytics', self.chef_analytics),
+            ('admin.meals', self.admin_meals),
+            ('auth.login', self.auth_login),
+        ])
+
+    def _fixtures(self):
+        """挑选请求用的zipcode、meal、大厨和客户"""
+        self.zipcodes = [zipcode for zipcode, in db.session.query(Zipcode.zipcode)]
+        self.meal_zipcodes = db.session.query(MealZipcode.meal_id, Zipcode.zipcode) \
+            .join(Zipcode, Zipcode.id == MealZipcode.zipcode_id).limit(1000).all()
+        chef_role = Role.query.filter_by(name='chef').first()
+        busiest_chef = db.session.query(Order.chef_id) \
+            .group_by(Order.chef_id) \
+            .order_by(db.func.count(Order.id).desc()).first()
+        self.chef_email = User.query.get(busiest_chef[0]).email
+        client = User.query.filter(~User.roles.contains(chef_role)) \
+            .filter(User.email != ADMIN_EMAIL).first()
+        self.client_email = client.email
+
+    def client_menu(self, client):
+        """匿名用户查看某个zipcode的菜单"""
+        zipcode = self.rng.choice(self.zipcodes)
+        return lambda: client.get(url_for('client.menu', zipcode=zipcode))
+
+    def client_search(self, client):
+        """搜索框的输入提示，第一次请求时建立搜索索引（在warmup里）"""
+        zipcode = self.rng.choice(self.zipcodes)
+        q = 'meal %d' % self.rng.randint(10, 99)
+        return lambda: client.get(url_for('client.search_suggest', q=q, zipcode=zipcode))
+
+    def client_meal_detail(self, client):
+        """客户在meal详情页下单"""
+        if not getattr(client, 'logged_in', False):
+            login(client, self.client_email)
+            client.logged_in = True
+        meal_id, zipcode = self.rng.choice(self.meal_zipcodes)
+        with client.session_transaction() as session:
+            session['client_zipcode'] = zipcode
+        data = {'address': '1 Bench Street', 'phone': '5550000000', 'message': 'bench'}
+        return lambda: client.post(url_for('client.meal_detail', id=meal_id), data=data)
+
+    def chef_orders(self, client):
+        if not getattr(client, 'logged_in', False):
+            login(client, self.chef_email)
+            client.logged_in = True
+        return lambda: client.get(url_for('chef.orders', order_status='all'))
+
+    def chef_analytics(self, client):
+        """大厨最近30天的订单统计，只读 order_daily_stats"""
+        if not getattr(client, 'logged_in', False):
+            login(client, self.chef_email)
+            client.logged_in = True
+        return lambda: client.get(url_for('chef.analytics'))
+
+    def admin_meals(self, client):
+        if not getattr(client, 'logged_in', False):
+            login(client, ADMIN_EMAIL)
+            client.logged_in = True
+        return lambda: client.get(url_for('admin.meals', order_status='all'))
+
+    def auth_login(self, client):
+        client.cookie_jar.clear()
+        data = {'email': self.client_email, 'password': SEED_PASSWORD}
+        return lambda: client.post(url_for('auth.login'), data=data)
+
+    def cache_counts(self):
+        """
+        :return: {缓存名: (命中, 未命中)}
+        """
+        return dict((cache.name, (cache.hits, cache.misses))
+                    for cache in self.app.extensions.values() if isinstance(cache, CountingCache))
+
+    def run_scenario(self, name):
+        """
+        :return: 一个场景的统计结果
+        """
+        prepare = self.scenarios[name]
+        client = self.app.test_client()
+        latencies = []
+        queries = []
+        statuses = Counter()
+        elapsed = 0.0
+        for i in range(self.warmup + self.requests):
+            if i == self.warmup:
+                counts = self.cache_counts()
+            send = prepare(client)
+            self.queries.count = 0
+            start = time.time()
+            response = send()
+            duration = time.time() - start
+            if i < self.warmup:
+                continue
+            elapsed += duration
+            latencies.append(duration * 1000)
+            queries.append(self.queries.count)
+            statuses[response.status_code] += 1
+        latencies.sort()
+        caches = OrderedDict()
+        for cache, (hits, misses) in sorted(self.cache_counts().items()):
+            hits -= counts[cache][0]
+            misses -= counts[cache][1]
+            if hits + misses:
+                caches[cache] = OrderedDict([('hits', hits), ('misses', misses),
+                                             ('hit_ratio', float(hits) / (hits + misses))])
+        return OrderedDict([
+            ('requests', len(latencies)),
+            ('throughput', len(latencies) / elapsed if elapsed else None),
+            ('latency_ms', OrderedDict([
+                ('mean', sum(latencies) / len(latencies)),
+                ('p50', percentile(latencies, 50)),
+                ('p95', percentile(latencies, 95)),
+                ('p99', percentile(latencies, 99)),
+                ('max', latencies[-1]),
+            ])),
+            ('queries', OrderedDict([
+                ('mean', float(sum(queries)) / len(queries)),
+                ('max', max(queries)),
+            ])),
+            ('statuses', dict((str(status), count) for status, count in statuses.items())),
+            ('caches', caches),
+        ])
+
+    def run(self, names=None):
+        """
+        :param names: 要运行的场景，默认全部
+        :return: {场景: 统计结果}
+        """
+        with self.app.test_request_context():
+            self._fixtures()
+            results = OrderedDict()
+            for name in names or self.scenarios.keys():
+                results[name] = self.run_scenario(name)
+                db.session.remove()
+        return results
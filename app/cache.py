@@ -0,0 +1,245 @@
+# -*- coding:utf-8 -*-
+"""
+进程内缓存
+
+MenuCache 按 (zipcode, date) 缓存 client.menu 的每日菜单。菜单只在大厨
+编辑meal或管理员推荐/取消推荐时改变，所以由这些视图显式调用 invalidate；
+另外缓存在当天午夜过期，保证日期窗口的变化能被看到。
+
+UserCache 缓存 load_user 读取的用户（连同roles），每个已登录的请求不再需要查询
+user 和 roles 两张表。缓存时间很短（USER_CACHE_TIMEOUT），修改角色的视图会显式调用
+invalidate。
+
+存储后端使用 werkzeug 的 cache 接口（get/set/delete/clear），默认是进程内的
+SimpleCache，可以通过配置 MENU_CACHE_BACKEND 换成 RedisCache、MemcachedCache 等。
+LRUCache 是按占用内存淘汰的进程内后端，模板片段缓存（fragments.py）和
+HTTP响应缓存（httpcache.py）使用。
+
+每次命中和未命中同时记在当前请求的性能分析里（profiler.record_cache）。
+"""
+
+import datetime
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from werkzeug.contrib.cache import BaseCache, SimpleCache
+
+from .profiler import record_cache
+
+
+def seconds_until_end_of(date, now=None):
+    """
+    距离某一天结束（次日零点）还有多少秒
+    :param date: datetime.date
+    :param now: 当前时间，默认datetime.datetime.now()
+    :return: 秒数，已经过去的日期返回0
+    """
+    now = now or datetime.datetime.now()
+    midnight = datetime.datetime.combine(date + datetime.timedelta(days=1),
+                                         datetime.time())
+    return max(int((midnight - now).total_seconds()), 0)
+
+
+def sizeof(value):
+    """sys.getsizeof，tuple和list加上元素的大小"""
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(sizeof(item) for item in value)
+    return size
+
+
+class LRUCache(BaseCache):
+    """
+    进程内的LRU缓存，条目占用的内存（sizeof估算）超过 max_bytes 时淘汰最久没有使用的
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, default_timeout=300):
+        BaseCache.__init__(self, default_timeout)
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        # {key: (过期时间, value, 字节数)}，按使用时间从旧到新
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value, size = entry
+            if expires and expires < time.time():
+                self.bytes -= size
+                return None
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        size = sys.getsizeof(key) + sizeof(value)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._entries[key] = (time.time() + timeout if timeout else 0, value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                key, (expires, value, size) = self._entries.popitem(last=False)
+                self.bytes -= size
+                self.evictions += 1
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False
+            self.bytes -= entry[2]
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+        return True
+
+
+class CountingCache(object):
+    """带命中/未命中计数的缓存"""
+    name = None
+
+    def __init__(self, app=None, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        子类在这里读取各自的配置、创建后端并登记到 app.extensions，基类不做任何事，
+        直接传入backend创建的实例可以不调用
+        """
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / total if total else 0.0}
+
+    def _incr(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        record_cache(self.name, counter == 'hits')
+
+
+class MenuCache(CountingCache):
+    """每日菜单缓存"""
+    name = 'menu'
+
+    def init_app(self, app):
+        if self.backend is None:
+            self.backend = app.config.get('MENU_CACHE_BACKEND') or \
+                SimpleCache(threshold=app.config.get('MENU_CACHE_THRESHOLD', 5000))
+        app.extensions['menu_cache'] = self
+
+    @staticmethod
+    def make_key(zipcode, date):
+        return 'menu:%s:%s' % (zipcode, date.isoformat())
+
+    def get(self, zipcode, date, loader):
+        """
+        获取菜单，未命中时调用loader生成并缓存到当天午夜
+        :param zipcode: zipcode字符串
+        :param date: 菜单日期
+        :param loader: 无参数函数，返回可以pickle的菜单数据
+        :return: 菜单数据，loader返回None时不缓存
+        """
+        key = self.make_key(zipcode, date)
+        menu = self.backend.get(key)
+        if menu is not None:
+            self._incr('hits')
+            return menu
+        self._incr('misses')
+        menu = loader()
+        timeout = seconds_until_end_of(date)
+        if menu is not None and timeout > 0:
+            self.backend.set(key, menu, timeout=timeout)
+        return menu
+
+    def invalidate(self, zipcodes, date=None):
+        """
+        删除zipcode的菜单缓存，附近的zipcode的菜单也包含这些zipcode的meal，一起删除
+        :param zipcodes: zipcode字符串列表
+        :param date: 菜单日期，默认今天
+        """
+        date = date or datetime.date.today()
+        zipcodes = set(zipcodes)
+        index = current_app.extensions.get('zipcode_index')
+        if index is not None:
+            zipcodes = index.expand(zipcodes)
+        for zipcode in zipcodes:
+            self.backend.delete(self.make_key(zipcode, date))
+
+
+class UserCache(CountingCache):
+    """已登录用户的缓存，值在后端中以pickle保存，每次取出的都是独立的detached对象"""
+    name = 'user'
+
+    def init_app(self, app):
+        if self.backend is None:
+            self.backend = app.config.get('USER_CACHE_BACKEND') or \
+                SimpleCache(threshold=app.config.get('USER_CACHE_THRESHOLD', 5000))
+        self.timeout = app.config.get('USER_CACHE_TIMEOUT', 60)
+        app.extensions['user_cache'] = self
+
+    @staticmethod
+    def make_key(user_id):
+        return 'user:%s' % user_id
+
+    def get(self, user_id, loader):
+        """
+        获取用户，未命中时调用loader读取并缓存 USER_CACHE_TIMEOUT 秒
+        :param user_id: 用户id
+        :param loader: 无参数函数，返回已经加载好roles的User，不存在时返回None
+        :return: detached的User，不存在时返回None
+        """
+        key = self.make_key(user_id)
+        user = self.backend.get(key)
+        if user is not None:
+            self._incr('hits')
+            return user
+        self._incr('misses')
+        user = loader()
+        if user is not None:
+            self.backend.set(key, user, timeout=self.timeout)
+        return user
+
+    def invalidate(self, *user_ids):
+        """
+        用户或者用户的角色改变后删除缓存
+        :param user_ids: 用户id
+        """
+        for user_id in set(user_ids):
+            self.backend.delete(self.make_key(user_id))
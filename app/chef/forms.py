@@ -1,11 +1,14 @@
 # -*- coding:utf-8 -*-
+import datetime
+from collections import OrderedDict, Counter
 from flask_wtf import Form
-from wtforms import StringField, TextAreaField, SelectField, FileField
+from wtforms import StringField, TextAreaField, SelectField, FileField, IntegerField, \
+    BooleanField
 from wtforms.fields.html5 import EmailField, DateField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, \
-    ValidationError
+    ValidationError, Optional, NumberRange
 
-from ..models import Meal
+from ..models import Meal, Order
 
 
 class MealEditForm(Form):
@@ -14,18 +17,79 @@ class MealEditForm(Form):
     description = TextAreaField()
     begin_date = DateField(u'Begin Date', validators=[DataRequired()])
     end_date = DateField(u'End Date', validators=[DataRequired()])
+    daily_capacity = IntegerField(u'Daily Capacity', validators=[Optional(), NumberRange(min=0)])
+
+    def validate_zipcodes(self, field):
+        try:
+            windows = self.zipcode_windows()
+        except ValueError:
+            raise ValidationError(u'日期格式应为 zipcode:2015-01-01~2015-01-07')
+        if not windows:
+            raise ValidationError(u'请至少填写一个zipcode')
+        for begin, end in windows.values():
+            if begin and end and begin > end:
+                raise ValidationError(u'开始日期不能晚于结束日期')
+
+    def zipcode_windows(self):
+        """
+        解析zipcodes字段，zipcode之间用","分开，每个zipcode可以单独设置日期，
+        比如 94536:2015-11-01~2015-11-07，没有设置的使用Begin Date和End Date
+        :return: OrderedDict {zipcode: (begin_date, end_date)}
+        """
+        windows = OrderedDict()
+        for item in (self.zipcodes.data or '').split(','):
+            zipcode, _, dates = item.partition(':')
+            zipcode = zipcode.strip()
+            if not zipcode:
+                continue
+            if dates.strip():
+                begin, _, end = dates.partition('~')
+                windows[zipcode] = (self._parse_date(begin), self._parse_date(end))
+            else:
+                windows[zipcode] = (self.begin_date.data, self.end_date.data)
+        return windows
+
+    def set_zipcode_windows(self, windows):
+        """
+        用meal的zipcode日期填充表单，最常见的日期作为Begin Date和End Date
+        :param windows: {zipcode: (begin_date, end_date)}
+        """
+        if not windows:
+            self.zipcodes.data = ''
+            return
+        default = Counter(windows.values()).most_common(1)[0][0]
+        self.begin_date.data, self.end_date.data = default
+        self.zipcodes.data = ','.join(
+            zipcode if window == default else '%s:%s~%s' % (
+                zipcode, window[0].strftime(self.begin_date.format),
+                window[1].strftime(self.end_date.format))
+            for zipcode, window in windows.items())
+
+    def _parse_date(self, value):
+        return datetime.datetime.strptime(value.strip(), self.begin_date.format).date()
 
 
 class ChefOrderEditForm(Form):
     status = SelectField('Status', coerce=unicode, validators=[DataRequired()])
     remark = StringField('Remark', validators=[Length(0, 256, message=u'长度要小于256个字符')])
 
-    def __init__(self, *args, **kwargs):
+    ACTIONS = {'HANDLED': u'发货', 'CANCELED': u'取消订单'}
+
+    def __init__(self, status, *args, **kwargs):
+        """
+        :param status: 订单当前的状态，可选的状态由 Order.TRANSITIONS 决定
+        """
         super(ChefOrderEditForm, self).__init__(*args, **kwargs)
-        self.status.choices = [('HANDLED', u'发货'), ('CANCELED', u'取消订单')]
+        self.status.choices = [(status, Order.STATUS_LABELS[status])] + \
+            [(target, self.ACTIONS[target]) for target in Order.next_statuses(status, 'chef')]
 
 
 class ChefApplyForm(Form):
     content = TextAreaField(validators=[DataRequired()])
     files = FileField('apply_files')
 
+
+class NotifySettingsForm(Form):
+    """订单通知设置，见 notify.py"""
+    phone = StringField(u'Phone', validators=[Optional(), Length(max=20)])
+    notify_digest = BooleanField(u'Digest')
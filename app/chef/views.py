@@ -1,11 +1,17 @@
 # -*- coding:utf-8 -*-
 
-from flask import render_template, redirect, url_for, abort, flash, request, jsonify
+from flask import render_template, redirect, url_for, abort, flash, request, jsonify, \
+    current_app, Response, stream_with_context
 from flask_login import login_required, current_user
 from . import chef
-from .forms import MealEditForm, ChefOrderEditForm, ChefApplyForm
-from .. import db
-from ..models import Meal, Zipcode, MealZipcode, Order, Role, ChefApply, S3file
+from .forms import MealEditForm, ChefOrderEditForm, ChefApplyForm, NotifySettingsForm
+from .. import db, menu_cache, user_cache, order_feed, meal_search
+from ..decorators import read_replica
+from ..util import keyset_paginate
+from ..export import export_response
+from ..analytics import request_report
+from ..exceptions import InvalidTransition
+from ..models import Meal, Order, Role, User, ChefApply, S3file
 
 
 @chef.before_app_first_request
@@ -21,7 +27,8 @@ def before_request():
         return redirect(url_for('auth.login'))
     if not current_user.has_role('chef') and \
                     request.endpoint != 'chef.chef_apply' and \
-                    request.endpoint != 'chef.chef_apply_status':
+                    request.endpoint != 'chef.chef_apply_status' and \
+                    request.endpoint != 'chef.apply_file':
         chefApply = ChefApply.query.filter_by(applicant_id=current_user.id) \
             .first()
         if chefApply:
@@ -61,11 +68,24 @@ def chef_apply_status(id):
     return render_template('chef/chef_apply_status.html', apply=chefApply)
 
 
+@chef.route('/apply/<int:id>/files/<int:file_id>')
+@login_required
+def apply_file(id, file_id):
+    """申请附件下载，权限同chef_apply_status"""
+    chefApply = ChefApply.query.get_or_404(id)
+    if not (chefApply.applicant_id == current_user.id or
+                current_user.has_role('superuser')):
+        abort(403)
+    s3file = S3file.query.filter_by(id=file_id, model_id=chefApply.id).first_or_404()
+    return s3file.send()
+
+
 @chef.route('/meal_list')
 @login_required
+@read_replica
 def meal_list():
     """meal列表"""
-    meals = Meal.query.filter_by(chef_id=current_user.id).order_by(Meal.id.desc())
+    meals = keyset_paginate(Meal.query.filter_by(chef_id=current_user.id), Meal.id)
     return render_template('chef/meal_list.html', meals=meals)
 
 
@@ -75,20 +95,16 @@ def meal_create():
     """创建meal"""
     form = MealEditForm()
     if form.validate_on_submit():
-        zipcodes = form.zipcodes.data
         meal = Meal(name=form.name.data,
                     description=form.description.data,
+                    daily_capacity=form.daily_capacity.data,
                     chef_id=current_user.id)
-        zips = Zipcode.add_zips(zipcodes.split(','))
         db.session.add(meal)
+        db.session.flush()
+        zipcodes = meal.update_zipcodes(form.zipcode_windows())
+        meal_search.update(db.session, meal)
         db.session.commit()
-        meal_zips = [MealZipcode(meal_id=meal.id,
-                                 zipcode_id=zip.id,
-                                 begin_date=form.begin_date.data,
-                                 end_date=form.end_date.data)
-                     for zip in zips]
-        db.session.add_all(meal_zips)
-        db.session.commit()
+        menu_cache.invalidate(zipcodes)
         return redirect(url_for('client.meal_detail', id=meal.id))
     return render_template('chef/meal_create.html', form=form)
 
@@ -102,40 +118,117 @@ def meal_edit(id):
         abort(403)
     form = MealEditForm()
     if form.validate_on_submit():
+        windows = form.zipcode_windows()
+        # 名字和描述会显示在所有zipcode的菜单里
+        renamed = meal.name != form.name.data or meal.description != form.description.data
         meal.name = form.name.data
         meal.description = form.description.data
-        # update the begin and end date
-        for meal_zipcode in meal.meal_zipcodes:
-            meal_zipcode.begin_date = form.begin_date.data
-            meal_zipcode.end_date = form.end_date.data
-        zips = Zipcode.add_zips(form.zipcodes.data.split(','))
-        while (len(meal.meal_zipcodes) > 0):
-            meal.meal_zipcodes.pop()
-        print(meal.meal_zipcodes)
-        # create new MealZipcode
-        for zipcode in zips:
-            meal_zipcode = MealZipcode(meal_id=meal.id,
-                                       zipcode_id=zipcode.id,
-                                       begin_date=form.begin_date.data,
-                                       end_date=form.end_date.data)
-            db.session.add(meal_zipcode)
+        meal.daily_capacity = form.daily_capacity.data
+        zipcodes = meal.update_zipcodes(windows)
         db.session.add(meal)
+        if renamed:
+            meal_search.update(db.session, meal)
         db.session.commit()
-    form.zipcodes.data = ','.join((zipcode.zipcode for zipcode in meal.zipcodes))
+        if renamed:
+            zipcodes |= set(windows)
+        menu_cache.invalidate(zipcodes)
+    form.set_zipcode_windows(meal.zipcode_windows())
     form.name.data = meal.name
     form.description.data = meal.description
-    if len(meal.meal_zipcodes) > 0:
-        form.begin_date.data = meal.meal_zipcodes[0].begin_date
-        form.end_date.data = meal.meal_zipcodes[0].end_date
+    form.daily_capacity.data = meal.daily_capacity
     return render_template('chef/meal_create.html', form=form)
 
 
 @chef.route('/orders/<order_status>')
 @login_required
+@read_replica
 def orders(order_status):
-    """订单列表"""
-    orders = Order.query.filter_by(chef_id=current_user.id).order_by(Order.id.desc())
-    return render_template('chef/orders.html', orders=orders)
+    """
+    订单列表
+    :param order_status: all, unhandled, handled, completed, canceled
+    """
+    orders = Order.query.filter_by(chef_id=current_user.id)
+    if order_status != 'all':
+        if order_status.upper() not in Order.status.type.enums:
+            abort(404)
+        orders = orders.filter_by(status=order_status.upper())
+    orders = keyset_paginate(Order.load_relations(orders), Order.id)
+    return render_template('chef/orders.html', orders=orders, order_status=order_status)
+
+
+@chef.route('/analytics')
+@login_required
+@read_replica
+def analytics():
+    """自己的订单统计，?begin=&end= 日期范围（YYYY-MM-DD）"""
+    return render_template('chef/analytics.html',
+                           report=request_report(request.args, current_user.id))
+
+
+@chef.route('/orders/stream')
+@login_required
+def orders_stream():
+    """
+    新订单和订单状态变化的推送（text/event-stream），见 feed.py
+    断线重连时补发 Last-Event-ID（或者 ?after=）之后的新订单
+    """
+    after = request.headers.get('Last-Event-ID', type=int)
+    if after is None:
+        after = request.args.get('after', type=int)
+    subscription = order_feed.subscribe(current_user.id)
+    backlog = []
+    if after is not None:
+        backlog = Order.created_after(current_user.id, after) \
+            .with_entities(Order.id, Order.status) \
+            .limit(current_app.config['THREEMEAL_MAX_PER_PAGE']).all()
+    # 连接会保持很久，结束事务把数据库连接还给连接池
+    db.session.commit()
+
+    def generate():
+        try:
+            for chunk in order_feed.stream(subscription, backlog):
+                yield chunk
+        finally:
+            subscription.close()
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # nginx 不要缓冲
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@chef.route('/orders/new')
+@login_required
+@read_replica
+def orders_new():
+    """?after=<订单id> 之后的新订单，订单列表页收到推送后取增量，返回表格的行"""
+    after = request.args.get('after', 0, type=int)
+    orders = Order.load_relations(Order.created_after(current_user.id, after)) \
+        .limit(current_app.config['THREEMEAL_MAX_PER_PAGE']).all()
+    return render_template('chef/order_rows.html', orders=reversed(orders), new=True)
+
+
+@chef.route('/orders/handle', methods=['POST'])
+@login_required
+def orders_handle():
+    """选中的未处理订单一次全部发货"""
+    ids = request.form.getlist('ids', type=int)
+    if ids:
+        chef_id = None if current_user.has_role('superuser') else current_user.id
+        count = Order.bulk_transition(ids, 'HANDLED', 'chef', chef_id=chef_id)
+        db.session.commit()
+        flash(u'%d个订单已发货' % count, 'info')
+        if count < len(set(ids)):
+            flash(u'%d个订单不是未处理状态，没有修改' % (len(set(ids)) - count), 'error')
+    return redirect(request.referrer or url_for('chef.orders', order_status='unhandled'))
+
+
+@chef.route('/orders/export.<fmt>')
+@login_required
+@read_replica
+def orders_export(fmt):
+    """导出订单，fmt: csv, jsonl"""
+    return export_response(fmt, chef_id=current_user.id)
 
 
 @chef.route('/order/<int:id>/detail', methods=['GET', 'POST'])
@@ -157,10 +250,36 @@ def order_edit(id):
     if not (order.chef_id == current_user.id or current_user.has_role('superuser')):
         flash(u'你没有权限查看这个订单', category='error')
         return abort(403)
-    form = ChefOrderEditForm()
+    form = ChefOrderEditForm(order.status)
     if form.validate_on_submit():
-        order.status = form.status.data
+        if form.status.data != order.status:
+            try:
+                order.transition(form.status.data, 'chef')
+            except InvalidTransition:
+                db.session.rollback()
+                flash(u'订单状态已经被修改，请刷新后重试', category='error')
+                return redirect(url_for('chef.order_edit', id=id))
         order.remark = form.remark.data
+        db.session.commit()
+        form = ChefOrderEditForm(order.status, formdata=None)
     form.status.data = order.status
     form.remark.data = order.remark
     return render_template('chef/order_edit.html', order=order, form=form)
+
+
+@chef.route('/notifications', methods=['GET', 'POST'])
+@login_required
+def notify_settings():
+    """订单通知：短信号码，是否合并成摘要"""
+    user = User.query.get_or_404(current_user.id)
+    form = NotifySettingsForm()
+    if form.validate_on_submit():
+        user.phone = form.phone.data or None
+        user.notify_digest = form.notify_digest.data
+        db.session.commit()
+        user_cache.invalidate(user.id)
+        flash(u'通知设置已保存', 'info')
+        return redirect(url_for('chef.notify_settings'))
+    form.phone.data = user.phone
+    form.notify_digest.data = user.notify_digest
+    return render_template('chef/notify_settings.html', form=form)
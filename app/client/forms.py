@@ -1,7 +1,8 @@
 # -*- coding:utf-8 -*-
 from flask_wtf import Form
-from wtforms import StringField, TextAreaField, SelectField
+from wtforms import StringField, TextAreaField, SelectField, HiddenField
 from wtforms.validators import DataRequired, Length
+from ..models import Order
 
 class ZipcodeForm(Form):
     zipcode = StringField('zipcode',
@@ -29,12 +30,20 @@ class ClientOrderForm(Form):
                                     Length(5,20)])
     message = TextAreaField('Message',
                             validators=[Length(0, 256, message=u'不能超过256个字符')])
+    # 每次打开下单页面生成一个，重复提交同一个表单只会创建一个订单
+    idempotency_key = HiddenField(validators=[Length(0, 64)])
 
 
 class ClientOrderEditForm(ClientOrderForm):
     status = SelectField('Status', coerce=unicode, validators=[DataRequired()])
 
-    def __init__(self, *args, **kwargs):
+    ACTIONS = {'COMPLETED': u'完成', 'CANCELED': u'取消订单'}
+
+    def __init__(self, status, *args, **kwargs):
+        """
+        :param status: 订单当前的状态，可选的状态由 Order.TRANSITIONS 决定
+        """
         super(ClientOrderEditForm, self).__init__(*args, **kwargs)
-        self.status.choices = [('COMPLETED', u'完成'), ('CANCELED', u'取消订单')]
+        self.status.choices = [(status, Order.STATUS_LABELS[status])] + \
+            [(target, self.ACTIONS[target]) for target in Order.next_statuses(status, 'client')]
 
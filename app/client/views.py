@@ -1,12 +1,16 @@
 # -*- coding:utf-8 -*-
 import datetime
-from flask import render_template, session, redirect, url_for, flash, abort, request
+from flask import render_template, session, redirect, url_for, flash, abort, request, jsonify, \
+    current_app
 from flask_login import login_required, current_user
 from . import client
 from .forms import ClientOrderForm, MenuForm, ClientOrderEditForm, ZipcodeForm
-from .. import db
-from ..util import flash_errors
-from ..models import Order, Meal, MealZipcode, Zipcode
+from .. import db, menu_cache, zipcode_index, meal_search, http_cache
+from ..decorators import read_replica, read_primary
+from ..util import flash_errors, keyset_paginate
+from ..models import Order, Meal, Zipcode
+from ..exceptions import OrderError, SoldOut, InvalidTransition
+from ..ordering import place_order, deliverable_zip_id
 
 
 @client.route('/', methods=['GET', 'POST'])
@@ -25,34 +29,37 @@ def index():
 
 
 @client.route('/meal/<int:id>', methods=['GET', 'POST'])
+@http_cache.cached()
 def meal_detail(id):
     """meal详情"""
     meal = Meal.query.get_or_404(id)
     form = ClientOrderForm()
     client_zip = session.get('client_zipcode', '')
     show_modal = False
-    for zipcode in meal.zipcodes:
-        if zipcode.zipcode == client_zip:
-            zipcode = zipcode
-            break
-    else:
-        flash(u'该产品不支持您所在的区域', category='error')
-        return redirect('/')
+    # 提交的订单在place_order里检查配送区域
     if form.validate_on_submit():
-        order = Order(meal_id=meal.id,
-                      zipcode=zipcode,
-                      client_id=current_user.id,
-                      chef_id=meal.chef_id,
-                      address=form.address.data,
-                      phone=form.phone.data,
-                      message=form.message.data,
-                      status='UNHANDLED')
-        db.session.add(order)
-        db.session.commit()
-        flash(u"下单成功", "info")
+        try:
+            order, created = place_order(meal, client_zip, current_user.id,
+                                         address=form.address.data,
+                                         phone=form.phone.data,
+                                         message=form.message.data,
+                                         idempotency_key=form.idempotency_key.data)
+        except SoldOut:
+            flash(u'今天已经卖完了', category='error')
+            return redirect(url_for('client.meal_detail', id=meal.id))
+        except OrderError:
+            flash(u'该产品不支持您所在的区域', category='error')
+            return redirect('/')
+        if created:
+            flash(u"下单成功", "info")
         return redirect(url_for('client.order_detail', id=order.id))
-    elif request.method == 'POST':
+    if deliverable_zip_id(meal.id, client_zip) is None:
+        flash(u'该产品不支持您所在的区域', category='error')
+        return redirect('/')
+    if request.method == 'POST':
         show_modal = True
+    if not form.idempotency_key.data:
+        form.idempotency_key.data = http_cache.placeholder('uuid')
     return render_template('client/meal_detail.html', meal=meal, form=form, show_modal=show_modal)
 
 
@@ -62,28 +69,66 @@ def bechef():
 
 
 @client.route('/menu/<zipcode>', methods=['GET', 'POST'])
+@http_cache.cached()
+@read_replica
 def menu(zipcode):
     zipcode2 = request.args.get('zipcode')
     if zipcode2 is not None and zipcode2 != zipcode:
         return redirect(url_for('client.menu', zipcode=zipcode2))
     if Zipcode.is_valid(zipcode):
-        zipcode = Zipcode.query.filter_by(zipcode=zipcode).first()
-        if zipcode is None:
-            return redirect(url_for('client.bechef'))
-        session['client_zipcode'] = zipcode.zipcode
         now = datetime.datetime.now().date()
-        meals = Meal.query\
-            .filter(Meal.is_selected==True)\
-            .filter(Meal.id==MealZipcode.meal_id)\
-            .filter(MealZipcode.zipcode_id==zipcode.id)\
-            .filter(MealZipcode.begin_date<=now)\
-            .filter(MealZipcode.end_date>=now)
-        return render_template('client/menu.html', meals=meals, zipcode=zipcode.zipcode)
+        meals = menu_cache.get(zipcode, now,
+                               lambda: read_primary(Meal.load_menu)(
+                                   zipcode, now, zipcode_index.nearby(zipcode)))
+        if meals is None:
+            return redirect(url_for('client.bechef'))
+        if session.get('client_zipcode') != zipcode:
+            session['client_zipcode'] = zipcode
+        return render_template('client/menu.html', meals=meals, zipcode=zipcode)
     else:
         flash('invaid zipcode')
         return redirect('/')
 
 
+def search_zipcodes(zipcode):
+    """
+    :return: zipcode和附近的zipcode，用来过滤搜索结果；没有zipcode时返回None，不过滤
+    """
+    if not zipcode:
+        return None
+    return [code for code, distance in zipcode_index.nearby(zipcode)] or [zipcode]
+
+
+@client.route('/search')
+@http_cache.cached()
+@read_replica
+def search():
+    """搜索今天配送到客户zipcode附近、被推荐的meal，按相关度排序"""
+    q = request.args.get('q', '').strip()
+    zipcode = request.args.get('zipcode') or session.get('client_zipcode')
+    meals = []
+    if q:
+        meals = meal_search.search(q, zipcodes=search_zipcodes(zipcode),
+                                   begin=datetime.date.today(), selected=True,
+                                   limit=current_app.config['THREEMEAL_PER_PAGE'])
+    return render_template('client/search.html', meals=meals, q=q, zipcode=zipcode)
+
+
+@client.route('/search/suggest')
+@read_replica
+def search_suggest():
+    """搜索框的输入提示，返回 {"meals": [{"id", "name", "url"}]}"""
+    zipcode = request.args.get('zipcode') or session.get('client_zipcode')
+    meals = meal_search.search_ids(request.args.get('q', ''), zipcodes=search_zipcodes(zipcode),
+                                   begin=datetime.date.today(), selected=True,
+                                   limit=current_app.config['SEARCH_SUGGEST_LIMIT'])
+    names = dict(db.session.query(Meal.id, Meal.name)
+                 .filter(Meal.id.in_([id for id, score in meals]))) if meals else {}
+    return jsonify(meals=[{'id': id, 'name': names[id],
+                           'url': url_for('client.meal_detail', id=id)}
+                          for id, score in meals if id in names])
+
+
 # @client.route('/order_meal/<int:id>', methods=['GET', 'POST'])
 # def order_meal(id):
 #     meal = Meal.query.get_or_404(id)
@@ -124,8 +169,10 @@ def order_detail(id):
 
 @client.route('/orders')
 @login_required
+@read_replica
 def orders():
-    orders = Order.query.filter_by(client_id=current_user.id).order_by(Order.id.desc())
+    orders = keyset_paginate(Order.load_relations(Order.query.filter_by(client_id=current_user.id)),
+                             Order.id)
     return render_template('client/orders.html', orders=orders)
 
 
@@ -136,20 +183,23 @@ def order_edit(id):
     if not (order.client_id == current_user.id or current_user.has_role('superuser')):
         flash(u'你没有权限编辑这个订单', category='error')
         return abort(403)
-    form = ClientOrderEditForm()
+    form = ClientOrderEditForm(order.status)
     if form.validate_on_submit():
-        if order.status == 'HANDLED' and form.status.data == 'CANCELED':
-            flash(u'已经发货的订单不能取消')
-            return redirect(url_for('client.order_edit', id=id))
-        elif order.status == 'HANDLED' and form.status.data == 'COMPLETED':
-            order.status = form.status.data
         if order.status == 'UNHANDLED':
             order.address = form.address.data
             order.phone = form.phone.data
             order.message = form.message.data
+        if form.status.data != order.status:
+            try:
+                order.transition(form.status.data, 'client')
+            except InvalidTransition:
+                db.session.rollback()
+                flash(u'订单状态已经被修改，请刷新后重试', category='error')
+                return redirect(url_for('client.order_detail', id=id))
+        db.session.commit()
         return redirect(url_for('client.order_detail', id=id))
     form.address.data = order.address
     form.phone.data = order.phone
     form.message.data = order.message
-    #form.status.data = order.status
+    form.status.data = order.status
     return render_template('client/order_edit.html', form=form, order=order)
@@ -0,0 +1,155 @@
+# -*- coding:utf-8 -*-
+"""
+数据库引擎配置和只读副本
+
+Database 在 Flask-SQLAlchemy 的基础上按数据库类型配置引擎：
+
+- postgres/mysql: 连接池大小、溢出、等待和回收时间用 Flask-SQLAlchemy 自己的
+  SQLALCHEMY_POOL_SIZE/SQLALCHEMY_MAX_OVERFLOW/SQLALCHEMY_POOL_TIMEOUT/SQLALCHEMY_POOL_RECYCLE；
+  SQLALCHEMY_POOL_PRE_PING 时每次从池里取出连接先执行 SELECT 1，数据库重启或者连接被
+  防火墙断开后自动重连；SQLALCHEMY_STATEMENT_TIMEOUT（毫秒）限制单条语句的执行时间
+  （postgres 的 statement_timeout，mysql 5.7.8+ 的 max_execution_time，只对SELECT有效）
+- sqlite: 不使用连接池参数；SQLALCHEMY_SQLITE_WAL 时使用WAL日志，读写互不阻塞，适合单机部署；
+  SQLALCHEMY_SQLITE_BUSY_TIMEOUT（毫秒）内等待其他连接释放写锁，而不是立即报 database is locked
+
+配置了 SQLALCHEMY_REPLICA_URI 时，用 decorators.read_replica 装饰的视图（菜单和列表页）里的查询发到只读副本，
+flush、INSERT/UPDATE/DELETE 和 SELECT ... FOR UPDATE 仍然发到主库。一个请求写过主库后，
+SQLALCHEMY_REPLICA_STICKY 秒内同一个session（浏览器）的请求都读主库，避免副本延迟导致看不到刚提交的数据。
+要缓存的结果（比如每日菜单）用 decorators.read_primary 从主库读取，副本延迟的数据不会被缓存下来。
+"""
+
+import threading
+import time
+import weakref
+
+from flask import g, session, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, select
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_BIND = 'replica'
+
+
+class RoutingSession(SignallingSession):
+    """read_replica 视图里的读查询使用只读副本"""
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = SignallingSession.get_bind(self, mapper, clause)
+        if bind is not self.bind or not has_request_context():
+            return bind
+        if self._flushing or isinstance(clause, UpdateBase) or \
+                getattr(clause, '_for_update_arg', None) is not None:
+            g.db_written = True
+            return bind
+        if g.get('db_replica') and self.app.config['SQLALCHEMY_REPLICA_URI']:
+            return self.db.get_engine(self.app, REPLICA_BIND)
+        return bind
+
+
+def _ping(connection, branch):
+    """SQLAlchemy 1.0 没有 pool_pre_ping，按文档里的做法在取出连接时检查"""
+    if branch:
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as e:
+        # 连接已经失效时 SQLAlchemy 会作废整个池，再试一次就是新连接
+        if e.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+class Database(SQLAlchemy):
+    """按 SQLALCHEMY_* 配置引擎，支持只读副本"""
+
+    def __init__(self, *args, **kwargs):
+        SQLAlchemy.__init__(self, *args, **kwargs)
+        self._configured = weakref.WeakSet()
+        self._configure_lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_POOL_PRE_PING', False)
+        app.config.setdefault('SQLALCHEMY_STATEMENT_TIMEOUT', None)
+        app.config.setdefault('SQLALCHEMY_SQLITE_WAL', False)
+        app.config.setdefault('SQLALCHEMY_SQLITE_BUSY_TIMEOUT', 5000)
+        app.config.setdefault('SQLALCHEMY_REPLICA_URI', None)
+        app.config.setdefault('SQLALCHEMY_REPLICA_STICKY', 5)
+        replica = app.config['SQLALCHEMY_REPLICA_URI']
+        if replica:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds[REPLICA_BIND] = replica
+            app.config['SQLALCHEMY_BINDS'] = binds
+        SQLAlchemy.init_app(self, app)
+
+        @app.before_request
+        def use_primary():
+            # 测试和 manage.py bench 里多个请求共用一个app context，g不会自动清空
+            g.db_replica = False
+            g.db_written = False
+
+        @app.after_request
+        def stick_to_primary(response):
+            if replica and g.get('db_written'):
+                session['db_primary_until'] = time.time() + \
+                    app.config['SQLALCHEMY_REPLICA_STICKY']
+            return response
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        config = app.config
+        timeout = config['SQLALCHEMY_STATEMENT_TIMEOUT']
+        if info.drivername == 'sqlite':
+            # 文件数据库用 NullPool，内存数据库用 SingletonThreadPool，都不接受这些参数
+            for key in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(key, None)
+        elif info.drivername.startswith('postgresql') and timeout:
+            options.setdefault('connect_args', {})['options'] = \
+                '-c statement_timeout=%d' % timeout
+        elif info.drivername.startswith('mysql') and timeout:
+            options.setdefault('connect_args', {})['init_command'] = \
+                'SET SESSION max_execution_time=%d' % timeout
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+    def get_engine(self, app, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        if engine not in self._configured:
+            with self._configure_lock:
+                if engine not in self._configured:
+                    self.configure_engine(app, engine)
+                    self._configured.add(engine)
+        return engine
+
+    def configure_engine(self, app, engine):
+        """
+        注册引擎事件，每个引擎只调用一次
+        :param engine: 新创建的引擎
+        """
+        config = app.config
+        if engine.dialect.name == 'sqlite':
+            memory = engine.url.database in (None, '', ':memory:')
+            wal = config['SQLALCHEMY_SQLITE_WAL'] and not memory
+            busy_timeout = config['SQLALCHEMY_SQLITE_BUSY_TIMEOUT']
+
+            @event.listens_for(engine, 'connect')
+            def sqlite_pragmas(dbapi_connection, connection_record):
+                cursor = dbapi_connection.cursor()
+                if wal:
+                    cursor.execute('PRAGMA journal_mode=WAL')
+                    # WAL模式下NORMAL不会损坏数据库，只是断电时可能丢失最后的事务
+                    cursor.execute('PRAGMA synchronous=NORMAL')
+                if busy_timeout:
+                    cursor.execute('PRAGMA busy_timeout=%d' % busy_timeout)
+                cursor.close()
+        elif config['SQLALCHEMY_POOL_PRE_PING']:
+            event.listen(engine, 'engine_connect', _ping)
@@ -1,5 +1,6 @@
+import time
 from functools import wraps
-from flask import abort
+from flask import abort, g, session
 from flask_login import current_user
 
 
@@ -17,3 +18,27 @@ def role_required(role):
 
 def superuser_required(f):
     return role_required('superuser')(f)
+
+
+def read_replica(f):
+    """Send the view's read queries to SQLALCHEMY_REPLICA_URI, see app/database.py"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get('db_primary_until', 0) < time.time():
+            g.db_replica = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def read_primary(f):
+    """Run f's queries on the primary even inside a read_replica view,
+    for results that get cached (a lagging replica would be cached as well)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        replica = g.get('db_replica', False)
+        g.db_replica = False
+        try:
+            return f(*args, **kwargs)
+        finally:
+            g.db_replica = replica
+    return decorated_function
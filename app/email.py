@@ -1,22 +1,291 @@
 # -*- coding:utf-8 -*-
+"""
+邮件发送
+
+send_email 把邮件写进 mail_outbox 表，再交给后台的 MailWorkerPool 发送。
+线程数固定（MAIL_WORKERS），每个线程保持一个 Flask-Mail 的 SMTP 连接并重复使用，
+每次从队列取一批（MAIL_BATCH_SIZE）邮件发送。发送失败的邮件按指数退避重试，
+超过 MAIL_MAX_ATTEMPTS 次标记为 failed。轮询线程定期把到期的邮件放回队列，
+所以进程重启前没发完的邮件也会被发送。
+
+send_email 和 send_emails 不提交事务：邮件和调用方的数据写在同一个事务里，由调用方提交，
+提交后才通知发送线程，回滚时邮件也一起丢弃。
+"""
+
+import atexit
+import datetime
+import logging
+import smtplib
+import socket
+import threading
+import time
+import uuid
+from Queue import Queue, Full, Empty
 
-from threading import Thread
 from flask import current_app, render_template
 from flask_mail import Message
-from . import mail
+from sqlalchemy import event
+from . import db, mail
+from .database import RoutingSession
+from .models import MailOutbox
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'mail_outbox_pending'
+READY = 'mail_outbox_ready'
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+def _outbox(app, to, subject, template, **kwargs):
+    return MailOutbox(sender=app.config['MAIL_SENDER'],
+                      recipient=to,
+                      subject=app.config['MAIL_SUBJECT_PREFIX'] + ' ' + subject,
+                      body=render_template(template + '.txt', **kwargs),
+                      html=render_template(template + '.html', **kwargs))
 
 
 def send_email(to, subject, template, **kwargs):
+    """
+    写入一封邮件，不提交事务，调用方提交后由发送线程发送
+    :param to: 收件人
+    :param template: 模板名，不带扩展名，.txt 和 .html 各渲染一份
+    :return: MailOutbox，flush之后才有id
+    """
+    return send_emails([(to, subject, template, kwargs)])[0]
+
+
+def send_emails(messages):
+    """
+    一次写入多封邮件，不提交事务，见 send_email
+    :param messages: [(to, subject, template, kwargs)]
+    :return: MailOutbox列表
+    """
     app = current_app._get_current_object()
-    msg = Message(app.config['MAIL_SUBJECT_PREFIX'] + ' ' + subject,
-                  sender=app.config['MAIL_SENDER'], recipients=[to])
-    msg.body = render_template(template + '.txt', **kwargs)
-    msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+    outboxes = [_outbox(app, to, subject, template, **kwargs)
+                for to, subject, template, kwargs in messages]
+    if not outboxes:
+        return outboxes
+    db.session.add_all(outboxes)
+    mail_workers.start(app)
+    mail_workers.stage(db.session, outboxes)
+    return outboxes
+
+
+def claim_mails(ids, worker_id):
+    """
+    把待发送的邮件标记为发送中，多个线程、进程同时领取时每封邮件只会被领取一次
+    :param ids: outbox id列表
+    :param worker_id: 领取者
+    :return: 领取到的MailOutbox列表
+    """
+    now = datetime.datetime.now()
+    MailOutbox.query \
+        .filter(MailOutbox.id.in_(ids)) \
+        .filter(MailOutbox.status == 'pending') \
+        .filter(MailOutbox.next_attempt_at <= now) \
+        .update({'status': 'sending', 'claimed_by': worker_id, 'claimed_at': now},
+                synchronize_session=False)
+    db.session.commit()
+    return MailOutbox.query.filter_by(claimed_by=worker_id, status='sending').all()
+
+
+def due_mail_ids(limit):
+    """
+    到期需要发送的邮件，同时把领取后超时（MAIL_CLAIM_TIMEOUT）没有结果的邮件放回待发送
+    :param limit: 最多返回多少封
+    :return: outbox id列表
+    """
+    now = datetime.datetime.now()
+    stale = now - datetime.timedelta(seconds=current_app.config['MAIL_CLAIM_TIMEOUT'])
+    MailOutbox.query \
+        .filter(MailOutbox.status == 'sending') \
+        .filter(MailOutbox.claimed_at < stale) \
+        .update({'status': 'pending', 'claimed_by': None}, synchronize_session=False)
+    db.session.commit()
+    rows = db.session.query(MailOutbox.id) \
+        .filter(MailOutbox.status == 'pending') \
+        .filter(MailOutbox.next_attempt_at <= now) \
+        .order_by(MailOutbox.next_attempt_at) \
+        .limit(limit)
+    return [id for id, in rows]
+
+
+def _message(outbox):
+    return Message(outbox.subject, sender=outbox.sender, recipients=[outbox.recipient],
+                   body=outbox.body, html=outbox.html)
+
+
+def _mark_failed(outbox, error):
+    config = current_app.config
+    outbox.attempts = (outbox.attempts or 0) + 1
+    outbox.last_error = str(error)[:512]
+    outbox.claimed_by = None
+    if outbox.attempts >= config['MAIL_MAX_ATTEMPTS']:
+        outbox.status = 'failed'
+    else:
+        delay = config['MAIL_RETRY_DELAY'] * 2 ** (outbox.attempts - 1)
+        outbox.status = 'pending'
+        outbox.next_attempt_at = datetime.datetime.now() + datetime.timedelta(seconds=delay)
+
+
+def _open(connection):
+    if connection is None:
+        connection = mail.connect()
+        connection.__enter__()
+    return connection
+
+
+def _close(connection):
+    if connection is not None:
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, socket.error):
+            pass
+    return None
+
+
+def send_batch(outboxes, connection=None):
+    """
+    用同一个SMTP连接发送一批邮件，不提交事务
+    :param outboxes: 已领取的MailOutbox列表
+    :param connection: 已经打开的Flask-Mail连接，None时新建
+    :return: 还可以继续使用的连接，出错时为None
+    """
+    for outbox in outboxes:
+        try:
+            connection = _open(connection)
+            connection.send(_message(outbox))
+        except (smtplib.SMTPException, socket.error) as e:
+            logger.warning('send mail %s to %s failed: %s', outbox.id, outbox.recipient, e)
+            _mark_failed(outbox, e)
+            connection = _close(connection)
+        else:
+            outbox.status = 'sent'
+            outbox.sent_date = datetime.datetime.now()
+            outbox.claimed_by = None
+    return connection
+
+
+class MailWorkerPool(object):
+    """固定数量的发送线程加一个轮询线程"""
+
+    def __init__(self):
+        self.app = None
+        self.queue = None
+        self.threads = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._listening = False
+
+    def start(self, app):
+        with self._lock:
+            if not self._listening:
+                self._listening = True
+                event.listen(RoutingSession, 'after_flush_postexec', self._after_flush)
+                event.listen(RoutingSession, 'after_commit', self._after_commit)
+                event.listen(RoutingSession, 'after_rollback', self._after_rollback)
+            if self.threads:
+                return
+            self.app = app
+            self.queue = Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+            self._stopped.clear()
+            for i in range(app.config['MAIL_WORKERS']):
+                self._spawn(self._work)
+            self._spawn(self._poll)
+            atexit.register(self.stop, 5)
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def stage(self, session, outboxes):
+        """
+        登记新写入的邮件，session提交后放进队列
+        :param outboxes: MailOutbox列表，flush之后才有id，所以到flush之后再读取
+        """
+        session.info.setdefault(PENDING, []).extend(outboxes)
+
+    def _after_flush(self, session, flush_context):
+        pending = session.info.pop(PENDING, None)
+        if pending:
+            session.info.setdefault(READY, []).extend(
+                outbox.id for outbox in pending if outbox.id is not None)
+
+    def _after_commit(self, session):
+        ready = session.info.pop(READY, None)
+        session.info.pop(PENDING, None)
+        if ready and self.queue is not None:
+            for outbox_id in ready:
+                self.notify(outbox_id)
+
+    def _after_rollback(self, session):
+        session.info.pop(PENDING, None)
+        session.info.pop(READY, None)
+
+    def notify(self, outbox_id):
+        try:
+            self.queue.put_nowait(outbox_id)
+        except Full:
+            # 队列满了，邮件留在数据库里由轮询线程稍后取出
+            pass
+
+    def _spawn(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def _take_batch(self):
+        try:
+            ids = [self.queue.get(timeout=1)]
+        except Empty:
+            return []
+        while len(ids) < self.app.config['MAIL_BATCH_SIZE']:
+            try:
+                ids.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return ids
+
+    def _work(self):
+        worker_id = uuid.uuid4().hex
+        connection = None
+        last_used = time.time()
+        with self.app.app_context():
+            while not self._stopped.is_set():
+                ids = self._take_batch()
+                if not ids:
+                    # 空闲太久的连接会被SMTP服务器断开，主动关闭
+                    if time.time() - last_used > self.app.config['MAIL_CONNECTION_IDLE']:
+                        connection = _close(connection)
+                    continue
+                try:
+                    outboxes = claim_mails(ids, worker_id)
+                    if outboxes:
+                        connection = send_batch(outboxes, connection)
+                        db.session.commit()
+                        last_used = time.time()
+                except Exception:
+                    logger.exception('mail worker failed')
+                    db.session.rollback()
+                    connection = _close(connection)
+                finally:
+                    db.session.remove()
+            _close(connection)
+
+    def _poll(self):
+        with self.app.app_context():
+            while not self._stopped.is_set():
+                try:
+                    for outbox_id in due_mail_ids(self.app.config['MAIL_QUEUE_SIZE']):
+                        self.notify(outbox_id)
+                except Exception:
+                    logger.exception('mail poller failed')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+                self._stopped.wait(self.app.config['MAIL_POLL_INTERVAL'])
+
+
+mail_workers = MailWorkerPool()
@@ -0,0 +1,25 @@
+# -*- coding:utf-8 -*-
+
+
+class ValidationError(ValueError):
+    pass
+
+
+class OrderError(ValidationError):
+    pass
+
+
+class NotDeliverable(OrderError):
+    pass
+
+
+class SoldOut(OrderError):
+    pass
+
+
+class IdempotencyKeyReused(OrderError):
+    pass
+
+
+class InvalidTransition(OrderError):
+    pass
@@ -0,0 +1,151 @@
+# -*- coding:utf-8 -*-
+"""
+订单导出
+
+meal名字、客户信息在同一条查询里join出来，结果通过服务端游标（stream_results）和
+yield_per分批读取，导出几百万行时内存占用保持不变。
+"""
+
+import csv
+import datetime
+import json
+from cStringIO import StringIO
+
+from flask import Response, request, stream_with_context, abort
+from sqlalchemy.orm import aliased
+
+from . import db
+from .models import Order, Meal, User, Zipcode
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def parse_date(value):
+    """
+    :param value: YYYY-MM-DD字符串
+    :return: datetime.date，value为空时返回None
+    """
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def order_export_query(chef_id=None, zipcode=None, status=None, begin=None, end=None):
+    """
+    导出订单的查询，按id排序
+    :param chef_id: 大厨id
+    :param zipcode: zipcode字符串
+    :param status: 订单状态
+    :param begin: 下单日期的开始（包含）
+    :param end: 下单日期的结束（包含）
+    :return: 列查询，每行的字段见columns
+    """
+    client = aliased(User)
+    query = db.session.query(
+        Order.id, Order.create_date, Order.update_date, Order.status,
+        Order.meal_id, Meal.name.label('meal_name'),
+        Zipcode.zipcode,
+        Order.client_id, client.nickname.label('client_nickname'),
+        client.email.label('client_email'),
+        Order.chef_id, Order.address, Order.phone, Order.message, Order.remark) \
+        .outerjoin(Meal, Meal.id == Order.meal_id) \
+        .outerjoin(Zipcode, Zipcode.id == Order.zip_id) \
+        .outerjoin(client, client.id == Order.client_id)
+    if chef_id is not None:
+        query = query.filter(Order.chef_id == chef_id)
+    if zipcode:
+        query = query.filter(Zipcode.zipcode == zipcode)
+    if status:
+        query = query.filter(Order.status == status)
+    if begin:
+        query = query.filter(Order.create_date >= begin)
+    if end:
+        query = query.filter(Order.create_date < end + datetime.timedelta(days=1))
+    return query.order_by(Order.id)
+
+
+def columns(query):
+    return [description['name'] for description in query.column_descriptions]
+
+
+def iter_rows(query, batch_size=1000):
+    return query.execution_options(stream_results=True).yield_per(batch_size)
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _json_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def export_csv(query, batch_size=1000):
+    """逐行生成utf-8编码的csv，第一行是表头"""
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns(query))
+    for i, row in enumerate(iter_rows(query, batch_size), 1):
+        writer.writerow([_text(value) for value in row])
+        if i % 100 == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def export_jsonl(query, batch_size=1000):
+    """每行一个json对象"""
+    names = columns(query)
+    for row in iter_rows(query, batch_size):
+        yield json.dumps(dict(zip(names, [_json_value(value) for value in row])),
+                         ensure_ascii=False, sort_keys=True).encode('utf-8') + '\n'
+
+
+def export_orders(fmt, **filters):
+    """
+    :param fmt: csv或者jsonl
+    :param filters: order_export_query的参数
+    :return: 生成导出内容的generator
+    """
+    query = order_export_query(**filters)
+    if fmt == 'csv':
+        return export_csv(query)
+    return export_jsonl(query)
+
+
+def export_response(fmt, chef_id=None):
+    """
+    流式返回导出文件，过滤条件从request.args读取：zipcode、status、begin、end
+    :param fmt: csv或者jsonl
+    :param chef_id: 大厨id，None表示所有大厨
+    :return: response
+    """
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    status = request.args.get('status')
+    if status:
+        status = status.upper()
+        if status not in Order.status.type.enums:
+            abort(400)
+    try:
+        begin = parse_date(request.args.get('begin'))
+        end = parse_date(request.args.get('end'))
+    except ValueError:
+        abort(400)
+    rows = export_orders(fmt, chef_id=chef_id, zipcode=request.args.get('zipcode'),
+                         status=status, begin=begin, end=end)
+    response = Response(stream_with_context(rows), mimetype=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = 'attachment; filename=orders.%s' % fmt
+    return response
@@ -0,0 +1,258 @@
+# -*- coding:utf-8 -*-
+"""
+大厨订单的推送
+
+大厨的订单页通过 Server-Sent Events（chef.orders_stream）接收自己订单的变化，不再反复刷新整个列表：
+
+- 新订单（ordering.place_order）和状态变化（Order.transition、Order.bulk_transition）调用
+  OrderFeed.stage 登记到当前session上，事务提交后才发布，回滚时丢弃，不会推送没有提交的数据
+- 消息只有订单id、状态和事件类型，发布时不查询数据库；页面收到新订单后用最后看到的订单id
+  请求 chef.orders_new，只取增量的几行
+- 断线重连时浏览器带上 Last-Event-ID（最后一个新订单的id），推送先补发这之后的新订单
+- 发布的同时发送 orders_committed 信号，订单通知（notify.py）据此发送邮件和短信
+
+消息由 broker 分发，ORDER_FEED_BROKER 选择：
+- local（默认）：进程内，每个连接一个有界队列，只适合单进程部署
+- redis：Redis 的 PUBLISH/SUBSCRIBE，多进程、多台机器都能收到，地址是 ORDER_FEED_REDIS_URL，
+  需要安装 redis 包
+也可以直接配置一个实现了 publish/subscribe 的对象。
+
+每个推送连接在服务器上占用一个线程（或者greenlet），部署时需要使用多线程或者gevent的worker；
+连接最长保持 ORDER_FEED_STREAM_TIMEOUT 秒，之后浏览器会自动重连。
+"""
+
+import json
+import threading
+import time
+from collections import deque
+
+from flask.signals import Namespace
+from sqlalchemy import event
+
+from .database import RoutingSession
+
+PENDING = 'order_feed_pending'
+READY = 'order_feed_ready'
+
+signals = Namespace()
+# 事务提交后发送，events=[(大厨id, 消息)]，订单通知（notify.py）从这里接收
+orders_committed = signals.signal('orders-committed')
+
+
+class Subscription(object):
+    """LocalBroker 的一个订阅，队列满了之后丢弃最早的消息并标记 overflowed"""
+
+    def __init__(self, broker, channel, size):
+        self.broker = broker
+        self.channel = channel
+        self.messages = deque()
+        self.size = size
+        self.overflowed = False
+        self._ready = threading.Condition(threading.Lock())
+
+    def put(self, message):
+        with self._ready:
+            if len(self.messages) >= self.size:
+                self.messages.popleft()
+                self.overflowed = True
+            self.messages.append(message)
+            self._ready.notify()
+
+    def get(self, timeout):
+        """
+        :param timeout: 没有消息时最多等待的秒数
+        :return: 所有已经到达的消息，超时返回空列表
+        """
+        with self._ready:
+            if not self.messages:
+                self._ready.wait(timeout)
+            messages = list(self.messages)
+            self.messages.clear()
+            return messages
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker(object):
+    """进程内的发布/订阅"""
+
+    def __init__(self, config):
+        self.queue_size = config.get('ORDER_FEED_QUEUE_SIZE', 100)
+        self.channels = {}
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscriptions = list(self.channels.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel, self.queue_size)
+        with self._lock:
+            self.channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self.channels.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self.channels[subscription.channel]
+
+    def subscribers(self, channel):
+        with self._lock:
+            return len(self.channels.get(channel, ()))
+
+
+class RedisSubscription(object):
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+        # Redis 的订阅不会丢消息，慢的连接由Redis的client-output-buffer-limit断开
+        self.overflowed = False
+
+    def get(self, timeout):
+        messages = []
+        message = self.pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+        while message is not None:
+            messages.append(json.loads(message['data']))
+            message = self.pubsub.get_message(ignore_subscribe_messages=True)
+        return messages
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisBroker(object):
+    """通过Redis的PUBLISH/SUBSCRIBE在多个进程之间分发"""
+
+    def __init__(self, config):
+        import redis
+        self.redis = redis.StrictRedis.from_url(config['ORDER_FEED_REDIS_URL'])
+        self.prefix = config.get('ORDER_FEED_REDIS_PREFIX', 'threemeal:orders:')
+
+    def publish(self, channel, message):
+        self.redis.publish(self.prefix + str(channel), json.dumps(message))
+
+    def subscribe(self, channel):
+        pubsub = self.redis.pubsub()
+        pubsub.subscribe(self.prefix + str(channel))
+        return RedisSubscription(pubsub)
+
+
+BROKERS = {
+    'local': LocalBroker,
+    'redis': RedisBroker,
+}
+
+
+def sse(data, event=None, id=None):
+    """
+    :return: 一条 text/event-stream 消息
+    """
+    lines = []
+    if id is not None:
+        lines.append('id: %s' % id)
+    if event is not None:
+        lines.append('event: %s' % event)
+    lines.append('data: %s' % json.dumps(data))
+    return '\n'.join(lines) + '\n\n'
+
+
+class OrderFeed(object):
+    """订单变化的发布和订阅，频道是大厨的id"""
+
+    def __init__(self, app=None):
+        self.broker = None
+        self.heartbeat = 15
+        self.stream_timeout = 300
+        self.retry = 3000
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        broker = app.config.get('ORDER_FEED_BROKER') or 'local'
+        if isinstance(broker, basestring):
+            broker = BROKERS[broker](app.config)
+        self.broker = broker
+        self.heartbeat = app.config.get('ORDER_FEED_HEARTBEAT', 15)
+        self.stream_timeout = app.config.get('ORDER_FEED_STREAM_TIMEOUT', 300)
+        self.retry = app.config.get('ORDER_FEED_RETRY', 3000)
+        app.extensions['order_feed'] = self
+        if not self._listening:
+            self._listening = True
+            event.listen(RoutingSession, 'after_flush_postexec', self._after_flush)
+            event.listen(RoutingSession, 'after_commit', self._after_commit)
+            event.listen(RoutingSession, 'after_rollback', self._after_rollback)
+
+    def stage(self, session, order, created=False):
+        """
+        登记一个新建或者改了状态的订单，session提交后发布
+        :param order: Order，新订单在flush之后才有id，所以到flush之后再读取
+        """
+        session.info.setdefault(PENDING, []).append((order, created))
+
+    def stage_status(self, session, chef_id, order_id, status):
+        """
+        登记一个状态已经改变的订单，用于不经过ORM的批量UPDATE
+        """
+        session.info.setdefault(READY, []).append(
+            (chef_id, {'event': 'status', 'id': order_id, 'status': status}))
+
+    def _after_flush(self, session, flush_context):
+        pending = session.info.pop(PENDING, None)
+        if not pending:
+            return
+        ready = session.info.setdefault(READY, [])
+        for order, created in pending:
+            if order.id is not None and order.chef_id is not None:
+                ready.append((order.chef_id, {'event': 'created' if created else 'status',
+                                              'id': order.id,
+                                              'status': order.status}))
+
+    def _after_commit(self, session):
+        ready = session.info.pop(READY, None)
+        session.info.pop(PENDING, None)
+        if not ready:
+            return
+        for chef_id, message in ready:
+            self.broker.publish(chef_id, message)
+        orders_committed.send(self, events=ready)
+
+    def _after_rollback(self, session):
+        session.info.pop(PENDING, None)
+        session.info.pop(READY, None)
+
+    def subscribe(self, chef_id):
+        return self.broker.subscribe(chef_id)
+
+    def stream(self, subscription, backlog=(), clock=None):
+        """
+        text/event-stream 的内容，调用方负责在结束时关闭subscription
+        :param subscription: 在查询backlog之前订阅，补发和推送之间不会漏掉消息
+        :param backlog: 断线期间的新订单 [(id, status)]，按id从小到大
+        :param clock: 返回当前秒数的函数，测试用
+        """
+        clock = clock or time.time
+        deadline = clock() + self.stream_timeout
+        yield 'retry: %d\n\n' % self.retry
+        for order_id, status in backlog:
+            yield sse({'event': 'created', 'id': order_id, 'status': status},
+                      event='created', id=order_id)
+        while clock() < deadline:
+            messages = subscription.get(min(self.heartbeat, max(deadline - clock(), 0)))
+            if subscription.overflowed:
+                # 丢了消息，页面重新加载列表
+                subscription.overflowed = False
+                yield sse({'event': 'reset'}, event='reset')
+                continue
+            if not messages:
+                yield ': keepalive\n\n'
+            for message in messages:
+                if message['event'] == 'created':
+                    yield sse(message, event='created', id=message['id'])
+                else:
+                    yield sse(message, event=message['event'])
@@ -0,0 +1,181 @@
+# -*- coding:utf-8 -*-
+"""
+模板片段缓存
+
+菜单、meal详情和管理员meal列表里每个meal的HTML对所有访问者都一样，用 cache 标签缓存渲染结果：
+
+    {% cache 'menu-item', meal.distance, meal=meal.id %}
+        ...
+    {% endcache %}
+
+第一个参数是片段名，其他位置参数是片段的其他变量（比如距离），关键字参数是片段依赖的数据：
+meal=<Meal.id>、user=<User.id>。缓存的key包含这些数据的版本号，数据改变后版本号增加，
+旧的片段不会再被命中，由LRU淘汰。片段里不能有和当前用户、请求相关的内容（csrf、登录状态）。
+
+版本号由 SQLAlchemy 的 session 事件维护：flush 时 Meal、MealZipcode（算作它的meal）、User
+有新建、修改或删除，对应的版本号增加；Query.update/delete 批量修改时这个模型的所有片段失效。
+不经过ORM的语句（比如 Meal.update_zipcodes 里的批量INSERT/UPDATE）需要调用 FragmentCache.touch。
+事务提交后版本号再增加一次，提交前其他请求用旧数据渲染的片段也不会被使用。
+
+缓存保存在进程内的 LRUCache（cache.py），总大小不超过 FRAGMENT_CACHE_MAX_BYTES；版本号也只在
+本进程内，多进程部署时其他进程的修改要等片段过期（FRAGMENT_CACHE_TIMEOUT）才能看到。
+命中率在 /admin/profiler 的缓存表和响应头 X-Cache 里。
+"""
+
+import itertools
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from sqlalchemy import event
+
+from .cache import CountingCache, LRUCache
+from .database import RoutingSession
+
+PENDING = 'fragment_cache_pending'
+
+# 模型名: (版本号的名字, 属性)
+WATCHED = {
+    'Meal': ('meal', 'id'),
+    'MealZipcode': ('meal', 'meal_id'),
+    'User': ('user', 'id'),
+}
+
+
+class FragmentCache(CountingCache):
+    """模板片段缓存，按依赖的数据的版本号失效"""
+    name = 'fragment'
+
+    def __init__(self, app=None, backend=None):
+        self.enabled = True
+        self.timeout = 300
+        # {(名字, id): 版本号}，{名字: 版本号} 是批量修改时整个模型的版本号
+        self._versions = {}
+        self._counter = itertools.count(1)
+        # 最新的版本号，任何数据改变后都会增加，HTTP响应缓存（httpcache.py）用作整体的版本
+        self.generation = 0
+        self._listening = False
+        CountingCache.__init__(self, app, backend)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('FRAGMENT_CACHE_ENABLED', True)
+        self.timeout = app.config.get('FRAGMENT_CACHE_TIMEOUT', 300)
+        if self.backend is None:
+            self.backend = LRUCache(max_bytes=app.config.get('FRAGMENT_CACHE_MAX_BYTES',
+                                                             16 * 1024 * 1024),
+                                    default_timeout=self.timeout)
+        app.extensions['fragment_cache'] = self
+        app.jinja_env.add_extension(FragmentCacheExtension)
+        app.jinja_env.fragment_cache = self
+        if not self._listening:
+            self._listening = True
+            event.listen(RoutingSession, 'after_flush', self._after_flush)
+            event.listen(RoutingSession, 'after_commit', self._after_commit)
+            event.listen(RoutingSession, 'after_rollback', self._after_rollback)
+            event.listen(RoutingSession, 'after_bulk_update', self._after_bulk)
+            event.listen(RoutingSession, 'after_bulk_delete', self._after_bulk)
+
+    def stats(self):
+        stats = CountingCache.stats(self)
+        if isinstance(self.backend, LRUCache):
+            stats.update(entries=len(self.backend), bytes=self.backend.bytes,
+                         max_bytes=self.backend.max_bytes, evictions=self.backend.evictions)
+        return stats
+
+    def clear(self):
+        CountingCache.clear(self)
+        self._versions.clear()
+
+    def version(self, kind, id):
+        return self._versions.get((kind, id), 0), self._versions.get(kind, 0)
+
+    def bump(self, keys):
+        """
+        :param keys: (名字, id) 的iterable，id为None时是整个模型
+        """
+        for kind, id in keys:
+            self.generation = self._versions[kind if id is None else (kind, id)] = \
+                next(self._counter)
+
+    def touch(self, session, kind, id):
+        """
+        登记不经过ORM修改的数据，和flush检测到的修改一样在flush和提交后增加版本号
+        :param kind: meal 或者 user
+        """
+        session.info.setdefault(PENDING, set()).add((kind, id))
+        self.bump([(kind, id)])
+
+    def _after_flush(self, session, flush_context):
+        changed = session.info.setdefault(PENDING, set())
+        for instance in itertools.chain(session.new, session.dirty, session.deleted):
+            watched = WATCHED.get(type(instance).__name__)
+            if watched is not None:
+                kind, attribute = watched
+                changed.add((kind, getattr(instance, attribute)))
+        self.bump(changed)
+
+    def _after_commit(self, session):
+        changed = session.info.pop(PENDING, None)
+        if changed:
+            self.bump(changed)
+
+    def _after_rollback(self, session):
+        session.info.pop(PENDING, None)
+
+    def _after_bulk(self, update_context):
+        watched = WATCHED.get(update_context.mapper.class_.__name__)
+        if watched is not None:
+            update_context.session.info.setdefault(PENDING, set()).add((watched[0], None))
+            self.bump([(watched[0], None)])
+
+    def make_key(self, name, parts, depends):
+        """
+        :param parts: 片段的其他变量
+        :param depends: {名字: id}
+        """
+        key = [u'fragment', unicode(name)]
+        key.extend(unicode(part) for part in parts)
+        for kind in sorted(depends):
+            key.append(u'%s:%s@%d.%d' % ((kind, depends[kind]) + self.version(kind, depends[kind])))
+        return u'|'.join(key)
+
+    def get(self, name, parts, depends, render):
+        """
+        :param render: 无参数函数，返回渲染好的HTML
+        :return: Markup
+        """
+        if not self.enabled:
+            return Markup(render())
+        key = self.make_key(name, parts, depends)
+        html = self.backend.get(key)
+        if html is not None:
+            self._incr('hits')
+            return Markup(html)
+        self._incr('misses')
+        html = render()
+        self.backend.set(key, html, timeout=self.timeout)
+        return Markup(html)
+
+
+class FragmentCacheExtension(Extension):
+    """{% cache '名字', 变量..., meal=meal.id %} ... {% endcache %}"""
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        kwargs = []
+        while parser.stream.skip_if('comma'):
+            if parser.stream.current.type == 'name' and parser.stream.look().type == 'assign':
+                key = parser.stream.current.value
+                parser.stream.skip(2)
+                kwargs.append(nodes.Keyword(key, parser.parse_expression()))
+            else:
+                args.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', args, kwargs),
+                               [], [], body).set_lineno(lineno)
+
+    def _render(self, name, *parts, **depends):
+        caller = depends.pop('caller')
+        return self.environment.fragment_cache.get(name, parts, depends, caller)
@@ -0,0 +1,205 @@
+# -*- coding:utf-8 -*-
+"""
+zipcode 的距离
+
+zipcode_centroid 表保存每个zipcode中心点的经纬度，数据来自 app/data/us_zipcodes.csv.gz
+（约4万个美国zipcode），用 python manage.py load_zipcodes 导入。
+
+ZipcodeIndex 在进程内存中把所有中心点按 ZIPCODE_GRID_CELL 度的经纬度网格分桶，第一次使用时从表中
+读取建立。查询某个zipcode半径N英里内的zipcode时只检查半径覆盖的几个网格，不用遍历全部zipcode，
+一次查询在一毫秒以内。client.menu 用它把附近zipcode的meal也列出来（按距离排序），下单时
+客户的zipcode在meal配送的zipcode附近 ZIPCODE_RADIUS 英里内也可以配送。
+
+表是空的（没有导入数据）时索引也是空的，所有查询退回到只匹配zipcode本身。
+导入新数据后web进程需要重启，或者调用 ZipcodeIndex.reload。
+"""
+
+import csv
+import gzip
+import logging
+import math
+import os
+import threading
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+logger = logging.getLogger(__name__)
+
+DATASET = os.path.join(os.path.dirname(__file__), 'data', 'us_zipcodes.csv.gz')
+EARTH_RADIUS = 3958.8  # 英里
+MILES_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    :return: 两点之间的球面距离，英里
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def read_dataset(path=DATASET):
+    """
+    :param path: gzip压缩的csv，#开头的是注释
+    :return: (zipcode, latitude, longitude, city, state) 的iterator
+    """
+    with gzip.open(path, 'rb') as f:
+        for row in csv.DictReader(line for line in f if not line.startswith('#')):
+            yield (row['zipcode'], float(row['latitude']), float(row['longitude']),
+                   row['city'].decode('utf-8'), row['state'])
+
+
+def load_dataset(session, path=DATASET, batch_size=5000):
+    """
+    清空 zipcode_centroid 表后导入数据集，提交事务
+    :return: 导入的行数
+    """
+    from .models import ZipcodeCentroid
+    table = ZipcodeCentroid.__table__
+    session.execute(table.delete())
+    count = 0
+    batch = []
+    for zipcode, latitude, longitude, city, state in read_dataset(path):
+        batch.append({'zipcode': zipcode, 'latitude': latitude, 'longitude': longitude,
+                      'city': city, 'state': state})
+        if len(batch) >= batch_size:
+            session.execute(table.insert(), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        session.execute(table.insert(), batch)
+        count += len(batch)
+    session.commit()
+    return count
+
+
+class ZipcodeIndex(object):
+    """zipcode中心点的网格索引"""
+
+    def __init__(self, app=None):
+        self.radius = 5
+        self.limit = 100
+        self.cell = 0.1
+        self.loaded = False
+        # {zipcode: (lat, lng)}，{(行, 列): [(zipcode, lat, lng)]}
+        self._points = {}
+        self._grid = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.radius = app.config.get('ZIPCODE_RADIUS', 5)
+        self.limit = app.config.get('ZIPCODE_NEARBY_LIMIT', 100)
+        self.cell = app.config.get('ZIPCODE_GRID_CELL', 0.1)
+        app.extensions['zipcode_index'] = self
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._points)
+
+    def _key(self, lat, lng):
+        return int(math.floor(lat / self.cell)), int(math.floor(lng / self.cell))
+
+    def build(self, rows):
+        """
+        :param rows: (zipcode, lat, lng) 的iterable
+        """
+        points = {}
+        grid = {}
+        for zipcode, lat, lng in rows:
+            points[zipcode] = (lat, lng)
+            grid.setdefault(self._key(lat, lng), []).append((zipcode, lat, lng))
+        self._points, self._grid = points, grid
+        self.loaded = True
+
+    def reload(self):
+        """从 zipcode_centroid 表重新建立索引，需要app context"""
+        from . import db
+        from .models import ZipcodeCentroid
+        start = time.time()
+        try:
+            rows = db.session.query(ZipcodeCentroid.zipcode, ZipcodeCentroid.latitude,
+                                    ZipcodeCentroid.longitude).all()
+        except SQLAlchemyError:
+            # 还没有执行数据库迁移
+            logger.warning('zipcode_centroid is not available, nearby search is disabled')
+            db.session.rollback()
+            rows = []
+        self.build(rows)
+        logger.info('zipcode index: %d zipcodes in %.0fms', len(rows), (time.time() - start) * 1000)
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self.reload()
+
+    def location(self, zipcode):
+        """
+        :return: (lat, lng)，不认识的zipcode返回None
+        """
+        self._ensure_loaded()
+        return self._points.get(zipcode)
+
+    def known(self, zipcode):
+        """索引是空的时候认为所有zipcode都存在"""
+        self._ensure_loaded()
+        return not self._points or zipcode in self._points
+
+    def distance(self, zipcode1, zipcode2):
+        """
+        :return: 两个zipcode中心点的距离（英里），有一个不认识时返回None
+        """
+        a, b = self.location(zipcode1), self.location(zipcode2)
+        if a is None or b is None:
+            return None
+        return haversine(a[0], a[1], b[0], b[1])
+
+    def nearby(self, zipcode, radius=None, limit=None):
+        """
+        :param radius: 英里，默认 ZIPCODE_RADIUS
+        :param limit: 最多返回几个，默认 ZIPCODE_NEARBY_LIMIT，0表示不限
+        :return: 半径内的 [(zipcode, 距离)]，按距离从近到远，包括zipcode本身；不认识的zipcode返回[]
+        """
+        radius = self.radius if radius is None else radius
+        limit = self.limit if limit is None else limit
+        center = self.location(zipcode)
+        if center is None:
+            return []
+        if not radius:
+            return [(zipcode, 0.0)]
+        lat, lng = center
+        # 半径很小，按平面计算：经度一度的长度乘以cos(纬度)
+        scale = max(math.cos(math.radians(lat)), 0.01)
+        dlat = radius / MILES_PER_DEGREE
+        dlng = dlat / scale
+        row_low, col_low = self._key(lat - dlat, lng - dlng)
+        row_high, col_high = self._key(lat + dlat, lng + dlng)
+        limit_sq = dlat * dlat
+        grid = self._grid
+        found = []
+        for row in xrange(row_low, row_high + 1):
+            for col in xrange(col_low, col_high + 1):
+                for code, lat2, lng2 in grid.get((row, col), ()):
+                    y = lat2 - lat
+                    x = (lng2 - lng) * scale
+                    d_sq = x * x + y * y
+                    if d_sq <= limit_sq:
+                        found.append((d_sq, code))
+        found.sort()
+        if limit:
+            found = found[:limit]
+        return [(code, math.sqrt(distance_sq) * MILES_PER_DEGREE) for distance_sq, code in found]
+
+    def expand(self, zipcodes, radius=None):
+        """
+        :return: zipcodes 和它们半径内的所有zipcode，附近的meal改变时用来删除菜单缓存
+        """
+        result = set(zipcodes)
+        for zipcode in list(result):
+            result.update(code for code, distance in self.nearby(zipcode, radius, limit=0))
+        return result
@@ -0,0 +1,325 @@
+# -*- coding:utf-8 -*-
+"""
+HTTP响应缓存和压缩
+
+共享缓存：@http_cache.cached() 装饰的页面（菜单、meal详情、搜索）对未登录的访问者都一样，
+整个响应缓存在进程内的 LRUCache 里（HTTP_CACHE_MAX_BYTES，HTTP_CACHE_TIMEOUT 秒）。
+key 包括完整路径、session 里的 client_zipcode（决定菜单和能否下单）、响应 Vary 头列出的
+请求头，以及模板片段缓存（fragments.py）的最新版本号，任何 Meal、MealZipcode、User 修改后
+所有缓存的页面都失效。只缓存没有修改 session 的200响应（Set-Cookie 不保存），
+已登录、有flash消息的请求不使用缓存，Vary: * 的响应不缓存。
+
+每个访问者不同的内容（csrf_token()、下单表单的 idempotency_key）在GET请求里渲染成占位符，
+缓存之后、发送之前才替换成真实的值，所以缓存的页面可以给所有人使用。
+
+ETag：GET请求的200响应没有ETag时加上响应内容的md5，If-None-Match 匹配时返回304。
+HTML页面的ETag按替换之前的内容计算，加上 session 的 csrf_token 和时间段（csrf令牌有效期的一半），
+浏览器重新验证时令牌不会过期；有 idempotency_key 的页面不加ETag。
+
+压缩：HTML、CSS、JS、JSON 等超过 COMPRESS_MIN_SIZE 字节时按 Accept-Encoding 使用 br（安装了
+brotli 包时）或者 gzip，ETag 变成弱ETag，加上 Vary: Accept-Encoding。静态文件压缩后的内容
+缓存在进程内。
+
+静态文件：url_for('static', filename=...) 自动加上 ?v=<文件md5>，带 v 的请求返回
+Cache-Control: public, max-age=STATIC_MAX_AGE（默认一年），文件改变后地址也改变。
+
+缓存和版本号都在进程内，多进程部署时其他进程的修改要等 HTTP_CACHE_TIMEOUT 才能看到。
+"""
+
+import hashlib
+import os
+import time
+import uuid
+import zlib
+from functools import wraps
+
+from flask import request, session, g, current_app
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from werkzeug.http import remove_entity_headers
+
+from .cache import CountingCache, LRUCache
+
+# 可以压缩的 mimetype
+COMPRESSIBLE = set(['text/html', 'text/css', 'text/plain', 'text/javascript', 'text/xml',
+                    'application/javascript', 'application/json', 'application/xml',
+                    'image/svg+xml'])
+# 视图执行前后比较 session 时忽略的key：Flask-Login 的 session 保护和csrf令牌每个请求都可能写
+SESSION_IGNORED = set(['remember', '_id', '_fresh', 'csrf_token'])
+# 缓存的响应里不保存的头
+HEADERS_IGNORED = set(['set-cookie', 'content-length'])
+
+
+# 占位符里的随机串，页面内容里不会出现同样的字符串
+PLACEHOLDER_SALT = hashlib.sha1(os.urandom(16)).hexdigest()[:16]
+
+
+def placeholder(name):
+    """不含HTML和JSON需要转义的字符"""
+    return 'uncached-%s-%s' % (name, PLACEHOLDER_SALT)
+
+
+def session_state():
+    return dict((key, value) for key, value in session.items() if key not in SESSION_IGNORED)
+
+
+def brotli_module():
+    """:return: brotli 模块，没有安装时返回None"""
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+class HttpCache(CountingCache):
+    """未登录访问者的共享响应缓存，ETag、压缩和静态文件地址"""
+    name = 'response'
+
+    def __init__(self, app=None, backend=None):
+        self.enabled = True
+        self.timeout = 60
+        self.etags = True
+        self.compress = True
+        self.compress_min_size = 500
+        self.compress_level = 6
+        self.brotli_quality = 5
+        self.static_max_age = 365 * 24 * 3600
+        # {名字: 无参数函数}，GET请求里渲染成占位符的值
+        self.placeholders = {'csrf_token': generate_csrf,
+                             'uuid': lambda: uuid.uuid4().hex}
+        # {静态文件名: (mtime, md5)}
+        self._fingerprints = {}
+        self._compressed = None
+        CountingCache.__init__(self, app, backend)
+
+    def init_app(self, app):
+        self.enabled = app.config.get('HTTP_CACHE_ENABLED', True)
+        self.timeout = app.config.get('HTTP_CACHE_TIMEOUT', 60)
+        self.etags = app.config.get('HTTP_ETAGS', True)
+        self.compress = app.config.get('COMPRESS_ENABLED', True)
+        self.compress_min_size = app.config.get('COMPRESS_MIN_SIZE', 500)
+        self.compress_level = app.config.get('COMPRESS_LEVEL', 6)
+        self.brotli_quality = app.config.get('COMPRESS_BROTLI_QUALITY', 5)
+        self.static_max_age = app.config.get('STATIC_MAX_AGE', 365 * 24 * 3600)
+        if self.backend is None:
+            self.backend = app.config.get('HTTP_CACHE_BACKEND') or \
+                LRUCache(max_bytes=app.config.get('HTTP_CACHE_MAX_BYTES', 32 * 1024 * 1024),
+                         default_timeout=self.timeout)
+        if self._compressed is None:
+            self._compressed = LRUCache(max_bytes=app.config.get('COMPRESS_STATIC_MAX_BYTES',
+                                                                 8 * 1024 * 1024),
+                                        default_timeout=0)
+        app.extensions['http_cache'] = self
+        # 必须在 csrf.init_app 之后，替换它注册的 csrf_token()
+        app.jinja_env.globals['csrf_token'] = self.csrf_token
+        app.context_processor(lambda: {'csrf_token': self.csrf_token})
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.url_defaults(self._static_version)
+
+    def stats(self):
+        stats = CountingCache.stats(self)
+        if isinstance(self.backend, LRUCache):
+            stats.update(entries=len(self.backend), bytes=self.backend.bytes,
+                         max_bytes=self.backend.max_bytes, evictions=self.backend.evictions)
+        return stats
+
+    def placeholder(self, name):
+        """
+        GET请求里返回占位符，发送响应之前替换成真实的值；其他请求直接返回真实的值
+        :param name: placeholders 里的名字
+        """
+        if not g.get('http_placeholders_enabled'):
+            return self.placeholders[name]()
+        g.http_placeholders.add(name)
+        return placeholder(name)
+
+    def csrf_token(self):
+        return self.placeholder('csrf_token')
+
+    def make_key(self):
+        fragments = current_app.extensions.get('fragment_cache')
+        return u'http|%s|%s|%s|%d' % (request.host, request.full_path,
+                                      session.get('client_zipcode', ''),
+                                      fragments.generation if fragments is not None else 0)
+
+    @staticmethod
+    def variant_key(key, vary):
+        return u'|'.join([key] + [u'%s=%s' % (header, request.headers.get(header, ''))
+                                  for header in vary])
+
+    def cached(self, timeout=None):
+        """
+        视图装饰器，未登录访问者的GET/HEAD请求使用共享缓存
+        :param timeout: 秒，默认 HTTP_CACHE_TIMEOUT
+        """
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or request.method not in ('GET', 'HEAD') or \
+                        current_user.is_authenticated or '_flashes' in session:
+                    return f(*args, **kwargs)
+                key = self.make_key()
+                # 同一个地址的响应按哪些请求头区分
+                vary = self.backend.get(key + u'|vary')
+                entry = self.backend.get(self.variant_key(key, vary)) if vary is not None else None
+                if entry is not None:
+                    self._incr('hits')
+                    status, headers, data, placeholders = entry
+                    g.http_placeholders.update(placeholders)
+                    return current_app.response_class(data, status=status, headers=headers)
+                self._incr('misses')
+                before = session_state()
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed and \
+                        not response.direct_passthrough and session_state() == before:
+                    vary = tuple(sorted(header for header in response.vary
+                                        if header.lower() != 'accept-encoding'))
+                    if '*' not in vary:
+                        headers = [(name, value) for name, value in response.headers
+                                   if name.lower() not in HEADERS_IGNORED]
+                        entry = (200, headers, response.get_data(),
+                                 tuple(g.http_placeholders))
+                        self.backend.set(key + u'|vary', vary, timeout=timeout or self.timeout)
+                        self.backend.set(self.variant_key(key, vary), entry,
+                                         timeout=timeout or self.timeout)
+                return response
+            return wrapper
+        return decorator
+
+    def _before_request(self):
+        g.http_placeholders = set()
+        g.http_placeholders_enabled = request.method in ('GET', 'HEAD')
+
+    def _after_request(self, response):
+        if request.endpoint == 'static' and request.args.get('v'):
+            response.cache_control.public = True
+            response.cache_control.max_age = self.static_max_age
+            response.expires = int(time.time() + self.static_max_age)
+        if response.direct_passthrough and request.endpoint != 'static' or \
+                response.is_streamed and not response.direct_passthrough or \
+                'X-Sendfile' in response.headers:
+            return response
+        etag = None
+        placeholders = g.get('http_placeholders')
+        if placeholders:
+            data = response.get_data()
+            for name in placeholders:
+                data = data.replace(placeholder(name), self.placeholders[name]())
+            if 'uuid' not in placeholders:
+                etag = self._page_etag(response.get_data())
+            response.set_data(data)
+        if request.method not in ('GET', 'HEAD') or response.status_code != 200:
+            return response
+        if self.etags and not response.headers.get('ETag') and \
+                (etag is not None or not placeholders):
+            if etag is not None:
+                response.set_etag(etag)
+            elif not response.direct_passthrough:
+                response.add_etag()
+            if response.mimetype == 'text/html' and not response.headers.get('Cache-Control'):
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+        encoding = self._encoding(response)
+        if encoding is not None:
+            response.vary.add('Accept-Encoding')
+        current, weak = response.get_etag()
+        if current and request.if_none_match.contains_weak(current):
+            return self._not_modified(response)
+        if encoding is not None:
+            self._compress(response, encoding)
+        return response
+
+    def _page_etag(self, data):
+        """HTML页面的ETag：替换占位符之前的内容、csrf令牌和时间段"""
+        period = max(current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600, 2) // 2
+        digest = hashlib.md5(data)
+        digest.update(session.get('csrf_token', ''))
+        digest.update(str(int(time.time()) // period))
+        return digest.hexdigest()
+
+    def _encoding(self, response):
+        """:return: 使用的压缩方式 br、gzip，不压缩时返回None"""
+        if not self.compress or response.mimetype not in COMPRESSIBLE or \
+                'Content-Encoding' in response.headers:
+            return None
+        length = response.content_length
+        if length is not None and length < self.compress_min_size:
+            return None
+        if request.accept_encodings['br'] and brotli_module() is not None:
+            return 'br'
+        if request.accept_encodings['gzip']:
+            return 'gzip'
+        return None
+
+    @staticmethod
+    def _not_modified(response):
+        response.close()
+        response.direct_passthrough = False
+        response.response = []
+        response.status_code = 304
+        remove_entity_headers(response.headers)
+        return response
+
+    def _compress(self, response, encoding):
+        key = None
+        if response.direct_passthrough:
+            # 静态文件，压缩后的内容按 ETag（文件修改时间、大小）缓存
+            key = u'%s|%s|%s' % (request.path, response.get_etag()[0], encoding)
+            data = self._compressed.get(key)
+            if data is not None:
+                response.close()
+                response.direct_passthrough = False
+                response.set_data(data)
+                self._set_encoding(response, encoding)
+                return
+            response.direct_passthrough = False
+        data = response.get_data()
+        if len(data) < self.compress_min_size:
+            return
+        if encoding == 'br':
+            data = brotli_module().compress(data, quality=self.brotli_quality)
+        else:
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+        if key is not None:
+            self._compressed.set(key, data)
+        response.set_data(data)
+        self._set_encoding(response, encoding)
+
+    @staticmethod
+    def _set_encoding(response, encoding):
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+
+    def _static_version(self, endpoint, values):
+        """url_defaults：静态文件地址加上 ?v=<文件md5>"""
+        if endpoint != 'static' or 'filename' not in values or 'v' in values:
+            return
+        version = self.fingerprint(values['filename'])
+        if version is not None:
+            values['v'] = version
+
+    def fingerprint(self, filename):
+        """
+        :param filename: 相对 static 目录的文件名
+        :return: 文件内容md5的前12位，文件不存在时返回None
+        """
+        cached = self._fingerprints.get(filename)
+        if cached is not None and not current_app.debug:
+            return cached[1]
+        path = os.path.join(current_app.static_folder, *filename.split('/'))
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path, 'rb') as f:
+            version = hashlib.md5(f.read()).hexdigest()[:12]
+        self._fingerprints[filename] = (mtime, version)
+        return version
@@ -3,17 +3,20 @@
 import hashlib
 import urllib
 import datetime
+from collections import OrderedDict
 
 from werkzeug.security import generate_password_hash, check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from flask import current_app, flash
+from flask import current_app, flash, url_for, redirect
 from flask_security import UserMixin, RoleMixin
 from flask_security.core import AnonymousUserMixin
 from sqlalchemy.ext.associationproxy import association_proxy
-import boto
-from boto.s3.key import Key
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.exc import IntegrityError
 
-from . import db, login_manager
+from . import db, login_manager, storage, user_cache, order_feed, zipcode_index, fragment_cache
+from .storage import FileTooLarge
+from .exceptions import InvalidTransition
 from .decorators import superuser_required
 
 
@@ -35,6 +38,63 @@ def get_or_create(session, model, **kwargs):
         return instance
 
 
+def bulk_get_or_create(session, model, field, values):
+    """
+    批量获取或者创建对象：一次IN查询已有的对象，一次多行insert缺少的对象，不提交事务
+    field上需要有唯一索引，其他请求并发插入相同的值时，冲突的行会被跳过，再加锁读出其他请求插入的行
+    :param session: db session对象
+    :param model: model类
+    :param field: 字段名，比如'zipcode'
+    :param values: 字段值列表
+    :return: {字段值: 对象}
+    """
+    column = getattr(model, field)
+    values = set(values)
+    if not values:
+        return {}
+    instances = dict((getattr(instance, field), instance)
+                     for instance in session.query(model).filter(column.in_(values)))
+    missing = values - set(instances)
+    if missing:
+        insert_ignore(session, model.__table__, [{field: value} for value in missing])
+        # 被跳过的行是其他事务刚插入的，MySQL REPEATABLE READ 下普通查询读的是事务开始时的快照，
+        # 看不到这些行，用加锁读（LOCK IN SHARE MODE / FOR SHARE）读取最新提交的数据
+        query = session.query(model).filter(column.in_(missing)).with_for_update(read=True)
+        for instance in query:
+            instances[getattr(instance, field)] = instance
+    return instances
+
+
+def insert_ignore(session, table, rows, chunk_size=500):
+    """
+    多行insert，跳过违反唯一约束的行
+    :param session: db session对象
+    :param table: Table对象
+    :param rows: dict列表
+    :param chunk_size: 每条insert语句的行数
+    """
+    dialect = session.get_bind(None, table).dialect.name
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        insert = table.insert().values(chunk)
+        if dialect == 'sqlite':
+            session.execute(insert.prefix_with('OR IGNORE'))
+        elif dialect == 'mysql':
+            session.execute(insert.prefix_with('IGNORE'))
+        else:
+            try:
+                with session.begin_nested():
+                    session.execute(insert)
+            except IntegrityError:
+                # 其他事务同时插入了部分行，逐行重试
+                for row in chunk:
+                    try:
+                        with session.begin_nested():
+                            session.execute(table.insert().values(row))
+                    except IntegrityError:
+                        pass
+
+
 roles_users = db.Table(
     'roles_users',
     db.Column('user_id', db.Integer(), db.ForeignKey('user.id')),
@@ -43,51 +103,171 @@ roles_users = db.Table(
 
 
 class Order(db.Model):
+    # 同一个客户重复提交的订单，见 ordering.place_order
+    __table_args__ = (
+        db.UniqueConstraint('client_id', 'idempotency_key',
+                            name='uq_order_client_id_idempotency_key'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    meal_id = db.Column(db.Integer)
-    zip_id = db.Column(db.Integer)
-    create_date = db.Column(db.DateTime, default=db.func.now())
-    update_date = db.Column(db.DateTime, default=db.func.now())
-    client_id = db.Column(db.Integer)
-    chef_id = db.Column(db.Integer)
+    meal_id = db.Column(db.Integer, db.ForeignKey('meal.id'), index=True)
+    zip_id = db.Column(db.Integer, db.ForeignKey('zipcode.id'), index=True)
+    # 按下单日期重建统计（analytics.rebuild）时使用
+    create_date = db.Column(db.DateTime, default=db.func.now(), index=True)
+    update_date = db.Column(db.DateTime, default=db.func.now(), onupdate=db.func.now())
+    client_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+    chef_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     address = db.Column(db.String(256))
     phone = db.Column(db.String(20))
     message = db.Column(db.String(256))
     # 状态：未处理、已处理、确认收货、取消
     status = db.Column(db.Enum('UNHANDLED', 'HANDLED', 'COMPLETED', 'CANCELED'))
     remark = db.Column(db.String(256))
+    idempotency_key = db.Column(db.String(64))
+
+    zipcode = db.relationship('Zipcode', foreign_keys=[zip_id])
+    meal = db.relationship('Meal', foreign_keys=[meal_id])
+    client = db.relationship('User', foreign_keys=[client_id])
+    chef = db.relationship('User', foreign_keys=[chef_id])
+
+    STATUS_LABELS = OrderedDict([('UNHANDLED', u'未处理'), ('HANDLED', u'已处理'),
+                                 ('COMPLETED', u'已完成'), ('CANCELED', u'已取消')])
+    # 状态机 {当前状态: {目标状态: 可以修改的角色}}：大厨发货，客户确认收货，
+    # 未处理的订单客户和大厨都可以取消，已完成和已取消的订单不能再修改
+    TRANSITIONS = {
+        'UNHANDLED': OrderedDict([('HANDLED', ('chef',)), ('CANCELED', ('client', 'chef'))]),
+        'HANDLED': OrderedDict([('COMPLETED', ('client',))]),
+    }
 
-    @property
-    def zipcode(self):
-        return Zipcode.query.get_or_404(self.zip_id)
-
-    @zipcode.setter
-    def zipcode(self, zipcode):
-        self.zip_id = zipcode.id
-
-    @property
-    def meal(self):
-        return Meal.query.get_or_404(self.meal_id)
-
-    @meal.setter
-    def meal(self, meal):
-        self.meal_id = meal.id
+    @staticmethod
+    def next_statuses(status, role):
+        """
+        :param status: 当前状态
+        :param role: 'client' 或者 'chef'
+        :return: role可以把订单改成的状态列表
+        """
+        return [target for target, roles in Order.TRANSITIONS.get(status, {}).items()
+                if role in roles]
 
-    @property
-    def client(self):
-        return User.query.get_or_404(self.client_id)
+    def transition(self, status, role):
+        """
+        修改订单状态并记录修改时间，取消的订单归还每日限量的名额，提交后推送给大厨，不提交事务。
+        状态用 UPDATE ... WHERE id = :id AND status = :当前状态 修改，并发的另一个请求先改了状态时
+        （比如客户取消的同时大厨发货）更新不到行，统计和名额都不会改变
+        :param status: 目标状态
+        :param role: 'client' 或者 'chef'
+        :raise InvalidTransition: 当前状态不能由role改成status，或者状态已经被其他请求修改
+        """
+        source = self.status
+        if status not in Order.next_statuses(source, role):
+            raise InvalidTransition('can not change status from %s to %s' % (source, status))
+        if self.id is None:
+            db.session.flush()
+        table = Order.__table__
+        now = datetime.datetime.now()
+        result = db.session.execute(table.update()
+                                    .where(table.c.id == self.id)
+                                    .where(table.c.status == source)
+                                    .values(status=status, update_date=now))
+        if result.rowcount != 1:
+            db.session.expire(self, ['status', 'update_date'])
+            raise InvalidTransition('order %d is no longer %s' % (self.id, source))
+        # 数据库里已经是新的状态，对象上同步修改，不再产生一条UPDATE
+        set_committed_value(self, 'status', status)
+        set_committed_value(self, 'update_date', now)
+        OrderDailyStats.add([(self.stats_key(source), -1), (self.stats_key(status), 1)])
+        if status == 'CANCELED' and self.create_date is not None:
+            MealDailyCount.release(self.meal_id, self.create_date.date())
+        order_feed.stage_status(db.session, self.chef_id, self.id, status)
+
+    def stats_key(self, status):
+        """
+        :return: 订单在 order_daily_stats 里的key，没有下单时间时返回None
+        """
+        if self.create_date is None:
+            return None
+        return self.chef_id, self.create_date.date(), self.meal_id, self.zip_id, status
 
-    @client.setter
-    def client(self, client):
-        self.client_id = client.id
+    @staticmethod
+    def bulk_transition(ids, status, role, chef_id=None, chunk_size=500):
+        """
+        用一条 UPDATE ... WHERE id IN (...) AND status IN (...) 修改多个订单的状态，
+        当前状态不允许改成status的订单不会被修改，修改的订单提交后推送给大厨，不提交事务
+        :param ids: 订单id列表，超过chunk_size个时分成多条UPDATE
+        :param status: 目标状态，取消需要归还名额，只能用transition逐个取消
+        :param chef_id: 只修改这个大厨的订单
+        :return: 修改的订单数
+        """
+        sources = [source for source in Order.TRANSITIONS
+                   if status in Order.next_statuses(source, role)]
+        if not sources or status == 'CANCELED':
+            raise InvalidTransition('can not change orders to %s in bulk' % status)
+        table = Order.__table__
+        ids = sorted(set(ids))
+        now = datetime.datetime.now()
+        count = 0
+        for i in range(0, len(ids), chunk_size):
+            # 先锁住要修改的行，才知道推送给哪些大厨
+            query = db.session.query(Order.id, Order.chef_id, Order.create_date, Order.meal_id,
+                                     Order.zip_id, Order.status) \
+                .filter(Order.id.in_(ids[i:i + chunk_size])) \
+                .filter(Order.status.in_(sources))
+            if chef_id is not None:
+                query = query.filter(Order.chef_id == chef_id)
+            rows = query.with_for_update().all()
+            if not rows:
+                continue
+            update = table.update() \
+                .where(table.c.id.in_([row.id for row in rows])) \
+                .where(table.c.status.in_(sources))
+            count += db.session.execute(update.values(status=status, update_date=now)).rowcount
+            changes = []
+            for id, chef, create_date, meal_id, zip_id, source in rows:
+                order_feed.stage_status(db.session, chef, id, status)
+                if create_date is not None:
+                    key = (chef, create_date.date(), meal_id, zip_id)
+                    changes.extend([(key + (source,), -1), (key + (status,), 1)])
+            OrderDailyStats.add(changes)
+        return count
 
-    @property
-    def chef(self):
-        return User.query.get_or_404(self.chef_id)
+    @staticmethod
+    def created_after(chef_id, order_id):
+        """
+        大厨在order_id之后收到的新订单，推送断线重连和页面取增量时使用
+        :return: 按id从小到大的query
+        """
+        return Order.query.filter(Order.chef_id == chef_id) \
+            .filter(Order.id > order_id).order_by(Order.id)
 
-    @chef.setter
-    def chef(self, chef):
-        self.chef_id = chef.id
+    @staticmethod
+    def load_relations(query):
+        """
+        列表页使用：一次查询取出订单关联的meal、client、chef、zipcode，避免N+1查询
+        :param query: Order query
+        :return: 带有joinedload选项的query
+        """
+        return query.options(db.joinedload(Order.meal),
+                             db.joinedload(Order.client),
+                             db.joinedload(Order.chef),
+                             db.joinedload(Order.zipcode))
+
+    def to_json(self):
+        json_order = {
+            'id': self.id,
+            'url': url_for('api.get_order', id=self.id, _external=True),
+            'meal_id': self.meal_id,
+            'meal_name': self.meal.name if self.meal else None,
+            'zipcode': self.zipcode.zipcode if self.zipcode else None,
+            'client_id': self.client_id,
+            'chef_id': self.chef_id,
+            'address': self.address,
+            'phone': self.phone,
+            'message': self.message,
+            'status': self.status,
+            'remark': self.remark,
+            'create_date': self.create_date.isoformat() if self.create_date else None,
+            'update_date': self.update_date.isoformat() if self.update_date else None,
+        }
+        return json_order
 
 
 class Role(db.Model, RoleMixin):
@@ -120,6 +300,9 @@ class User(db.Model, UserMixin):
     avatar = db.Column(db.String(36))
     about_me = db.Column(db.String(512))
     last_seen = db.Column(db.DateTime)
+    # 订单通知，见 notify.py：大厨的短信号码，是否把通知合并成定时的摘要
+    phone = db.Column(db.String(20))
+    notify_digest = db.Column(db.Boolean, default=False)
 
     roles = db.relationship('Role', secondary=roles_users,
                             backref=db.backref('users', lazy='dynamic'))
@@ -164,6 +347,19 @@ class User(db.Model, UserMixin):
         db.session.add(self)
         return True
 
+    def generate_auth_token(self, expiration=3600):
+        s = Serializer(current_app.config['SECRET_KEY'], expires_in=expiration)
+        return s.dumps({'id': self.id})
+
+    @staticmethod
+    def verify_auth_token(token):
+        s = Serializer(current_app.config['SECRET_KEY'])
+        try:
+            data = s.loads(token)
+        except:
+            return None
+        return load_user(data['id'])
+
     def get_gravatar_url(self):
         size = 40
         random = 'identicon'
@@ -203,25 +399,30 @@ login_manager.anonymous_user = AnonymousUser
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    """
+    读取已登录的用户，用户和roles缓存在user_cache中，命中时不查询数据库
+    :param user_id: 用户id
+    :return: 属于当前session的User，不存在时返回None
+    """
+    user_id = int(user_id)
+    user = user_cache.get(
+        user_id, lambda: User.query.options(db.joinedload(User.roles)).get(user_id))
+    if user is None:
+        return None
+    # 缓存中的对象是detached的，load=False 不会发出查询
+    return db.session.merge(user, load=False)
 
 
 class ChefApply(db.Model):
     id = db.Column(db.Integer(), primary_key=True)
-    applicant_id = db.Column(db.Integer())
+    applicant_id = db.Column(db.Integer(), db.ForeignKey('user.id'), index=True)
     content = db.Column(db.Text)
     create_time = db.Column(db.DateTime, default=db.func.now())
     status = db.Column(db.Enum('waiting', 'refused', 'approved'))
     update_time = db.Column(db.DateTime, default=db.func.now())
     admin_id = db.Column(db.Integer())
 
-    @property
-    def applicant(self):
-        return User.query.get_or_404(self.applicant_id)
-
-    @applicant.setter
-    def applicant(self, applicant):
-        self.applicant_id = applicant.id
+    applicant = db.relationship('User', foreign_keys=[applicant_id])
 
     @property
     def admin(self):
@@ -242,9 +443,12 @@ class Meal(db.Model):
     name = db.Column(db.String(128))
     description = db.Column(db.Text)
     is_selected = db.Column(db.Boolean, default=False)
-    chef_id = db.Column(db.Integer)
+    chef_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     create_date = db.Column(db.DateTime, default=db.func.now())
+    # 每天最多的订单数，为空时不限
+    daily_capacity = db.Column(db.Integer)
     zipcodes = association_proxy('meal_zipcodes', 'zipcode')
+    chef = db.relationship('User', foreign_keys=[chef_id])
 
     def __repr__(self):
         return '<Meal %r>' % self.name
@@ -257,19 +461,139 @@ class Meal(db.Model):
     def orders(self, orders):
         raise AttributeError('orders is not a writable attribute')
 
-    @property
-    def chef(self):
-        return User.query.get_or_404(self.chef_id)
+    @staticmethod
+    def load_menu(zipcode, date, nearby=None):
+        """
+        查询zipcode和附近的zipcode在date当天被推荐的meal
+        :param zipcode: zipcode字符串
+        :param date: 菜单日期
+        :param nearby: 附近的zipcode [(zipcode, 距离)]，见 ZipcodeIndex.nearby，为空时只查zipcode本身
+        :return: 可以缓存的meal dict列表，按距离（英里，配送zipcode本身的是0）从近到远；
+                 zipcode和附近的zipcode都不存在时返回None
+        """
+        distances = dict(nearby or ())
+        distances[zipcode] = 0.0
+        zips = dict(db.session.query(Zipcode.id, Zipcode.zipcode)
+                    .filter(Zipcode.zipcode.in_(distances.keys())))
+        if not zips:
+            return None
+        meals = db.session.query(Meal.id, Meal.name, Meal.description, MealZipcode.zipcode_id)\
+            .filter(Meal.is_selected==True)\
+            .filter(Meal.id==MealZipcode.meal_id)\
+            .filter(MealZipcode.zipcode_id.in_(zips.keys()))\
+            .filter(MealZipcode.begin_date<=date)\
+            .filter(MealZipcode.end_date>=date)
+        menu = {}
+        for id, name, description, zip_id in meals:
+            distance = round(distances[zips[zip_id]], 1)
+            if id not in menu or distance < menu[id]['distance']:
+                menu[id] = {'id': id, 'name': name, 'description': description,
+                            'distance': distance}
+        return sorted(menu.values(), key=lambda meal: (meal['distance'], meal['id']))
+
+    @staticmethod
+    def search_filter(zipcodes=None, begin=None, end=None, selected=None):
+        """
+        搜索结果的过滤条件，见 MealSearch.search_ids
+        :param zipcodes: 配送到这些zipcode之一
+        :param begin: 配送日期窗口和 [begin, end] 有交集，end默认等于begin
+        :param selected: 是否被推荐
+        :return: 符合条件的meal id的查询，没有条件时返回None
+        """
+        if zipcodes is None and begin is None and selected is None:
+            return None
+        query = db.session.query(Meal.id)
+        if selected is not None:
+            query = query.filter(Meal.is_selected == selected)
+        if zipcodes is not None or begin is not None:
+            query = query.join(MealZipcode, MealZipcode.meal_id == Meal.id)
+        if zipcodes is not None:
+            query = query.join(Zipcode, Zipcode.id == MealZipcode.zipcode_id)\
+                .filter(Zipcode.zipcode.in_(zipcodes))
+        if begin is not None:
+            query = query.filter(MealZipcode.begin_date <= (end or begin))\
+                .filter(MealZipcode.end_date >= begin)
+        return query
+
+    def to_json(self, fields=None):
+        json_meal = {
+            'id': self.id,
+            'url': url_for('api.get_meal', id=self.id, _external=True),
+            'name': self.name,
+            'description': self.description,
+            'is_selected': self.is_selected,
+            'chef_id': self.chef_id,
+            'daily_capacity': self.daily_capacity,
+            'create_date': self.create_date.isoformat() if self.create_date else None,
+        }
+        if fields is None or 'zipcodes' in fields:
+            json_meal['zipcodes'] = [
+                {'zipcode': zipcode,
+                 'begin_date': begin.isoformat() if begin else None,
+                 'end_date': end.isoformat() if end else None}
+                for zipcode, (begin, end) in self.zipcode_windows().items()]
+        return json_meal
+
+    def zipcode_windows(self):
+        """
+        meal支持的zipcode以及每个zipcode的日期
+        :return: OrderedDict {zipcode: (begin_date, end_date)}，按添加顺序
+        """
+        rows = db.session.query(Zipcode.zipcode, MealZipcode.begin_date, MealZipcode.end_date) \
+            .filter(Zipcode.id == MealZipcode.zipcode_id) \
+            .filter(MealZipcode.meal_id == self.id) \
+            .order_by(MealZipcode.create_date, Zipcode.id)
+        return OrderedDict((zipcode, (begin, end)) for zipcode, begin, end in rows)
 
-    @chef.setter
-    def chef(self, chef):
-        self.chef_id = chef.id
+    def update_zipcodes(self, windows):
+        """
+        按差异更新meal的zipcode：只插入新增的、删除去掉的，日期有变化的用一条UPDATE批量修改，不提交事务
+        :param windows: {zipcode: (begin_date, end_date)}
+        :return: 有变化的zipcode集合
+        """
+        table = MealZipcode.__table__
+        rows = db.session.query(MealZipcode.zipcode_id, Zipcode.zipcode,
+                                MealZipcode.begin_date, MealZipcode.end_date) \
+            .filter(Zipcode.id == MealZipcode.zipcode_id) \
+            .filter(MealZipcode.meal_id == self.id)
+        current = dict((zipcode, (zipcode_id, (begin, end)))
+                       for zipcode_id, zipcode, begin, end in rows)
+        removed = [zipcode for zipcode in current if zipcode not in windows]
+        added = [zipcode for zipcode in windows if zipcode not in current]
+        changed = [zipcode for zipcode in windows
+                   if zipcode in current and current[zipcode][1] != tuple(windows[zipcode])]
+        if removed:
+            db.session.execute(
+                table.delete()
+                .where(table.c.meal_id == self.id)
+                .where(table.c.zipcode_id.in_([current[zipcode][0] for zipcode in removed])))
+        if added:
+            db.session.execute(table.insert().values([
+                {'meal_id': self.id,
+                 'zipcode_id': zipcode.id,
+                 'begin_date': windows[zipcode.zipcode][0],
+                 'end_date': windows[zipcode.zipcode][1]}
+                for zipcode in Zipcode.add_zips(added)]))
+        if changed:
+            ids = dict((zipcode, current[zipcode][0]) for zipcode in changed)
+            begin_dates = dict((ids[zipcode], windows[zipcode][0]) for zipcode in changed)
+            end_dates = dict((ids[zipcode], windows[zipcode][1]) for zipcode in changed)
+            db.session.execute(
+                table.update()
+                .where(table.c.meal_id == self.id)
+                .where(table.c.zipcode_id.in_(ids.values()))
+                .values(begin_date=db.case(begin_dates, value=table.c.zipcode_id),
+                        end_date=db.case(end_dates, value=table.c.zipcode_id)))
+        if removed or added or changed:
+            fragment_cache.touch(db.session, 'meal', self.id)
+        db.session.expire(self, ['meal_zipcodes'])
+        return set(removed) | set(added) | set(changed)
 
 
 class Zipcode(db.Model):
     __tablename__ = 'zipcode'
     id = db.Column(db.Integer(), primary_key=True)
-    zipcode = db.Column(db.String(20))
+    zipcode = db.Column(db.String(20), index=True, unique=True)
     meals = association_proxy('meal_zipcodes', 'meal')
 
     def __repr__(self):
@@ -278,16 +602,23 @@ class Zipcode(db.Model):
     @staticmethod
     def add_zips(zips):
         """
-        批量添加zip
+        批量添加zip，不提交事务
         :param zips: zip list
-        :return:所有zip对象
+        :return:所有zip对象，按zips中的顺序去重
         """
-        return [get_or_create(db.session, Zipcode, zipcode=zip.strip()) for zip in zips]
+        codes = []
+        for zip in zips:
+            zip = zip.strip()
+            if zip and zip not in codes:
+                codes.append(zip)
+        zipcodes = bulk_get_or_create(db.session, Zipcode, 'zipcode', codes)
+        return [zipcodes[code] for code in codes]
 
     @staticmethod
     def is_valid(zipcode):
+        """5位数字，并且导入了zipcode中心点时是存在的zipcode"""
         if zipcode is not None and zipcode != "" and len(zipcode) == 5 and zipcode.isdigit():
-            return True
+            return zipcode_index.known(zipcode)
         else:
             return False
 
@@ -300,8 +631,25 @@ class Zipcode(db.Model):
         raise AttributeError('orders is not a writable attribute')
 
 
+class ZipcodeCentroid(db.Model):
+    """zipcode中心点的经纬度，python manage.py load_zipcodes 导入，见 geo.py"""
+    __tablename__ = 'zipcode_centroid'
+    zipcode = db.Column(db.String(5), primary_key=True)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    city = db.Column(db.String(64))
+    state = db.Column(db.String(2))
+
+    def __repr__(self):
+        return '<ZipcodeCentroid %r>' % self.zipcode
+
+
 class MealZipcode(db.Model):
     __tablename__ = 'meal_zipcode'
+    # client.menu按zipcode和日期窗口查找meal
+    __table_args__ = (
+        db.Index('ix_meal_zipcode_zipcode_id_dates', 'zipcode_id', 'begin_date', 'end_date'),
+    )
     meal_id = db.Column(db.Integer,
                         db.ForeignKey('meal.id'),
                         primary_key=True)
@@ -320,52 +668,101 @@ class MealZipcode(db.Model):
                                               cascade='all, delete-orphan'))
 
 
+class MealDailyCount(db.Model):
+    """有每日限量的meal每天已经下的订单数，见 ordering.reserve"""
+    __tablename__ = 'meal_daily_count'
+    meal_id = db.Column(db.Integer, db.ForeignKey('meal.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True)
+    ordered = db.Column(db.Integer, nullable=False, default=0)
+
+    @staticmethod
+    def release(meal_id, date):
+        """取消的订单归还名额，不提交事务"""
+        table = MealDailyCount.__table__
+        db.session.execute(
+            table.update()
+            .where(table.c.meal_id == meal_id)
+            .where(table.c.date == date)
+            .where(table.c.ordered > 0)
+            .values(ordered=table.c.ordered - 1))
+
+
+class OrderDailyStats(db.Model):
+    """
+    每个大厨、下单日期、meal、zipcode每种状态的订单数，下单和订单状态变化时增量更新，
+    统计页面只读这张表，见 analytics.py
+    """
+    __tablename__ = 'order_daily_stats'
+    chef_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    date = db.Column(db.Date, primary_key=True, index=True)
+    meal_id = db.Column(db.Integer, db.ForeignKey('meal.id'), primary_key=True)
+    zip_id = db.Column(db.Integer, db.ForeignKey('zipcode.id'), primary_key=True)
+    status = db.Column(db.String(16), primary_key=True)
+    orders = db.Column(db.Integer, nullable=False, default=0)
+
+    KEY = ('chef_id', 'date', 'meal_id', 'zip_id', 'status')
+
+    @staticmethod
+    def add(changes):
+        """
+        修改订单数，不提交事务：先插入不存在的计数行，再用 orders = orders + n 更新，
+        和订单在同一个事务里提交
+        :param changes: [(key, 变化)]，key是 Order.stats_key 的返回值，为None或者有空值时跳过
+        """
+        counts = {}
+        for key, delta in changes:
+            if key is not None and None not in key:
+                counts[key] = counts.get(key, 0) + delta
+        # 按固定的顺序更新，并发的事务不会互相等待对方锁住的行
+        keys = sorted(key for key, delta in counts.items() if delta)
+        if not keys:
+            return
+        table = OrderDailyStats.__table__
+        insert_ignore(db.session, table, [dict(zip(OrderDailyStats.KEY, key), orders=0)
+                                          for key in keys if counts[key] > 0])
+        for key in keys:
+            condition = db.and_(*[table.c[name] == value
+                                  for name, value in zip(OrderDailyStats.KEY, key)])
+            db.session.execute(table.update().where(condition)
+                               .values(orders=table.c.orders + counts[key]))
+
+
 class S3file(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     timestamp = db.Column(db.DateTime)
     filename = db.Column(db.String(128))
     user_id = db.Column(db.String(36))
     url = db.Column(db.String)
+    key = db.Column(db.String(512))
     model_id = db.Column(db.Integer)
 
     @staticmethod
     def files2s3(data_files, path=""):
         """
-        store files to Amazon S3
+        store files to the configured storage backend (S3, local disk or memory)
         :param data_files: file list
-        :param path: the file path in Amazon S3
-        :return: file list in Amazon S3
+        :param path: the file path in the storage
+        :return: file list in the storage
         """
         s3file_list = []
         if data_files is None or len(data_files) == 0:
             return s3file_list
         if data_files[0].filename == "" or data_files[0].filename is None:
             return s3file_list
-        # connect to s3
-        s3 = boto.connect_s3(current_app.config['AWS_ACCESS_KEY_ID'],
-                             current_app.config['AWS_SECRET_ACCESS_KEY'])
-        # Get a handle to the S3 bucket
-        bucket_name = 'threemealbucket'
-        bucket = s3.lookup(bucket_name, validate=False)
-        if bucket is None:
-            bucket = s3.create_bucket(bucket_name)
-        k = Key(bucket)
-        # Loop over the list of files from the HTML input control
+        uploads = []
         for data_file in data_files:
             s3file = S3file(filename=data_file.filename, timestamp=datetime.datetime.utcnow())
-
-            k.key = path + s3file.timestamp.strftime("%Y-%m-%d-%H-%M-%S-")+s3file.filename
-            # Read the contents of the file
-            content = data_file.read()
-            if len(content) < current_app.config['MAX_CONTENT_LENGTH']:
-                k.set_contents_from_string(content)
-                s3file.url = k.generate_url(expires_in=0, query_auth=False, force_http=True)
+            s3file.key = path + s3file.timestamp.strftime("%Y-%m-%d-%H-%M-%S-") + s3file.filename
+            s3file_list.append(s3file)
+            uploads.append((data_file.stream, s3file.key))
+        # files are streamed to the storage concurrently, see app/storage.py
+        for s3file, error in zip(s3file_list, storage.save_many(uploads)):
+            if error is None:
                 s3file.fail_reason = None
-            else:
+            elif isinstance(error, FileTooLarge):
                 s3file.fail_reason = u"文件超过10MB"
-            s3file_list.append(s3file)
-            print "upaload to s3 " + s3file.filename
-        s3.close()
+            else:
+                s3file.fail_reason = u"保存文件出错"
         return s3file_list
 
     @staticmethod
@@ -383,10 +780,53 @@ class S3file(db.Model):
                 flash(s3file.filename + u'上传失败: ' + s3file.fail_reason, 'error')
             else:
                 flash(s3file.filename + u'上传成功', 'info')
+                s3file.url = storage.url(s3file.key)
                 s3file.model_id = model_instance.id
                 db.session.add(s3file)
 
-        if len(s3file_list) > 0:
+        try:
             db.session.commit()
+        except Exception:
+            db.session.rollback()
+            for s3file in s3file_list:
+                if s3file.fail_reason is None:
+                    storage.delete(s3file.key)
+            raise
 
         return True
+
+    def send(self):
+        """
+        response for downloading the file
+        """
+        if self.key is None:
+            # uploaded before the key was recorded, always on s3
+            return redirect(self.url)
+        return storage.send(self.key)
+
+
+class MailOutbox(db.Model):
+    """待发送的邮件，进程重启后仍会被发送，失败时按指数退避重试"""
+    __tablename__ = 'mail_outbox'
+    __table_args__ = (
+        db.Index('ix_mail_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    sender = db.Column(db.String(256))
+    recipient = db.Column(db.String(120))
+    subject = db.Column(db.String(256))
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    # 状态：待发送、发送中、已发送、失败
+    status = db.Column(db.Enum('pending', 'sending', 'sent', 'failed', name='mail_status'),
+                       default='pending')
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.datetime.now)
+    claimed_by = db.Column(db.String(32), index=True)
+    claimed_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String(512))
+    create_date = db.Column(db.DateTime, default=db.func.now())
+    sent_date = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<MailOutbox %r %s>' % (self.recipient, self.status)
@@ -0,0 +1,387 @@
+# -*- coding:utf-8 -*-
+"""
+订单通知
+
+订单事件提交后（feed.orders_committed 信号）由 Notifier 在后台发送邮件和短信：
+
+- 新订单通知大厨，发货通知客户，取消通知大厨和客户
+- 事件先放进队列，后台线程每次取一批（NOTIFY_BATCH_SIZE，最多等 NOTIFY_BATCH_WINDOW 秒凑一批），
+  一条查询取出这批订单和关联的meal、大厨、客户，邮件一次写入 mail_outbox（email.send_emails），
+  短信一次交给短信后端，请求线程不等待发送
+- 大厨可以打开摘要模式（User.notify_digest），事件先攒起来，每 NOTIFY_DIGEST_INTERVAL 秒合并成
+  一封邮件、一条短信
+- 限流：每个收件人 NOTIFY_RATE_PERIOD 秒内最多 NOTIFY_RATE_LIMIT 条通知，超过的大厨通知转入摘要，
+  客户的通知丢弃
+- 发送方式由 NOTIFY_EMAIL_TRANSPORT（mail、fake）和 NOTIFY_SMS_TRANSPORT（log、twilio、fake）选择，
+  也可以直接配置一个实现了 send(notices) 的对象；fake 只把渲染好的通知记在 sent 里，测试使用
+
+队列和摘要在进程内存中，进程退出时还没有发出的通知会丢失；写进 mail_outbox 的邮件不会丢。
+测试时 NOTIFY_ASYNC = False，不启动后台线程，调用 Notifier.flush 同步发送。
+"""
+
+import atexit
+import base64
+import json
+import logging
+import threading
+import time
+import urllib
+import urllib2
+from collections import namedtuple, deque
+from Queue import Queue, Full, Empty
+
+from flask import current_app, render_template
+
+from .feed import orders_committed
+
+logger = logging.getLogger(__name__)
+
+# 订单事件通知谁
+RECIPIENTS = {
+    'created': ('chef',),
+    'handled': ('client',),
+    'canceled': ('chef', 'client'),
+}
+
+SUBJECTS = {
+    'created': u'新订单：%s',
+    'handled': u'订单已发货：%s',
+    'canceled': u'订单已取消：%s',
+}
+
+
+class Notice(namedtuple('Notice', 'channel to subject template context')):
+    """一条要发送的通知，template 是 email/ 或 sms/ 下的模板名"""
+
+    def render(self, extension='.txt'):
+        return render_template('%s/%s%s' % (self.channel, self.template, extension),
+                               **self.context)
+
+
+def event_kind(message):
+    """
+    :param message: feed 发布的消息
+    :return: created、handled、canceled，不需要通知时返回None
+    """
+    if message['event'] == 'created':
+        return 'created'
+    return {'HANDLED': 'handled', 'CANCELED': 'canceled'}.get(message['status'])
+
+
+def summarize(order, kind):
+    """订单的摘要，摘要里保存的是普通的dict，不引用ORM对象"""
+    return {'kind': kind,
+            'id': order.id,
+            'meal': order.meal.name if order.meal else '',
+            'client': (order.client.nickname or order.client.email) if order.client else '',
+            'address': order.address,
+            'phone': order.phone,
+            'message': order.message,
+            'status': order.status,
+            'create_date': order.create_date.strftime('%Y-%m-%d %H:%M') if order.create_date else ''}
+
+
+class MailTransport(object):
+    """写入 mail_outbox，不提交事务，由 email.mail_workers 发送"""
+
+    def __init__(self, config):
+        pass
+
+    def send(self, notices):
+        from .email import send_emails
+        send_emails([(notice.to, notice.subject, 'email/' + notice.template, notice.context)
+                     for notice in notices])
+
+
+class LogSms(object):
+    """没有短信服务时只写日志"""
+
+    def __init__(self, config):
+        pass
+
+    def send(self, notices):
+        for notice in notices:
+            logger.info('sms to %s: %s', notice.to, notice.render())
+
+
+class TwilioSms(object):
+    """Twilio 的 REST API，TWILIO_ACCOUNT_SID、TWILIO_AUTH_TOKEN、TWILIO_FROM"""
+
+    def __init__(self, config):
+        self.url = 'https://api.twilio.com/2010-04-01/Accounts/%s/Messages.json' % \
+            config['TWILIO_ACCOUNT_SID']
+        self.authorization = 'Basic ' + base64.b64encode(
+            '%s:%s' % (config['TWILIO_ACCOUNT_SID'], config['TWILIO_AUTH_TOKEN']))
+        self.sender = config['TWILIO_FROM']
+        self.timeout = config.get('TWILIO_TIMEOUT', 10)
+
+    def send(self, notices):
+        for notice in notices:
+            data = urllib.urlencode({'From': self.sender,
+                                     'To': notice.to,
+                                     'Body': notice.render().encode('utf-8')})
+            request = urllib2.Request(self.url, data, {'Authorization': self.authorization})
+            try:
+                json.load(urllib2.urlopen(request, timeout=self.timeout))
+            except (urllib2.URLError, ValueError) as e:
+                logger.warning('send sms to %s failed: %s', notice.to, e)
+
+
+class FakeTransport(object):
+    """只记录渲染好的通知，不发送"""
+
+    def __init__(self, config=None):
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, notices):
+        rendered = [{'channel': notice.channel,
+                     'to': notice.to,
+                     'subject': notice.subject,
+                     'body': notice.render()} for notice in notices]
+        with self._lock:
+            self.sent.extend(rendered)
+
+    def clear(self):
+        with self._lock:
+            self.sent = []
+
+
+TRANSPORTS = {
+    'email': {'mail': MailTransport, 'fake': FakeTransport},
+    'sms': {'log': LogSms, 'twilio': TwilioSms, 'fake': FakeTransport},
+}
+
+
+class RateLimiter(object):
+    """滑动窗口限流：每个key在period秒内最多limit次"""
+
+    def __init__(self, limit, period, clock=time.time):
+        self.limit = limit
+        self.period = period
+        self.clock = clock
+        self.history = {}
+
+    def allow(self, key):
+        now = self.clock()
+        history = self.history.setdefault(key, deque())
+        while history and history[0] <= now - self.period:
+            history.popleft()
+        if len(history) >= self.limit:
+            return False
+        history.append(now)
+        return True
+
+    def prune(self):
+        """删除窗口里已经没有记录的key"""
+        expired = self.clock() - self.period
+        for key in [key for key, history in self.history.items()
+                    if not history or history[-1] <= expired]:
+            del self.history[key]
+
+
+class Notifier(object):
+    """订单事件的队列、后台发送线程和大厨的摘要"""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.queue = None
+        self.thread = None
+        self.transports = {}
+        self.limiter = None
+        # {大厨id: {'since': 第一条的时间, 'email', 'phone', 'nickname', 'events': [摘要]}}
+        self.digests = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        for channel, key, default in (('email', 'NOTIFY_EMAIL_TRANSPORT', 'mail'),
+                                      ('sms', 'NOTIFY_SMS_TRANSPORT', 'log')):
+            transport = config.get(key) or default
+            if isinstance(transport, basestring):
+                transport = TRANSPORTS[channel][transport](config)
+            self.transports[channel] = transport
+        self.limiter = RateLimiter(config.get('NOTIFY_RATE_LIMIT', 20),
+                                   config.get('NOTIFY_RATE_PERIOD', 3600))
+        self.queue = Queue(maxsize=config.get('NOTIFY_QUEUE_SIZE', 10000))
+        orders_committed.connect(self._on_commit)
+        app.extensions['notifier'] = self
+
+    def _on_commit(self, sender, events):
+        app = current_app._get_current_object()
+        if not app.config.get('NOTIFY_ENABLED', True):
+            return
+        for chef_id, message in events:
+            kind = event_kind(message)
+            if kind is not None:
+                self.notify(app, message['id'], kind)
+
+    def notify(self, app, order_id, kind):
+        """
+        把一个订单事件放进队列
+        :param kind: created、handled、canceled
+        """
+        if app.config.get('NOTIFY_ASYNC', True):
+            self.start(app)
+        try:
+            self.queue.put_nowait((order_id, kind))
+        except Full:
+            logger.warning('notification queue is full, %s of order %s dropped', kind, order_id)
+
+    def start(self, app):
+        with self._lock:
+            if self.thread is not None:
+                return
+            self.app = app
+            self._stopped.clear()
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+            atexit.register(self.stop, 5)
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.thread = None
+
+    def _take_batch(self, batch_size, window):
+        try:
+            batch = [self.queue.get(timeout=1)]
+        except Empty:
+            return []
+        deadline = time.time() + window
+        while len(batch) < batch_size:
+            remaining = deadline - time.time()
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining > 0
+                             else self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        from . import db
+        config = self.app.config
+        with self.app.app_context():
+            while not self._stopped.is_set():
+                batch = self._take_batch(config.get('NOTIFY_BATCH_SIZE', 100),
+                                         config.get('NOTIFY_BATCH_WINDOW', 2))
+                try:
+                    if batch:
+                        self.dispatch(batch)
+                    self.flush_digests()
+                    # MailTransport 写入的邮件
+                    db.session.commit()
+                except Exception:
+                    logger.exception('notifier failed')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+    def flush(self):
+        """
+        同步发送队列里所有的事件和所有的摘要，需要app context，
+        写入 mail_outbox 的邮件由调用方提交
+        """
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        if batch:
+            self.dispatch(batch)
+        self.flush_digests(force=True)
+
+    def dispatch(self, batch):
+        """
+        发送一批事件
+        :param batch: [(订单id, 事件)]
+        """
+        from .models import Order
+        ids = set(order_id for order_id, kind in batch)
+        orders = dict((order.id, order) for order in
+                      Order.load_relations(Order.query.filter(Order.id.in_(ids))))
+        notices = []
+        for order_id, kind in batch:
+            order = orders.get(order_id)
+            if order is None:
+                continue
+            for role in RECIPIENTS[kind]:
+                if role == 'chef':
+                    notices.extend(self._chef_notices(order, kind))
+                else:
+                    notices.extend(self._client_notices(order, kind))
+        self.send(notices)
+
+    def _notices(self, email, phone, template, subject, context):
+        notices = []
+        if email:
+            notices.append(Notice('email', email, subject, template, context))
+        if phone:
+            notices.append(Notice('sms', phone, subject, template, context))
+        return notices
+
+    def _chef_notices(self, order, kind):
+        chef = order.chef
+        if chef is None:
+            return []
+        summary = summarize(order, kind)
+        if chef.notify_digest or not self.limiter.allow(('chef', chef.id)):
+            digest = self.digests.setdefault(chef.id, {'since': time.time(), 'events': []})
+            digest.update(email=chef.email, phone=chef.phone,
+                          nickname=chef.nickname or chef.email)
+            digest['events'].append(summary)
+            return []
+        return self._notices(chef.email, chef.phone, 'order_%s' % kind,
+                             SUBJECTS[kind] % summary['meal'],
+                             {'order': summary, 'nickname': chef.nickname or chef.email})
+
+    def _client_notices(self, order, kind):
+        client = order.client
+        if client is None:
+            return []
+        if not self.limiter.allow(('client', client.id)):
+            logger.info('notification of order %s to client %s is rate limited', order.id, client.id)
+            return []
+        summary = summarize(order, kind)
+        return self._notices(client.email, order.phone, 'order_%s' % kind,
+                             SUBJECTS[kind] % summary['meal'],
+                             {'order': summary, 'nickname': client.nickname or client.email})
+
+    def flush_digests(self, force=False):
+        """
+        发送到期的摘要
+        :param force: 不管是否到期，全部发送
+        """
+        interval = current_app.config.get('NOTIFY_DIGEST_INTERVAL', 900)
+        now = time.time()
+        notices = []
+        for chef_id in list(self.digests):
+            digest = self.digests[chef_id]
+            if not force and now - digest['since'] < interval:
+                continue
+            del self.digests[chef_id]
+            events = digest['events']
+            counts = dict((kind, sum(1 for event in events if event['kind'] == kind))
+                          for kind in RECIPIENTS)
+            notices.extend(self._notices(digest['email'], digest['phone'], 'order_digest',
+                                         u'%d个订单更新' % len(events),
+                                         {'events': events, 'counts': counts,
+                                          'nickname': digest['nickname']}))
+        self.limiter.prune()
+        self.send(notices)
+
+    def send(self, notices):
+        for channel in ('email', 'sms'):
+            batch = [notice for notice in notices if notice.channel == channel]
+            if not batch:
+                continue
+            try:
+                self.transports[channel].send(batch)
+            except Exception:
+                logger.exception('send %d %s notifications failed', len(batch), channel)
@@ -0,0 +1,120 @@
+# -*- coding:utf-8 -*-
+"""
+下单
+
+place_order 是网页（client.meal_detail）和API（POST /api/v1.0/orders）共用的下单入口：
+
+- 配送检查：一条查询，走 zipcode 的唯一索引和 meal_zipcode 的主键，不加载meal的所有zipcode；
+  客户的zipcode附近 ZIPCODE_RADIUS 英里内的zipcode也算（geo.ZipcodeIndex），订单记在最近的那个上
+- 幂等：表单里的隐藏字段或者API的 Idempotency-Key 头作为 idempotency_key，同一个客户重复提交
+  （双击、网络超时后重试）返回第一次创建的订单；(client_id, idempotency_key) 上有唯一约束，
+  并发的重复提交只有一个能插入成功
+- 每日限量：Meal.daily_capacity 不为空时，meal_daily_count 里当天的计数用一条带条件的UPDATE
+  加一（ordered < daily_capacity），更新不到行就是卖完了；计数和订单在同一个事务里提交，
+  不需要行锁。订单取消时 Order.transition 把计数减回去
+- 统计：order_daily_stats 里这个订单的计数同一个事务里加一，见 analytics.py
+"""
+
+import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from . import db, order_feed, zipcode_index
+from .exceptions import NotDeliverable, SoldOut, IdempotencyKeyReused
+from .models import Order, OrderDailyStats, Zipcode, MealZipcode, MealDailyCount, insert_ignore
+
+
+def deliverable_zip_id(meal_id, zipcode):
+    """
+    :param meal_id: meal id
+    :param zipcode: zipcode字符串
+    :return: meal配送到zipcode或者附近 ZIPCODE_RADIUS 英里内的zipcode时，返回最近的那个zipcode的id，
+             否则返回None
+    """
+    distances = dict(zipcode_index.nearby(zipcode))
+    distances[zipcode] = 0.0
+    rows = db.session.query(MealZipcode.zipcode_id, Zipcode.zipcode) \
+        .join(Zipcode, Zipcode.id == MealZipcode.zipcode_id) \
+        .filter(MealZipcode.meal_id == meal_id) \
+        .filter(Zipcode.zipcode.in_(distances.keys())).all()
+    if not rows:
+        return None
+    return min(rows, key=lambda row: distances[row[1]])[0]
+
+
+def reserve(meal, day):
+    """
+    占用meal在day的一个名额，不提交事务
+    :raise SoldOut: 已经卖完
+    """
+    table = MealDailyCount.__table__
+    insert_ignore(db.session, table, [{'meal_id': meal.id, 'date': day, 'ordered': 0}])
+    result = db.session.execute(
+        table.update()
+        .where(table.c.meal_id == meal.id)
+        .where(table.c.date == day)
+        .where(table.c.ordered < meal.daily_capacity)
+        .values(ordered=table.c.ordered + 1))
+    if result.rowcount != 1:
+        raise SoldOut('meal %d is sold out on %s' % (meal.id, day))
+
+
+def find_order(client_id, idempotency_key):
+    return Order.query.filter_by(client_id=client_id, idempotency_key=idempotency_key).first()
+
+
+def _replayed(order, meal):
+    if order.meal_id != meal.id:
+        raise IdempotencyKeyReused('idempotency key was used for another order')
+    return order, False
+
+
+def place_order(meal, zipcode, client_id, address, phone, message=None, idempotency_key=None):
+    """
+    下单并提交事务，提交后推送给大厨
+    :param meal: Meal
+    :param zipcode: 配送的zipcode字符串
+    :param client_id: 下单的客户
+    :param idempotency_key: 客户端生成的唯一字符串，为空时不检查重复提交
+    :return: (订单, 是否新建)，重复提交时返回第一次创建的订单
+    :raise NotDeliverable: meal不配送到zipcode
+    :raise SoldOut: meal今天已经卖完
+    :raise IdempotencyKeyReused: idempotency_key已经用来订了别的meal
+    """
+    if idempotency_key:
+        order = find_order(client_id, idempotency_key)
+        if order is not None:
+            return _replayed(order, meal)
+    zip_id = deliverable_zip_id(meal.id, zipcode)
+    if zip_id is None:
+        raise NotDeliverable('meal is not available in this zipcode')
+    now = datetime.datetime.now()
+    order = Order(meal_id=meal.id,
+                  zip_id=zip_id,
+                  client_id=client_id,
+                  chef_id=meal.chef_id,
+                  address=address,
+                  phone=phone,
+                  message=message,
+                  status='UNHANDLED',
+                  idempotency_key=idempotency_key or None,
+                  create_date=now,
+                  update_date=now)
+    try:
+        if meal.daily_capacity is not None:
+            reserve(meal, now.date())
+        db.session.add(order)
+        OrderDailyStats.add([(order.stats_key(order.status), 1)])
+        order_feed.stage(db.session, order, created=True)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        # 同一个idempotency_key的另一个请求先提交了
+        order = find_order(client_id, idempotency_key) if idempotency_key else None
+        if order is None:
+            raise
+        return _replayed(order, meal)
+    except SoldOut:
+        db.session.rollback()
+        raise
+    return order, True
@@ -0,0 +1,265 @@
+# -*- coding:utf-8 -*-
+"""
+请求级别的SQL性能分析
+
+打开 PROFILER_ENABLED 后，SQLProfiler 通过 SQLAlchemy 的 engine 事件记录每个请求执行的
+查询和耗时，通过 Flask 的 request_started/request_finished 信号把这些数据归到请求上，
+并统计模板渲染时间和各个缓存（cache.py、fragments.py）的命中次数。同一个请求里相同的SQL执行多次（通常是在循环里访问 Order.meal、
+Meal.chef、ChefApply.admin 这类属性造成的N+1查询）会被标记为重复，并记下发出查询的代码位置。
+
+结果的去处：
+- 响应头 X-DB-Queries、X-DB-Time、X-DB-Duplicates、X-Template-Time、X-Request-Time（毫秒），
+  X-Cache（每个缓存的 命中/查找次数，比如 fragment=3/4,menu=1/1）
+- 日志 app.profiler：慢查询（PROFILER_SLOW_QUERY）、慢请求（PROFILER_SLOW_REQUEST）、重复查询
+- 最近 PROFILER_HISTORY 个请求保存在内存中，管理员页面 /admin/profiler 查看，
+  或者 python manage.py profile /menu/94536 在命令行里分析
+"""
+
+import logging
+import os
+import threading
+import time
+import traceback
+from collections import deque, Counter
+
+from flask import g, request, has_app_context, request_started, request_finished
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+class RequestProfile(object):
+    """一个请求的查询和耗时"""
+
+    def __init__(self, method, path, endpoint):
+        self.method = method
+        self.path = path
+        self.endpoint = endpoint
+        self.status = None
+        self.started = time.time()
+        self.duration = 0.0
+        self.queries = []
+        self.template_time = 0.0
+        # {缓存名: [命中, 未命中]}
+        self.caches = {}
+        # 重复查询第一次出现重复时的代码位置 {statement: 'file:line in function'}
+        self.origins = {}
+        self._seen = set()
+
+    @property
+    def db_time(self):
+        return sum(duration for statement, duration in self.queries)
+
+    def duplicates(self):
+        """
+        :return: 执行超过一次的查询 [(statement, 次数, 代码位置)]，按次数从多到少
+        """
+        counts = Counter(statement for statement, duration in self.queries)
+        return [(statement, count, self.origins.get(statement))
+                for statement, count in counts.most_common() if count > 1]
+
+    def cache_totals(self):
+        """
+        :return: (所有缓存的命中次数, 查找次数)
+        """
+        hits = sum(hits for hits, misses in self.caches.values())
+        return hits, hits + sum(misses for hits, misses in self.caches.values())
+
+    def record_query(self, statement, duration, root_path):
+        if statement in self._seen and statement not in self.origins:
+            self.origins[statement] = caller(root_path)
+        self._seen.add(statement)
+        self.queries.append((statement, duration))
+
+    def to_dict(self):
+        return {'method': self.method,
+                'path': self.path,
+                'endpoint': self.endpoint,
+                'status': self.status,
+                'started': self.started,
+                'duration': self.duration,
+                'queries': len(self.queries),
+                'db_time': self.db_time,
+                'template_time': self.template_time,
+                'caches': dict((name, {'hits': hits, 'misses': misses})
+                               for name, (hits, misses) in self.caches.items()),
+                'duplicates': [{'statement': statement, 'count': count, 'origin': origin}
+                               for statement, count, origin in self.duplicates()]}
+
+
+def caller(root_path):
+    """
+    调用栈中最靠近当前位置的应用代码（root_path下，除了本模块）
+    :param root_path: app包的目录
+    :return: 'file:line in function'，找不到时返回None
+    """
+    for filename, line, function, text in reversed(traceback.extract_stack()):
+        if filename.startswith(root_path) and filename != __file__.rstrip('c'):
+            return '%s:%d in %s' % (os.path.relpath(filename, os.path.dirname(root_path)),
+                                    line, function)
+    return None
+
+
+def current_profile():
+    """当前请求的RequestProfile，没有在分析时返回None"""
+    if not has_app_context():
+        return None
+    return getattr(g, 'sql_profile', None)
+
+
+def record_cache(name, hit):
+    """
+    记录一次缓存查找，没有在分析时什么也不做
+    :param name: 缓存名，比如 menu、user、fragment
+    :param hit: 是否命中
+    """
+    profile = current_profile()
+    if profile is not None:
+        counts = profile.caches.setdefault(name, [0, 0])
+        counts[0 if hit else 1] += 1
+
+
+class ProfiledTemplate(Template):
+    """记录渲染时间的模板类，extends/include 的子模板在父模板的render里完成"""
+
+    def render(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return super(ProfiledTemplate, self).render(*args, **kwargs)
+        finally:
+            profile = current_profile()
+            if profile is not None:
+                profile.template_time += time.time() - start
+
+
+class SQLProfiler(object):
+    """SQL性能分析，默认关闭"""
+
+    _engine_hooked = False
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.recent = deque(maxlen=200)
+        self.slow_queries = deque(maxlen=200)
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['profiler'] = self
+        if app.config.get('PROFILER_ENABLED'):
+            self.enable(app)
+
+    def enable(self, app):
+        """开始分析app的请求"""
+        config = app.config
+        self.root_path = app.root_path
+        self.slow_query = config.get('PROFILER_SLOW_QUERY', 0.1)
+        self.slow_request = config.get('PROFILER_SLOW_REQUEST', 0.5)
+        self.headers = config.get('PROFILER_HEADERS', True)
+        history = config.get('PROFILER_HISTORY', 200)
+        self.recent = deque(maxlen=history)
+        self.slow_queries = deque(maxlen=history)
+        if not SQLProfiler._engine_hooked:
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+            SQLProfiler._engine_hooked = True
+        request_started.connect(self._request_started, app)
+        request_finished.connect(self._request_finished, app)
+        app.jinja_env.template_class = ProfiledTemplate
+        self.enabled = True
+
+    def _request_started(self, app, **extra):
+        g.sql_profile = RequestProfile(request.method, request.full_path.rstrip('?'),
+                                       request.endpoint)
+        g.sql_profiler = self
+
+    def _request_finished(self, app, response, **extra):
+        profile = current_profile()
+        if profile is None:
+            return
+        profile.duration = time.time() - profile.started
+        profile.status = response.status_code
+        g.sql_profile = None
+        with self._lock:
+            self.recent.append(profile)
+        self._log(profile)
+        if self.headers:
+            response.headers['X-DB-Queries'] = str(len(profile.queries))
+            response.headers['X-DB-Time'] = '%.1f' % (profile.db_time * 1000)
+            response.headers['X-DB-Duplicates'] = str(
+                sum(count - 1 for statement, count, origin in profile.duplicates()))
+            response.headers['X-Template-Time'] = '%.1f' % (profile.template_time * 1000)
+            response.headers['X-Request-Time'] = '%.1f' % (profile.duration * 1000)
+            if profile.caches:
+                response.headers['X-Cache'] = ','.join(
+                    '%s=%d/%d' % (name, hits, hits + misses)
+                    for name, (hits, misses) in sorted(profile.caches.items()))
+
+    def _log(self, profile):
+        if profile.duration >= self.slow_request:
+            logger.warning('slow request %s %s: %.1fms, %d queries, db %.1fms, template %.1fms',
+                           profile.method, profile.path, profile.duration * 1000,
+                           len(profile.queries), profile.db_time * 1000,
+                           profile.template_time * 1000)
+        for statement, count, origin in profile.duplicates():
+            logger.info('%s %s: query executed %d times at %s: %s',
+                        profile.method, profile.path, count, origin, statement)
+
+    def query_executed(self, profile, statement, duration):
+        profile.record_query(statement, duration, self.root_path)
+        if duration >= self.slow_query:
+            logger.warning('slow query %.1fms in %s %s: %s',
+                           duration * 1000, profile.method, profile.path, statement)
+            with self._lock:
+                self.slow_queries.append((time.time(), profile.path, duration, statement))
+
+    def report(self, profiles=None):
+        """
+        按endpoint汇总请求
+        :param profiles: RequestProfile列表，默认最近的请求
+        :return: [{'endpoint', 'requests', 'avg_queries', 'avg_db_time', 'avg_duration',
+                  'cache_hit_ratio', 'duplicates'}]，按平均耗时从大到小；
+                 cache_hit_ratio 是所有缓存的命中率，没有查找过缓存时为None
+        """
+        if profiles is None:
+            with self._lock:
+                profiles = list(self.recent)
+        endpoints = {}
+        for profile in profiles:
+            endpoints.setdefault(profile.endpoint, []).append(profile)
+        rows = []
+        for endpoint, items in endpoints.items():
+            n = float(len(items))
+            totals = [profile.cache_totals() for profile in items]
+            lookups = sum(total for hits, total in totals)
+            rows.append({'endpoint': endpoint,
+                         'requests': len(items),
+                         'avg_queries': sum(len(p.queries) for p in items) / n,
+                         'avg_db_time': sum(p.db_time for p in items) / n,
+                         'avg_template_time': sum(p.template_time for p in items) / n,
+                         'avg_duration': sum(p.duration for p in items) / n,
+                         'cache_hit_ratio': float(sum(hits for hits, total in totals)) / lookups
+                         if lookups else None,
+                         'duplicates': max(len(p.duplicates()) for p in items)})
+        return sorted(rows, key=lambda row: row['avg_duration'], reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self.recent.clear()
+            self.slow_queries.clear()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_profile() is not None:
+        conn.info.setdefault('profiler_start', []).append(time.time())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = current_profile()
+    starts = conn.info.get('profiler_start')
+    if profile is None or not starts:
+        return
+    g.sql_profiler.query_executed(profile, statement, time.time() - starts.pop())
@@ -0,0 +1,480 @@
+# -*- coding:utf-8 -*-
+"""
+meal 的全文搜索
+
+搜索 Meal.name 和 Meal.description（去掉HTML标签），名字里的词权重更高，结果按相关度排序，
+可以按zipcode（配送的zipcode，通常是客户zipcode附近的几个）、日期窗口和是否被推荐过滤。
+最后一个英文词按前缀匹配（至少 SEARCH_MIN_PREFIX 个字母），输入框可以边输入边提示。
+
+分词在Python里完成，三种后端使用同样的词：英文和数字按连续的字母数字切分并转成小写，
+中文没有空格，每个汉字和相邻的两个汉字都作为词，查询时中文按相邻的两个字匹配，
+“宫保鸡”会匹配“宫保鸡丁”。
+
+SEARCH_BACKEND 选择索引保存在哪里，None 时按数据库自动选择：
+- fts5：sqlite 的 FTS5 虚拟表 meal_fts，bm25 排序
+- postgres：meal_search 表的 tsvector 列和 GIN 索引，ts_rank 排序
+- memory：进程内的倒排索引，第一次搜索时从 meal 表建立，其他数据库使用；
+  每个进程各有一份，多进程部署时其他进程看不到修改，需要定期重启或者调用 MealSearch.reload
+也可以直接配置一个后端对象。
+
+索引表不在 models 里，也不由数据库迁移维护：第一次搜索时如果表不存在会自动建立并导入所有meal，
+python manage.py search_index 可以重建。chef.meal_create 和 chef.meal_edit 保存meal时调用
+MealSearch.update，和meal在同一个事务里更新索引；不经过这两个视图批量导入的meal（seed）需要重建索引。
+"""
+
+import heapq
+import logging
+import math
+import re
+import threading
+import time
+from bisect import bisect_left
+from HTMLParser import HTMLParser
+
+from sqlalchemy import event, select, table, column, literal_column, text
+
+from .database import RoutingSession
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'meal_search_pending'
+TAG = re.compile(r'<[^>]*>')
+WORD = re.compile(u'([a-z0-9]+)|([\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+)', re.U)
+NAME_WEIGHT = 5.0
+MAX_TERMS = 8
+
+_html = HTMLParser()
+
+
+def plain_text(html):
+    """去掉HTML标签和实体"""
+    if not html:
+        return u''
+    return _html.unescape(TAG.sub(u' ', html))
+
+
+def tokenize(text):
+    """
+    :return: 建立索引用的词列表，有重复
+    """
+    tokens = []
+    for word, han in WORD.findall(plain_text(text).lower()):
+        if word:
+            tokens.append(word)
+        else:
+            tokens.extend(han)
+            tokens.extend(han[i:i + 2] for i in xrange(len(han) - 1))
+    return tokens
+
+
+def parse_query(query, min_prefix=2):
+    """
+    :return: [(词, 是否前缀匹配)]，所有词都要匹配
+    """
+    query = query or u''
+    terms = []
+    matches = list(WORD.finditer(query.lower()))
+    for match in matches:
+        word, han = match.groups()
+        if word:
+            # 还在输入的最后一个词
+            prefix = match is matches[-1] and match.end() == len(query) and len(word) >= min_prefix
+            terms.append((word, prefix))
+        elif len(han) == 1:
+            terms.append((han, False))
+        else:
+            terms.extend((han[i:i + 2], False) for i in xrange(len(han) - 1))
+    unique = []
+    for term in terms:
+        if term not in unique:
+            unique.append(term)
+    return unique[:MAX_TERMS]
+
+
+def document(name, description):
+    """
+    :return: (名字的词, 描述的词)，用空格连接，写入 fts5/postgres 的索引表
+    """
+    return u' '.join(tokenize(name)), u' '.join(tokenize(description))
+
+
+class Fts5Backend(object):
+    """sqlite FTS5"""
+    name = 'fts5'
+    table = 'meal_fts'
+
+    def __init__(self, config):
+        pass
+
+    def exists(self, connection):
+        return connection.dialect.has_table(connection, self.table)
+
+    def create(self, connection):
+        # 词已经切分好了，unicode61按空格切分；prefix 建立2、3个字母的前缀索引
+        connection.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS meal_fts USING fts5("
+            "name, description, tokenize='unicode61 remove_diacritics 0', prefix='2 3')")
+
+    def clear(self, connection):
+        connection.execute('DELETE FROM meal_fts')
+
+    def write(self, executor, rows):
+        """
+        :param executor: session或者connection
+        :param rows: [(meal id, 名字的词, 描述的词)]
+        """
+        if not rows:
+            return
+        executor.execute(text('DELETE FROM meal_fts WHERE rowid = :id'),
+                         [{'id': id} for id, name, description in rows])
+        executor.execute(text('INSERT INTO meal_fts (rowid, name, description) '
+                              'VALUES (:id, :name, :description)'),
+                         [{'id': id, 'name': name, 'description': description}
+                          for id, name, description in rows])
+
+    def query(self, session, terms, candidates, limit, offset):
+        """
+        :param candidates: 符合过滤条件的meal id的select，None表示不过滤
+        :return: [(meal id, 分数)]，分数越大越相关
+        """
+        match = u' '.join(u'"%s"%s' % (term, u'*' if prefix else u'') for term, prefix in terms)
+        fts = table('meal_fts', column('rowid'))
+        # bm25 越小越相关
+        rank = literal_column('bm25(meal_fts, %s, 1.0)' % NAME_WEIGHT)
+        stmt = select([fts.c.rowid, rank.label('rank')]).select_from(fts) \
+            .where(text('meal_fts MATCH :match').bindparams(match=match)) \
+            .order_by(rank, fts.c.rowid).limit(limit).offset(offset)
+        if candidates is not None:
+            stmt = stmt.where(fts.c.rowid.in_(candidates))
+        return [(id, -score) for id, score in session.execute(stmt)]
+
+
+class PostgresBackend(object):
+    """postgres tsvector，名字的词权重A，描述的词权重B"""
+    name = 'postgres'
+    table = 'meal_search'
+
+    def __init__(self, config):
+        pass
+
+    def exists(self, connection):
+        return connection.dialect.has_table(connection, self.table)
+
+    def create(self, connection):
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS meal_search ('
+            'meal_id INTEGER PRIMARY KEY REFERENCES meal (id) ON DELETE CASCADE, '
+            'document TSVECTOR NOT NULL)')
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS ix_meal_search_document ON meal_search USING gin (document)')
+
+    def clear(self, connection):
+        connection.execute('DELETE FROM meal_search')
+
+    def write(self, executor, rows):
+        if not rows:
+            return
+        executor.execute(text('DELETE FROM meal_search WHERE meal_id = :id'),
+                         [{'id': id} for id, name, description in rows])
+        executor.execute(text("INSERT INTO meal_search (meal_id, document) VALUES (:id, "
+                              "setweight(to_tsvector('simple', :name), 'A') || "
+                              "setweight(to_tsvector('simple', :description), 'B'))"),
+                         [{'id': id, 'name': name, 'description': description}
+                          for id, name, description in rows])
+
+    def query(self, session, terms, candidates, limit, offset):
+        tsquery = u' & '.join(u"'%s'%s" % (term, u':*' if prefix else u'') for term, prefix in terms)
+        meal_id = literal_column('meal_id')
+        rank = literal_column('ts_rank(document, query)')
+        stmt = select([meal_id, rank.label('rank')]) \
+            .select_from(text("meal_search, to_tsquery('simple', :tsquery) AS query")
+                         .bindparams(tsquery=tsquery)) \
+            .where(text('document @@ query')) \
+            .order_by(rank.desc(), meal_id).limit(limit).offset(offset)
+        if candidates is not None:
+            stmt = stmt.where(meal_id.in_(candidates))
+        return [(id, score) for id, score in session.execute(stmt)]
+
+
+class MemoryBackend(object):
+    """
+    进程内的倒排索引 {词: {meal id: 权重}}，权重是词在名字里出现的次数乘以 NAME_WEIGHT
+    加上在描述里出现的次数，分数是 tf-idf；所有的词另外排好序，前缀查询用二分查找
+    """
+    name = 'memory'
+
+    def __init__(self, config):
+        self.loaded = False
+        self._postings = {}
+        self._documents = {}
+        self._words = []
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def exists(self, connection):
+        return self.loaded
+
+    def create(self, connection):
+        pass
+
+    def clear(self, connection=None):
+        with self._lock:
+            self._postings = {}
+            self._documents = {}
+            self._words = []
+            self.loaded = True
+
+    def write(self, executor, rows):
+        """session 提交之后才更新索引，回滚时丢弃；executor 是connection时（重建索引）立即更新"""
+        if isinstance(executor, RoutingSession):
+            executor.info.setdefault(PENDING, []).extend(rows)
+        else:
+            self.apply(rows)
+
+    def apply(self, rows):
+        with self._lock:
+            for id, name, description in rows:
+                self._remove(id)
+                weights = {}
+                for token in name.split():
+                    weights[token] = weights.get(token, 0) + NAME_WEIGHT
+                for token in description.split():
+                    weights[token] = weights.get(token, 0) + 1
+                for token, weight in weights.iteritems():
+                    postings = self._postings.get(token)
+                    if postings is None:
+                        postings = self._postings[token] = {}
+                        self._words.insert(bisect_left(self._words, token), token)
+                    postings[id] = weight
+                self._documents[id] = list(weights)
+
+    def _remove(self, id):
+        for token in self._documents.pop(id, ()):
+            postings = self._postings[token]
+            del postings[id]
+            if not postings:
+                del self._postings[token]
+                del self._words[bisect_left(self._words, token)]
+
+    def _expand(self, term, prefix):
+        if not prefix:
+            return [term] if term in self._postings else []
+        words = self._words
+        i = bisect_left(words, term)
+        expanded = []
+        while i < len(words) and words[i].startswith(term):
+            expanded.append(words[i])
+            i += 1
+        return expanded
+
+    def query(self, session, terms, candidates, limit, offset):
+        allowed = None
+        if candidates is not None:
+            allowed = set(id for id, in session.execute(candidates))
+        with self._lock:
+            total = len(self._documents)
+            expanded = []
+            for term, prefix in terms:
+                tokens = [(self._postings[token], math.log(1.0 + float(total) / len(self._postings[token])))
+                          for token in self._expand(term, prefix)]
+                if not tokens:
+                    return []
+                expanded.append((sum(len(postings) for postings, idf in tokens), tokens))
+            # 从匹配最少的词开始，后面的词只检查已经匹配的meal
+            expanded.sort(key=lambda item: item[0])
+            scores = None
+            for size, tokens in expanded:
+                # 前缀匹配的多个词取最高分
+                term_scores = {}
+                if scores is None:
+                    for postings, idf in tokens:
+                        for id, weight in postings.iteritems():
+                            if allowed is not None and id not in allowed:
+                                continue
+                            score = idf * weight
+                            if score > term_scores.get(id, 0):
+                                term_scores[id] = score
+                else:
+                    for id, score in scores.iteritems():
+                        best = 0
+                        for postings, idf in tokens:
+                            weight = postings.get(id)
+                            if weight is not None and idf * weight > best:
+                                best = idf * weight
+                        if best:
+                            term_scores[id] = score + best
+                scores = term_scores
+                if not scores:
+                    return []
+        ranked = heapq.nsmallest(offset + limit, scores.iteritems(),
+                                 key=lambda item: (-item[1], item[0]))
+        return ranked[offset:]
+
+
+BACKENDS = {
+    'fts5': Fts5Backend,
+    'postgres': PostgresBackend,
+    'memory': MemoryBackend,
+}
+
+
+def default_backend(engine):
+    """sqlite 编译了FTS5时用fts5，postgres用postgres，其他数据库用memory"""
+    if engine.dialect.name == 'postgresql':
+        return 'postgres'
+    if engine.dialect.name == 'sqlite':
+        with engine.connect() as connection:
+            options = [option for option, in connection.execute('PRAGMA compile_options')]
+        if 'ENABLE_FTS5' in options:
+            return 'fts5'
+    return 'memory'
+
+
+class MealSearch(object):
+    """meal 的全文搜索"""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.config = {}
+        self.min_prefix = 2
+        self.max_results = 100
+        self._ready = False
+        self._lock = threading.Lock()
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.config = app.config
+        self.min_prefix = app.config.get('SEARCH_MIN_PREFIX', 2)
+        self.max_results = app.config.get('SEARCH_MAX_RESULTS', 100)
+        self.backend = None
+        self._ready = False
+        app.extensions['meal_search'] = self
+        if not self._listening:
+            self._listening = True
+            event.listen(RoutingSession, 'after_commit', self._after_commit)
+            event.listen(RoutingSession, 'after_rollback', self._after_rollback)
+
+    def _after_commit(self, session):
+        rows = session.info.pop(PENDING, None)
+        if rows and isinstance(self.backend, MemoryBackend):
+            self.backend.apply(rows)
+
+    def _after_rollback(self, session):
+        session.info.pop(PENDING, None)
+
+    def _backend(self):
+        """第一次使用时按数据库选择后端，需要app context"""
+        if self.backend is None:
+            from . import db
+            backend = self.config.get('SEARCH_BACKEND') or default_backend(db.engine)
+            if isinstance(backend, basestring):
+                backend = BACKENDS[backend](self.config)
+            self.backend = backend
+        return self.backend
+
+    def _ensure_ready(self, connection=None):
+        """
+        第一次使用时如果索引表不存在，建立并导入所有meal
+        :param connection: 在这个连接的事务里建立，默认用主库的一个新事务
+        """
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    from . import db
+                    backend = self._backend()
+                    if connection is None:
+                        # 建表和导入写主库，不使用只读副本
+                        with db.engine.begin() as connection:
+                            if not backend.exists(connection):
+                                self.reload(connection)
+                    elif not backend.exists(connection):
+                        self.reload(connection)
+                    self._ready = True
+
+    def reload(self, connection=None):
+        """
+        重建索引表并导入所有meal，需要app context
+        :param connection: 在这个连接的事务里重建，默认用主库的一个新事务
+        :return: 导入的meal数
+        """
+        from . import db
+        from .models import Meal
+        if connection is None:
+            with db.engine.begin() as connection:
+                return self.reload(connection)
+        backend = self._backend()
+        start = time.time()
+        count = 0
+        backend.create(connection)
+        backend.clear(connection)
+        meals = connection.execute(select([Meal.id, Meal.name, Meal.description]))
+        for batch in iter(lambda: meals.fetchmany(1000), []):
+            backend.write(connection, [(id,) + document(name, description)
+                                       for id, name, description in batch])
+            count += len(batch)
+        logger.info('meal search (%s): %d meals indexed in %.0fms',
+                    backend.name, count, (time.time() - start) * 1000)
+        return count
+
+    def update(self, session, meal):
+        """
+        新建或者修改了名字、描述的meal，和session在同一个事务里更新索引
+        :param meal: 已经flush、有id的Meal
+        """
+        from . import db
+        self._ensure_ready(session.connection(bind=db.engine))
+        self._backend().write(session, [(meal.id,) + document(meal.name, meal.description)])
+
+    def search_ids(self, query, zipcodes=None, begin=None, end=None, selected=None,
+                   limit=20, offset=0):
+        """
+        :param query: 用户输入的字符串
+        :param zipcodes: 只要配送到这些zipcode的meal，None表示不过滤
+        :param begin: 只要配送日期窗口和 [begin, end] 有交集的meal，end默认等于begin
+        :param selected: True/False 只要被推荐/没有被推荐的meal，None表示不过滤
+        :param limit: 最多返回 SEARCH_MAX_RESULTS 个
+        :return: [(meal id, 分数)]，按相关度从高到低
+        """
+        from .models import Meal
+        terms = parse_query(query, self.min_prefix)
+        if not terms:
+            return []
+        if zipcodes is not None:
+            zipcodes = list(zipcodes)
+            if not zipcodes:
+                return []
+        self._ensure_ready()
+        from . import db
+        candidates = Meal.search_filter(zipcodes, begin, end, selected)
+        if candidates is not None:
+            candidates = candidates.statement
+        limit = max(min(limit, self.max_results), 0)
+        return self._backend().query(db.session, terms, candidates, limit, max(offset, 0))
+
+    def search(self, query, zipcodes=None, begin=None, end=None, selected=None,
+               limit=20, offset=0):
+        """
+        参数同 search_ids
+        :return: meal dict的列表（id、name、description、chef_id、is_selected、score），按相关度从高到低
+        """
+        from . import db
+        from .models import Meal
+        ranked = self.search_ids(query, zipcodes, begin, end, selected, limit, offset)
+        if not ranked:
+            return []
+        rows = db.session.query(Meal.id, Meal.name, Meal.description,
+                                Meal.chef_id, Meal.is_selected) \
+            .filter(Meal.id.in_([id for id, score in ranked]))
+        meals = dict((row.id, row) for row in rows)
+        results = []
+        for id, score in ranked:
+            meal = meals.get(id)
+            if meal is not None:
+                results.append({'id': id, 'name': meal.name, 'description': meal.description,
+                                'chef_id': meal.chef_id, 'is_selected': meal.is_selected,
+                                'score': round(score, 4)})
+        return results
@@ -0,0 +1,254 @@
+# -*- coding:utf-8 -*-
+"""
+生成压测用的大规模数据
+
+Seeder 批量插入用户、角色、zipcode、meal、MealZipcode 日期窗口和订单：不创建ORM对象，
+每行是一个tuple，由 Core 编译好的 INSERT 语句直接交给 DBAPI 的 executemany，省掉每行的参数处理；
+每 batch_size 行一个事务，数据在生成器里逐批产生，内存占用与总行数无关；插入前删除表上的索引，
+插入完成后再建，比逐行维护索引快得多。随机数由 seed 决定，相同的参数总是生成相同的数据。
+
+分布：
+- 用户：1号是管理员，前 chef_ratio 的用户是大厨，其余是客户；密码都是 SEED_PASSWORD
+- meal：随机属于某个大厨，selected_ratio 的meal被推荐，每个meal有 windows 个zipcode日期窗口，
+  窗口从今天偏移 window_start 天开始，持续 window_days 天，窗口之间可以重叠
+- zipcode 和 meal 的热门程度服从 Zipf 分布（zipcode_skew、meal_skew，0表示均匀）：
+  热门zipcode上的meal多，热门meal的订单多
+- 订单：下单时间均匀分布在最近 order_days 天内，状态按 statuses 的权重；插入后重建订单统计（analytics.py）
+
+入口是 python manage.py seed，见 manage.py。
+"""
+
+import bisect
+import datetime
+import itertools
+import time
+from collections import OrderedDict
+
+from werkzeug.security import generate_password_hash
+
+from .analytics import rebuild
+from .models import User, Role, roles_users, Zipcode, Meal, MealZipcode, Order, OrderDailyStats
+
+SEED_PASSWORD = 'bench'
+ADMIN_EMAIL = 'admin@bench.local'
+
+DEFAULTS = OrderedDict([
+    ('users', 100000),
+    ('chef_ratio', 0.05),
+    ('zipcodes', 2000),
+    ('meals', 50000),
+    ('selected_ratio', 0.5),
+    ('windows', (1, 5)),
+    ('window_start', (-30, 7)),
+    ('window_days', (0, 30)),
+    ('zipcode_skew', 1.0),
+    ('meal_skew', 1.0),
+    ('orders', 1000000),
+    ('order_days', 180),
+    ('statuses', OrderedDict([('UNHANDLED', 1), ('HANDLED', 2),
+                              ('COMPLETED', 6), ('CANCELED', 1)])),
+])
+
+
+def user_email(i):
+    return 'user%d@bench.local' % i
+
+
+def zipf_weights(n, skew):
+    """
+    :param n: 元素个数
+    :param skew: Zipf指数，0表示均匀分布
+    :return: 第k个元素的权重 1/k^skew
+    """
+    return [1.0 / (k ** skew) for k in range(1, n + 1)]
+
+
+class WeightedChoice(object):
+    """按权重随机选择，每次选择是一次二分查找"""
+
+    def __init__(self, items, weights, rng):
+        self.items = list(items)
+        self.cumulative = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self.cumulative.append(total)
+        self.total = total
+        self.rng = rng
+
+    def __call__(self):
+        return self.items[bisect.bisect_right(self.cumulative, self.rng.random() * self.total)]
+
+
+class Seeder(object):
+    """批量生成数据，参数见DEFAULTS"""
+
+    def __init__(self, engine, rng, batch_size=10000, **options):
+        self.engine = engine
+        self.rng = rng
+        self.batch_size = batch_size
+        self.options = OrderedDict(DEFAULTS)
+        self.options.update((key, value) for key, value in options.items() if value is not None)
+        self.timings = OrderedDict()
+
+    def run(self):
+        """
+        :return: OrderedDict {表名: (行数, 秒数)}
+        """
+        with self.engine.connect() as conn:
+            if conn.dialect.name == 'sqlite':
+                # 生成的数据随时可以重建，不需要每个事务都fsync
+                conn.execute('PRAGMA synchronous=OFF')
+                conn.execute('PRAGMA journal_mode=MEMORY')
+            self._insert(conn, Role.__table__, ('id', 'name'), self.roles())
+            self._insert(conn, User.__table__, ('id', 'nickname', 'email', 'password_hash'),
+                         self.users())
+            self._insert(conn, roles_users, ('user_id', 'role_id'), self.user_roles())
+            self._insert(conn, Zipcode.__table__, ('id', 'zipcode'), self.zipcodes())
+            self._insert(conn, Meal.__table__,
+                         ('id', 'name', 'description', 'is_selected', 'chef_id', 'create_date'),
+                         self.meals())
+            self._insert(conn, MealZipcode.__table__,
+                         ('meal_id', 'zipcode_id', 'begin_date', 'end_date'),
+                         self.meal_zipcodes())
+            self._insert(conn, Order.__table__,
+                         ('id', 'meal_id', 'zip_id', 'create_date', 'update_date', 'client_id',
+                          'chef_id', 'address', 'phone', 'status'),
+                         self.orders())
+            start = time.time()
+            rows = sum(count for first, last, count in rebuild(conn, chunk_days=31))
+            self.timings[OrderDailyStats.__tablename__] = (rows, time.time() - start)
+        return self.timings
+
+    def _insert(self, conn, table, columns, rows):
+        """
+        :param columns: 列名，rows中每个tuple的顺序，和表中列的顺序一致时不需要重新排列
+        :param rows: tuple的iterator
+        """
+        start = time.time()
+        compiled = table.insert().compile(dialect=conn.dialect, column_keys=columns)
+        # 有默认值的列即使不在columns里也会出现在INSERT里，只支持常量默认值
+        extra = tuple(key for key in compiled.params if key not in columns)
+        defaults = tuple(self._default(table.c[key]) for key in extra)
+        keys = columns + extra
+        if compiled.positional:
+            order = [keys.index(key) for key in compiled.positiontup]
+            if defaults or order != range(len(columns)):
+                rows = (tuple((row + defaults)[i] for i in order) for row in rows)
+        else:
+            rows = (dict(zip(keys, row + defaults)) for row in rows)
+        indexes = list(table.indexes)
+        for index in indexes:
+            index.drop(conn)
+        cursor = conn.connection.cursor()
+        count = 0
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                break
+            with conn.begin():
+                cursor.executemany(str(compiled), batch)
+            count += len(batch)
+        cursor.close()
+        for index in indexes:
+            index.create(conn)
+        self.timings[table.name] = (count, time.time() - start)
+
+    @staticmethod
+    def _default(column):
+        default = column.default
+        return default.arg if default is not None and default.is_scalar else None
+
+    @property
+    def n_users(self):
+        return max(self.options['users'], 3)
+
+    @property
+    def n_chefs(self):
+        return max(int(self.n_users * self.options['chef_ratio']), 1)
+
+    def roles(self):
+        return iter([(1, 'user'), (2, 'superuser'), (3, 'chef')])
+
+    def users(self):
+        password_hash = generate_password_hash(SEED_PASSWORD)
+        yield 1, 'admin', ADMIN_EMAIL, password_hash
+        for i in xrange(2, self.n_users + 1):
+            yield i, 'user%d' % i, user_email(i), password_hash
+
+    def user_roles(self):
+        yield 1, 2
+        for i in xrange(1, self.n_users + 1):
+            yield i, 1
+        # 管理员也是大厨
+        for i in xrange(1, self.n_chefs + 2):
+            yield i, 3
+
+    def zipcodes(self):
+        for i in xrange(1, self.options['zipcodes'] + 1):
+            yield i, '%05d' % (10000 + i)
+
+    def meals(self):
+        rng = self.rng
+        chefs = self.n_chefs
+        selected_ratio = self.options['selected_ratio']
+        now = datetime.datetime.now().replace(microsecond=0)
+        self.meal_chef = [None]
+        for i in xrange(1, self.options['meals'] + 1):
+            chef_id = rng.randint(2, chefs + 1)
+            self.meal_chef.append(chef_id)
+            yield i, 'meal %d' % i, 'seed meal %d' % i, rng.random() < selected_ratio, chef_id, now
+
+    def meal_zipcodes(self):
+        rng = self.rng
+        n_zipcodes = self.options['zipcodes']
+        # 热门程度与id无关
+        ranked = range(1, n_zipcodes + 1)
+        rng.shuffle(ranked)
+        choose_zipcode = WeightedChoice(
+            ranked, zipf_weights(n_zipcodes, self.options['zipcode_skew']), rng)
+        low, high = self.options['windows']
+        start_low, start_high = self.options['window_start']
+        days_low, days_high = self.options['window_days']
+        today = datetime.date.today()
+        day = datetime.timedelta(days=1)
+        self.meal_zips = [None]
+        for meal_id in xrange(1, self.options['meals'] + 1):
+            # 每个meal至少有一个窗口，订单才有zipcode可选
+            k = min(max(rng.randint(low, high), 1), n_zipcodes)
+            zip_ids = set()
+            while len(zip_ids) < k:
+                zip_ids.add(choose_zipcode())
+            zip_ids = sorted(zip_ids)
+            self.meal_zips.append(zip_ids)
+            for zip_id in zip_ids:
+                begin = today + rng.randint(start_low, start_high) * day
+                yield meal_id, zip_id, begin, begin + rng.randint(days_low, days_high) * day
+
+    def orders(self):
+        rng = self.rng
+        n_meals = self.options['meals']
+        ranked = range(1, n_meals + 1)
+        rng.shuffle(ranked)
+        choose_meal = WeightedChoice(ranked, zipf_weights(n_meals, self.options['meal_skew']), rng)
+        statuses = self.options['statuses']
+        choose_status = WeightedChoice(statuses.keys(), statuses.values(), rng)
+        first_client, last_client = self.n_chefs + 2, self.n_users
+        if first_client > last_client:
+            first_client = 2
+        clients = last_client - first_client + 1
+        meal_chef = self.meal_chef
+        meal_zips = self.meal_zips
+        random = rng.random
+        # 下单时间精确到分钟，预先生成所有可能的时间
+        now = datetime.datetime.now().replace(second=0, microsecond=0)
+        minutes = [now - datetime.timedelta(minutes=m)
+                   for m in xrange(self.options['order_days'] * 1440)]
+        n_minutes = len(minutes)
+        for i in xrange(1, self.options['orders'] + 1):
+            meal_id = choose_meal()
+            zips = meal_zips[meal_id]
+            create_date = minutes[int(random() * n_minutes)]
+            yield (i, meal_id, zips[int(random() * len(zips))], create_date, create_date,
+                   first_client + int(random() * clients), meal_chef[meal_id],
+                   '%d Seed Street' % i, '555%07d' % (i % 10000000), choose_status())
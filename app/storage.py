@@ -0,0 +1,369 @@
+# -*- coding:utf-8 -*-
+"""
+文件存储
+
+Storage 扩展负责上传文件的保存和下载，具体存储由后端实现，配置 STORAGE_BACKEND 选择：
+
+- s3: Amazon S3。每个上传线程缓存一个boto连接和bucket句柄，bucket只在第一次使用时
+  检查/创建；超过 S3_MULTIPART_CHUNK 的文件用multipart分块上传。
+  配置 S3_HOST/S3_PORT/S3_SECURE 可以指向本地的S3替代服务，例如 moto_server -p 5000。
+- local: 保存在 STORAGE_ROOT 目录下。下载整个文件用 send_file（USE_X_SENDFILE 时交给
+  nginx/apache，否则由 wsgi.file_wrapper 发送，gunicorn 等会使用 sendfile），Range请求
+  通过mmap分块返回，都不会把整个文件读进内存。
+- memory: 保存在进程内存中，用于测试。
+
+上传时直接从文件对象读取，多个文件由固定大小的线程池（STORAGE_UPLOAD_THREADS）同时保存。
+"""
+
+import datetime
+import errno
+import hashlib
+import logging
+import math
+import mimetypes
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+
+import boto
+from boto.exception import BotoClientError, BotoServerError
+from boto.s3.connection import OrdinaryCallingFormat
+from boto.s3.key import Key
+from flask import request, redirect, send_file, safe_join, abort, Response
+from werkzeug.exceptions import NotFound
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+def file_size(fileobj):
+    """
+    文件对象从当前位置到结尾的字节数，不读取内容
+    :param fileobj: 可以seek的文件对象
+    :return: 字节数
+    """
+    position = fileobj.tell()
+    fileobj.seek(0, 2)
+    size = fileobj.tell()
+    fileobj.seek(position)
+    return size - position
+
+
+def guess_mimetype(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def partial_response(data, length, name, etag, close=None):
+    """
+    按请求的Range返回一段内容
+    :param data: 支持切片的内容，比如mmap或者str
+    :param length: 内容总长度
+    :param name: 文件名，用来猜测mimetype
+    :param etag: 内容的etag，If-Range不匹配时返回None
+    :param close: 响应结束时调用
+    :return: 206响应，请求没有可以满足的单个Range时返回None
+    """
+    if request.range is None:
+        return None
+    if_range = request.headers.get('If-Range')
+    if if_range and if_range.strip('"') != etag:
+        return None
+    content_range = request.range.make_content_range(length)
+    if content_range is None:
+        return None
+    start, stop = content_range.start, content_range.stop
+
+    def generate():
+        try:
+            for offset in xrange(start, stop, CHUNK_SIZE):
+                yield data[offset:min(offset + CHUNK_SIZE, stop)]
+        finally:
+            if close is not None:
+                close()
+
+    response = Response(generate(), 206, mimetype=guess_mimetype(name),
+                        direct_passthrough=True)
+    response.headers['Content-Range'] = content_range.to_header()
+    response.headers['Content-Length'] = stop - start
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(etag)
+    return response
+
+
+class StorageBackend(object):
+    """存储后端接口"""
+
+    def save(self, fileobj, name, size):
+        """
+        保存文件
+        :param fileobj: 文件对象，从当前位置读到结尾
+        :param name: 文件的key，比如 chef_apply_files/2015-11-01-00-00-00-a.pdf
+        :param size: 文件大小
+        """
+        raise NotImplementedError
+
+    def delete(self, name):
+        raise NotImplementedError
+
+    def url(self, name):
+        """
+        :return: 可以直接访问的公开地址，没有时返回None，由 send 提供下载
+        """
+        return None
+
+    def send(self, name):
+        """
+        :return: 下载文件的响应
+        """
+        raise NotImplementedError
+
+
+class S3Backend(StorageBackend):
+    """Amazon S3"""
+
+    def __init__(self, config):
+        self.access_key = config.get('AWS_ACCESS_KEY_ID')
+        self.secret_key = config.get('AWS_SECRET_ACCESS_KEY')
+        self.bucket_name = config.get('S3_BUCKET', 'threemealbucket')
+        self.host = config.get('S3_HOST')
+        self.port = config.get('S3_PORT')
+        self.secure = config.get('S3_SECURE', True)
+        self.chunk_size = config.get('S3_MULTIPART_CHUNK', 5 * 1024 * 1024)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._bucket_ready = False
+
+    def _connect(self):
+        kwargs = {}
+        if self.host:
+            # 本地替代服务不支持 bucket.host 形式的虚拟主机地址
+            kwargs.update(host=self.host, port=self.port, is_secure=self.secure,
+                          calling_format=OrdinaryCallingFormat())
+        return boto.connect_s3(self.access_key, self.secret_key, **kwargs)
+
+    @property
+    def bucket(self):
+        """当前线程的bucket句柄，连接在线程内重复使用"""
+        bucket = getattr(self._local, 'bucket', None)
+        if bucket is None:
+            connection = self._connect()
+            with self._lock:
+                if not self._bucket_ready:
+                    if connection.lookup(self.bucket_name) is None:
+                        connection.create_bucket(self.bucket_name)
+                    self._bucket_ready = True
+            bucket = connection.get_bucket(self.bucket_name, validate=False)
+            self._local.bucket = bucket
+        return bucket
+
+    def _reset(self):
+        bucket = getattr(self._local, 'bucket', None)
+        if bucket is not None:
+            bucket.connection.close()
+        self._local.bucket = None
+
+    def save(self, fileobj, name, size):
+        try:
+            if size <= self.chunk_size:
+                key = Key(self.bucket, name)
+                key.set_contents_from_file(fileobj, size=size, rewind=False)
+            else:
+                self._save_multipart(fileobj, name, size)
+        except (BotoClientError, BotoServerError):
+            self._reset()
+            raise
+
+    def _save_multipart(self, fileobj, name, size):
+        upload = self.bucket.initiate_multipart_upload(name)
+        try:
+            parts = int(math.ceil(float(size) / self.chunk_size))
+            for part in range(1, parts + 1):
+                upload.upload_part_from_file(
+                    fileobj, part, size=min(self.chunk_size, size - (part - 1) * self.chunk_size))
+            upload.complete_upload()
+        except Exception:
+            upload.cancel_upload()
+            raise
+
+    def delete(self, name):
+        self.bucket.delete_key(name)
+
+    def url(self, name):
+        return Key(self.bucket, name).generate_url(expires_in=0, query_auth=False,
+                                                   force_http=True)
+
+    def send(self, name):
+        return redirect(self.url(name))
+
+
+class LocalBackend(StorageBackend):
+    """保存在本地目录"""
+
+    def __init__(self, config):
+        self.root = config['STORAGE_ROOT']
+
+    def path(self, name):
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        try:
+            return safe_join(self.root, name)
+        except NotFound:
+            raise ValueError('invalid file name: %r' % name)
+
+    def save(self, fileobj, name, size):
+        path = self.path(name)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # 先写临时文件再改名，下载时不会读到写了一半的文件
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(fileobj, f, CHUNK_SIZE)
+            os.rename(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def send(self, name):
+        path = self.path(name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            abort(404)
+        etag = 'local-%d-%d' % (stat.st_mtime, stat.st_size)
+        if stat.st_size and request.range is not None:
+            with open(path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            response = partial_response(data, stat.st_size, name, etag, close=data.close)
+            if response is not None:
+                return response
+            data.close()
+        response = send_file(path, mimetype=guess_mimetype(name), add_etags=False)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.set_etag(etag)
+        return response.make_conditional(request)
+
+
+class MemoryBackend(StorageBackend):
+    """保存在进程内存中"""
+
+    def __init__(self, config=None):
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def save(self, fileobj, name, size):
+        data = fileobj.read(size)
+        with self._lock:
+            self.files[name] = (data, hashlib.md5(data).hexdigest(), datetime.datetime.utcnow())
+
+    def delete(self, name):
+        with self._lock:
+            self.files.pop(name, None)
+
+    def send(self, name):
+        if name not in self.files:
+            abort(404)
+        data, etag, last_modified = self.files[name]
+        response = partial_response(data, len(data), name, etag)
+        if response is None:
+            response = Response(data, mimetype=guess_mimetype(name))
+            response.headers['Accept-Ranges'] = 'bytes'
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response = response.make_conditional(request)
+        return response
+
+
+BACKENDS = {
+    's3': S3Backend,
+    'local': LocalBackend,
+    'memory': MemoryBackend,
+}
+
+
+class Storage(object):
+    """上传文件存储，后端由 STORAGE_BACKEND 选择"""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.max_size = None
+        self.threads = 4
+        self._pool = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config.get('STORAGE_BACKEND') or 's3'
+        if isinstance(backend, basestring):
+            backend = BACKENDS[backend](app.config)
+        self.backend = backend
+        self.max_size = app.config.get('MAX_CONTENT_LENGTH')
+        self.threads = app.config.get('STORAGE_UPLOAD_THREADS', 4)
+        app.extensions['storage'] = self
+
+    def save(self, fileobj, name):
+        """
+        保存一个文件
+        :param fileobj: 可以seek的文件对象，从当前位置读到结尾
+        :param name: 文件的key
+        """
+        size = file_size(fileobj)
+        if self.max_size is not None and size >= self.max_size:
+            raise FileTooLarge(name)
+        self.backend.save(fileobj, name, size)
+
+    def _save_one(self, args):
+        fileobj, name = args
+        try:
+            self.save(fileobj, name)
+        except FileTooLarge as e:
+            return e
+        except (BotoClientError, BotoServerError, EnvironmentError, ValueError) as e:
+            logger.warning('save %s failed: %s', name, e)
+            return e
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.threads)
+        return self._pool
+
+    def save_many(self, files):
+        """
+        用线程池同时保存多个文件
+        :param files: (文件对象, key) 列表
+        :return: 与files顺序一致的异常列表，保存成功的为None
+        """
+        if len(files) == 1:
+            return [self._save_one(files[0])]
+        return self.pool.map(self._save_one, files)
+
+    def delete(self, name):
+        self.backend.delete(name)
+
+    def url(self, name):
+        return self.backend.url(name)
+
+    def send(self, name):
+        return self.backend.send(name)
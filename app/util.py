@@ -1,5 +1,5 @@
 # -*- coding:utf-8 -*-
-from flask import flash
+from flask import flash, current_app, request, url_for
 
 
 def flash_errors(form, dest='error'):
@@ -8,4 +8,101 @@ def flash_errors(form, dest='error'):
             flash(u"%s 字段 - %s" % (
                 getattr(form, field).label.text,
                 error
-            ), dest)
\ No newline at end of file
+            ), dest)
+
+
+class KeysetPage(object):
+    """
+    keyset分页的一页数据
+    :param param: 翻页用的查询参数，keyset_paginate是before，ranked_paginate是offset
+    """
+
+    def __init__(self, items, cursor, next_cursor, param='before'):
+        self.items = items
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        self.param = param
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def next_url(self):
+        return self._url(**{self.param: self.next_cursor}) if self.has_next else None
+
+    @property
+    def first_url(self):
+        return self._url(**{self.param: None}) if self.cursor else None
+
+    @staticmethod
+    def _url(**kwargs):
+        args = request.args.to_dict()
+        args.update(request.view_args or {})
+        args.update(kwargs)
+        args = dict((key, value) for key, value in args.items() if value is not None)
+        return url_for(request.endpoint, **args)
+
+
+def page_size(per_page=None):
+    """每页条数，默认取request.args['per_page']，在 1 到 THREEMEAL_MAX_PER_PAGE 之间"""
+    if per_page is None:
+        per_page = request.args.get('per_page', type=int)
+    return max(1, min(per_page or current_app.config['THREEMEAL_PER_PAGE'],
+                      current_app.config['THREEMEAL_MAX_PER_PAGE']))
+
+
+def keyset_paginate(query, column, cursor=None, per_page=None):
+    """
+    按column倒序做keyset分页：WHERE column < cursor ORDER BY column DESC LIMIT per_page，
+    翻页的代价和页数无关
+    :param query: query对象，为None时返回空页
+    :param column: 唯一且有索引的列，比如Order.id
+    :param cursor: 上一页最后一行的column值，默认取request.args['before']
+    :param per_page: 每页条数，默认取request.args['per_page']，见 page_size
+    :return: KeysetPage
+    """
+    if cursor is None:
+        cursor = request.args.get('before', type=int)
+    per_page = page_size(per_page)
+    if query is None:
+        return KeysetPage([], cursor, None)
+    if cursor is not None:
+        query = query.filter(column < cursor)
+    items = query.order_by(None).order_by(column.desc()).limit(per_page + 1).all()
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        next_cursor = getattr(items[-1], column.key)
+    return KeysetPage(items, cursor, next_cursor)
+
+
+def ranked_paginate(query, column, rank, offset=None, per_page=None):
+    """
+    按rank给出的顺序（比如搜索的相关度）分页，不能按column做keyset，用 ?offset= 翻页
+    :param query: query对象，为None时返回空页
+    :param column: rank返回的id对应的列，比如Meal.id
+    :param rank: rank(limit, offset) 返回排好序的 [(id, 分数)]
+    :param offset: 跳过的条数，默认取request.args['offset']
+    :param per_page: 同keyset_paginate
+    :return: KeysetPage，next_cursor是下一页的offset
+    """
+    if offset is None:
+        offset = request.args.get('offset', type=int)
+    offset = max(offset or 0, 0)
+    per_page = page_size(per_page)
+    if query is None:
+        return KeysetPage([], offset, None, param='offset')
+    ranked = rank(per_page + 1, offset)
+    next_cursor = offset + per_page if len(ranked) > per_page else None
+    ids = [id for id, score in ranked[:per_page]]
+    rows = dict((getattr(row, column.key), row)
+                for row in query.filter(column.in_(ids)).all()) if ids else {}
+    items = [rows[id] for id in ids if id in rows]
+    return KeysetPage(items, offset, next_cursor, param='offset')
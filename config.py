@@ -9,13 +9,109 @@ class Config:
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
     MAIL_SUBJECT_PREFIX = '[Three Meal]'
     MAIL_SENDER = 'Three Meal Admin<admin@threemeal.com>'
+    # mail outbox workers, see app/email.py
+    MAIL_WORKERS = 2
+    MAIL_BATCH_SIZE = 20
+    MAIL_QUEUE_SIZE = 1000
+    MAIL_MAX_ATTEMPTS = 5
+    MAIL_RETRY_DELAY = 30  # seconds, doubled after every failed attempt
+    MAIL_POLL_INTERVAL = 10
+    MAIL_CLAIM_TIMEOUT = 300
+    MAIL_CONNECTION_IDLE = 30
     THREEMEAL_ADMIN = os.environ.get('THREEMEAL_ADMIN') or '550488300@qq.com'
     THREEMEAL_ADMIN_PWD = os.environ.get('THREEMEAL_ADMIN_PWD') or '123456'
     AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID')
     AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
     # s3 max file size
     MAX_CONTENT_LENGTH = 10 * 1024 * 1024  # 10MB max
+    # uploaded files, see app/storage.py: s3, local or memory
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND') or 's3'
+    STORAGE_ROOT = os.environ.get('STORAGE_ROOT') or os.path.join(basedir, 'uploads')
+    STORAGE_UPLOAD_THREADS = 4
+    # let nginx/apache send local files (X-Sendfile / X-Accel-Redirect)
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE') == '1'
+    # S3_HOST points at a local stand-in such as moto_server
+    S3_BUCKET = os.environ.get('S3_BUCKET') or 'threemealbucket'
+    S3_HOST = os.environ.get('S3_HOST')
+    S3_PORT = int(os.environ.get('S3_PORT') or 0) or None
+    S3_SECURE = os.environ.get('S3_SECURE', '1') == '1'
+    S3_MULTIPART_CHUNK = 5 * 1024 * 1024  # s3 minimum part size
     ALLOWED_EXTENSIONS = set(['txt', 'doc', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'zip'])
+    # client.menu cache, any werkzeug.contrib.cache backend, None for in-process SimpleCache
+    MENU_CACHE_BACKEND = None
+    MENU_CACHE_THRESHOLD = 5000
+    # login_manager.user_loader cache, roles are loaded along with the user
+    USER_CACHE_BACKEND = None
+    USER_CACHE_THRESHOLD = 5000
+    USER_CACHE_TIMEOUT = 60
+    # {% cache %} template fragments, see app/fragments.py
+    FRAGMENT_CACHE_ENABLED = True
+    FRAGMENT_CACHE_MAX_BYTES = 16 * 1024 * 1024
+    FRAGMENT_CACHE_TIMEOUT = 300  # seconds, bounds staleness across processes
+    # shared cache of anonymous pages, ETags, compression, see app/httpcache.py
+    HTTP_CACHE_ENABLED = True
+    HTTP_CACHE_BACKEND = None  # None for an in-process LRUCache of HTTP_CACHE_MAX_BYTES
+    HTTP_CACHE_MAX_BYTES = 32 * 1024 * 1024
+    HTTP_CACHE_TIMEOUT = 60  # seconds, bounds staleness across processes
+    HTTP_ETAGS = True
+    COMPRESS_ENABLED = True  # br needs the brotli package, gzip otherwise
+    COMPRESS_MIN_SIZE = 500  # bytes
+    COMPRESS_LEVEL = 6
+    COMPRESS_BROTLI_QUALITY = 5
+    COMPRESS_STATIC_MAX_BYTES = 8 * 1024 * 1024
+    STATIC_MAX_AGE = 365 * 24 * 3600  # seconds, static urls carry ?v=<md5>
+    # database engine, see app/database.py
+    # pool settings (SQLALCHEMY_POOL_SIZE etc.) only apply to postgres/mysql
+    SQLALCHEMY_POOL_PRE_PING = False
+    SQLALCHEMY_STATEMENT_TIMEOUT = None  # milliseconds
+    SQLALCHEMY_SQLITE_WAL = False
+    SQLALCHEMY_SQLITE_BUSY_TIMEOUT = 5000  # milliseconds
+    # read queries of @read_replica views go here
+    SQLALCHEMY_REPLICA_URI = os.environ.get('REPLICA_DATABASE_URL')
+    SQLALCHEMY_REPLICA_STICKY = 5  # seconds a browser reads the primary after writing
+    # request profiling, see app/profiler.py
+    PROFILER_ENABLED = os.environ.get('THREEMEAL_PROFILER') == '1'
+    PROFILER_HEADERS = True
+    PROFILER_SLOW_QUERY = 0.1  # seconds
+    PROFILER_SLOW_REQUEST = 0.5
+    PROFILER_HISTORY = 200
+    # chef order push (server-sent events), see app/feed.py: local or redis
+    ORDER_FEED_BROKER = os.environ.get('ORDER_FEED_BROKER') or 'local'
+    ORDER_FEED_REDIS_URL = os.environ.get('REDIS_URL') or 'redis://localhost:6379/0'
+    ORDER_FEED_QUEUE_SIZE = 100  # messages buffered per connection
+    ORDER_FEED_HEARTBEAT = 15  # seconds
+    ORDER_FEED_STREAM_TIMEOUT = 300  # seconds, browsers reconnect afterwards
+    # order notifications, see app/notify.py
+    NOTIFY_ENABLED = True
+    NOTIFY_ASYNC = True  # False: queued until notifier.flush(), for tests
+    NOTIFY_EMAIL_TRANSPORT = 'mail'  # mail or fake
+    NOTIFY_SMS_TRANSPORT = os.environ.get('NOTIFY_SMS_TRANSPORT') or 'log'  # log, twilio or fake
+    NOTIFY_BATCH_SIZE = 100
+    NOTIFY_BATCH_WINDOW = 2  # seconds to wait for more events before sending a batch
+    NOTIFY_QUEUE_SIZE = 10000
+    NOTIFY_DIGEST_INTERVAL = 15 * 60  # seconds, chefs with User.notify_digest
+    NOTIFY_RATE_LIMIT = 20  # notifications per recipient per NOTIFY_RATE_PERIOD
+    NOTIFY_RATE_PERIOD = 3600
+    TWILIO_ACCOUNT_SID = os.environ.get('TWILIO_ACCOUNT_SID')
+    TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
+    TWILIO_FROM = os.environ.get('TWILIO_FROM')
+    # nearby zipcodes, see app/geo.py; 0 matches the zipcode itself only
+    ZIPCODE_RADIUS = 5  # miles
+    ZIPCODE_NEARBY_LIMIT = 100
+    ZIPCODE_GRID_CELL = 0.1  # degrees
+    # meal search, see app/search.py: fts5, postgres, memory, None picks by database
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    SEARCH_MIN_PREFIX = 2  # letters before the last word is matched as a prefix
+    SEARCH_MAX_RESULTS = 100
+    SEARCH_SUGGEST_LIMIT = 8
+    # order analytics, see app/analytics.py
+    ANALYTICS_DAYS = 30  # default window of the dashboards
+    ANALYTICS_MAX_DAYS = 366
+    ANALYTICS_TOP = 10  # meals, zipcodes and chefs listed
+    ANALYTICS_REBUILD_CHUNK_DAYS = 7  # days recomputed per transaction
+    # list pages
+    THREEMEAL_PER_PAGE = 20
+    THREEMEAL_MAX_PER_PAGE = 100
 
     @staticmethod
     def init_app(app):
@@ -24,6 +120,7 @@ class Config:
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND') or 'local'
     MAIL_SERVER = 'smtp.googlemail.com'
     MAIL_PORT = 587
     MAIL_USE_TLS = True
@@ -35,18 +132,56 @@ class DevelopmentConfig(Config):
 
 class TestingConfig(Config):
     TESTING = True
+    # local SMTP stand-in: python -m smtpd -n -c DebuggingServer localhost:1025
+    MAIL_SERVER = 'localhost'
+    MAIL_PORT = int(os.environ.get('TEST_MAIL_PORT') or 1025)
+    MAIL_SUPPRESS_SEND = False
+    MAIL_RETRY_DELAY = 1
+    MAIL_POLL_INTERVAL = 1
+    # local S3 stand-in: moto_server -p 5000
+    S3_HOST = os.environ.get('TEST_S3_HOST') or 'localhost'
+    S3_PORT = int(os.environ.get('TEST_S3_PORT') or 5000)
+    S3_SECURE = False
+    AWS_ACCESS_KEY_ID = 'test'
+    AWS_SECRET_ACCESS_KEY = 'test'
+    STORAGE_BACKEND = 'memory'
+    NOTIFY_ASYNC = False
+    NOTIFY_EMAIL_TRANSPORT = 'fake'
+    NOTIFY_SMS_TRANSPORT = 'fake'
+    HTTP_CACHE_ENABLED = False
     SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URL') or \
         'sqlite:///'+os.path.join(basedir, 'data-TEST.sqlite')
 
 
+class BenchmarkConfig(TestingConfig):
+    """python manage.py bench, the database url is given on the command line"""
+    WTF_CSRF_ENABLED = False
+    MAIL_SUPPRESS_SEND = True
+    PROFILER_ENABLED = False
+    NOTIFY_ENABLED = False
+    HTTP_CACHE_ENABLED = True
+
+
 class ProductionConfig(Config):
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URL') or \
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
+        os.environ.get('DEV_DATABASE_URL') or \
         'sqlite:///'+os.path.join(basedir, 'data-TEST.sqlite')
+    # per process: gunicorn workers * (pool size + overflow) must stay below max_connections
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE') or 10)
+    SQLALCHEMY_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW') or 10)
+    SQLALCHEMY_POOL_TIMEOUT = 10
+    # below the server's idle timeout (mysql wait_timeout, pgbouncer server_idle_timeout)
+    SQLALCHEMY_POOL_RECYCLE = 1800
+    SQLALCHEMY_POOL_PRE_PING = True
+    SQLALCHEMY_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT') or 30000)
+    # single node on sqlite: readers don't block the writer
+    SQLALCHEMY_SQLITE_WAL = True
 
 
 config = {
     'development': DevelopmentConfig,
     'testing': TestingConfig,
     'production': ProductionConfig,
+    'benchmark': BenchmarkConfig,
     'default': DevelopmentConfig
 }
@@ -2,7 +2,8 @@
 # -*- coding:utf-8 -*-
 
 import os
-from flask_script import Manager
+import re
+from flask_script import Manager, Server
 from flask_migrate import Migrate, MigrateCommand
 from app import create_app, db
 
@@ -11,6 +12,8 @@ manager = Manager(app)
 migrate = Migrate(app, db)
 
 manager.add_command('db', MigrateCommand)
+# 大厨订单页的推送连接会一直占用一个线程
+manager.add_command('runserver', Server(threaded=True))
 
 
 @manager.command
@@ -30,5 +33,300 @@ def add_admin():
     db.session.add(admin)
     db.session.commit()
 
+
+@manager.command
+def mail_worker():
+    """发送mail_outbox里待发送的邮件，Ctrl-C退出"""
+    import time
+    from app.email import mail_workers
+    mail_workers.start(app)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mail_workers.stop(timeout=5)
+
+
+@manager.command
+def export_orders(fmt='csv', chef_id=None, zipcode=None, status=None,
+                  begin=None, end=None, output=None):
+    """导出订单为csv或者jsonl，begin/end格式YYYY-MM-DD，默认输出到stdout"""
+    import sys
+    from app.export import export_orders as export, parse_date
+    out = open(output, 'wb') if output else sys.stdout
+    try:
+        for chunk in export(fmt,
+                            chef_id=int(chef_id) if chef_id else None,
+                            zipcode=zipcode,
+                            status=status.upper() if status else None,
+                            begin=parse_date(begin),
+                            end=parse_date(end)):
+            out.write(chunk)
+    finally:
+        if output:
+            out.close()
+
+
+@manager.option('paths', nargs='+', help='e.g. /menu/94536 /chef/orders/all')
+@manager.option('-u', '--user-id', dest='user_id', type=int, default=None,
+                help='request as this user')
+@manager.option('-n', '--repeat', dest='repeat', type=int, default=1)
+def profile(paths, user_id=None, repeat=1):
+    """用test client请求页面，打印每个请求的查询数、耗时和重复查询"""
+    from flask_login import _create_identifier
+    from app import profiler
+    if not profiler.enabled:
+        profiler.enable(app)
+    profiler.clear()
+    with app.test_client() as client:
+        if user_id is not None:
+            with client.session_transaction() as session:
+                session['user_id'] = unicode(user_id)
+                session['_fresh'] = True
+                session['_id'] = _create_identifier()
+        for i in range(repeat):
+            for path in paths:
+                client.get(path)
+    for p in sorted(profiler.recent, key=lambda p: p.started):
+        print('%s %s -> %s  %d queries, db %.1fms, template %.1fms, total %.1fms' % (
+            p.method, p.path, p.status, len(p.queries), p.db_time * 1000,
+            p.template_time * 1000, p.duration * 1000))
+        for statement, count, origin in p.duplicates():
+            print('    x%d at %s: %s' % (count, origin, ' '.join(statement.split())))
+
+
+@manager.option('--users', dest='users', type=int, default=200)
+@manager.option('--zipcodes', dest='zipcodes', type=int, default=20)
+@manager.option('--meals', dest='meals', type=int, default=300)
+@manager.option('--windows', dest='windows', type=int, default=3,
+                help='zipcode date windows per meal')
+@manager.option('--orders', dest='orders', type=int, default=5000)
+@manager.option('-n', '--requests', dest='requests', type=int, default=100,
+                help='requests per scenario')
+@manager.option('--warmup', dest='warmup', type=int, default=10)
+@manager.option('-s', '--scenarios', dest='scenarios', default=None,
+                help='comma separated, e.g. client.menu,chef.orders')
+@manager.option('-d', '--database', dest='database', default=None,
+                help='database url, default a temporary sqlite file')
+@manager.option('--seed', dest='seed', type=int, default=42)
+@manager.option('-o', '--output', dest='output', default=None)
+def bench(users, zipcodes, meals, windows, orders, requests, warmup, scenarios,
+          database, seed, output):
+    """生成测试数据并压测主要页面，结果以json输出；数据库里已经有用户时不再生成数据"""
+    import json
+    import random
+    import sys
+    import tempfile
+    import time
+    from collections import OrderedDict
+    from app.bench import Benchmark
+    from app.seed import Seeder
+    from app.models import User, Zipcode, Meal, MealZipcode, Order
+    if requests < 1:
+        sys.exit('--requests must be at least 1')
+    bench_app = create_app('benchmark')
+    tmp = None
+    if database is None:
+        fd, tmp = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        database = 'sqlite:///' + tmp
+    bench_app.config['SQLALCHEMY_DATABASE_URI'] = database
+    try:
+        with bench_app.app_context():
+            db.create_all()
+            rng = random.Random(seed)
+            if User.query.first() is None:
+                Seeder(db.engine, rng, users=users, zipcodes=zipcodes, meals=meals,
+                       windows=(windows, windows), orders=orders).run()
+            volumes = OrderedDict((model.__tablename__, model.query.count())
+                                  for model in (User, Zipcode, Meal, MealZipcode, Order))
+            benchmark = Benchmark(bench_app, rng, requests=requests, warmup=warmup)
+            results = benchmark.run(scenarios.split(',') if scenarios else None)
+            report = OrderedDict([
+                ('started', time.strftime('%Y-%m-%dT%H:%M:%S')),
+                ('database', db.engine.dialect.name),
+                ('volumes', volumes),
+                ('requests', requests),
+                ('warmup', warmup),
+                ('seed', seed),
+                ('results', results),
+            ])
+    finally:
+        if tmp:
+            os.remove(tmp)
+    out = open(output, 'w') if output else sys.stdout
+    json.dump(report, out, indent=2, separators=(',', ': '))
+    out.write('\n')
+    if output:
+        out.close()
+
+
+def _range(value):
+    """'1-5' -> (1, 5)，'-30-7' -> (-30, 7)"""
+    low, high = re.match(r'^(-?\d+)-(-?\d+)$', value).groups()
+    return int(low), int(high)
+
+
+def _weights(value):
+    """'UNHANDLED=1,HANDLED=2' -> OrderedDict"""
+    from collections import OrderedDict
+    return OrderedDict((key.strip().upper(), float(weight)) for key, weight in
+                       (item.split('=') for item in value.split(',')))
+
+
+@manager.option('--users', dest='users', type=int, default=100000)
+@manager.option('--chef-ratio', dest='chef_ratio', type=float, default=0.05)
+@manager.option('--zipcodes', dest='zipcodes', type=int, default=2000)
+@manager.option('--meals', dest='meals', type=int, default=50000)
+@manager.option('--selected-ratio', dest='selected_ratio', type=float, default=0.5)
+@manager.option('--windows', dest='windows', type=_range, default='1-5',
+                help='zipcode date windows per meal, e.g. 1-5')
+@manager.option('--window-start', dest='window_start', type=_range, default='-30-7',
+                help='first day of a window relative to today')
+@manager.option('--window-days', dest='window_days', type=_range, default='0-30')
+@manager.option('--zipcode-skew', dest='zipcode_skew', type=float, default=1.0,
+                help='zipf exponent of zipcode popularity, 0 for uniform')
+@manager.option('--meal-skew', dest='meal_skew', type=float, default=1.0)
+@manager.option('--orders', dest='orders', type=int, default=1000000)
+@manager.option('--order-days', dest='order_days', type=int, default=180)
+@manager.option('--statuses', dest='statuses', type=_weights,
+                default='UNHANDLED=1,HANDLED=2,COMPLETED=6,CANCELED=1')
+@manager.option('--seed', dest='seed', type=int, default=42)
+@manager.option('--batch-size', dest='batch_size', type=int, default=10000)
+@manager.option('--drop', dest='drop', action='store_true', default=False,
+                help='drop and recreate all tables first')
+def seed(seed, batch_size, drop, **options):
+    """用批量插入生成大规模测试数据，相同的参数和--seed生成相同的数据"""
+    import random
+    from app.models import User
+    from app.seed import Seeder, SEED_PASSWORD, ADMIN_EMAIL
+    if drop:
+        db.drop_all()
+    db.create_all()
+    if User.query.first() is not None:
+        print('database %s is not empty, use --drop to recreate it' % db.engine.url)
+        return
+    db.session.remove()
+    seeder = Seeder(db.engine, random.Random(seed), batch_size=batch_size, **options)
+    for table, (count, seconds) in seeder.run().items():
+        print('%-14s %10d rows %8.1fs' % (table, count, seconds))
+    print('admin: %s, every password: %s' % (ADMIN_EMAIL, SEED_PASSWORD))
+
+
+@manager.option('-f', '--file', dest='path', default=None,
+                help='gzipped csv: zipcode,latitude,longitude,city,state')
+def load_zipcodes(path=None):
+    """导入zipcode中心点（默认 app/data/us_zipcodes.csv.gz），并测试附近zipcode的查询速度"""
+    import random
+    import time
+    from app import zipcode_index
+    from app.geo import load_dataset, DATASET
+    start = time.time()
+    count = load_dataset(db.session, path or DATASET)
+    print('zipcode_centroid: %d rows in %.1fs' % (count, time.time() - start))
+    zipcode_index.reload()
+    codes = random.Random(42).sample(list(zipcode_index._points), min(2000, count))
+    durations = []
+    for code in codes:
+        start = time.time()
+        zipcode_index.nearby(code)
+        durations.append((time.time() - start) * 1000)
+    durations.sort()
+    if durations:
+        print('nearby(radius=%s miles): p50 %.3fms, p99 %.3fms, max %.3fms' % (
+            zipcode_index.radius, durations[len(durations) // 2],
+            durations[int(len(durations) * 0.99)], durations[-1]))
+
+
+@manager.command
+def search_index():
+    """重建meal的搜索索引（seed等批量导入meal之后），并测试输入提示的查询速度"""
+    import random
+    import time
+    from app import meal_search
+    from app.models import Meal
+    start = time.time()
+    count = meal_search.reload()
+    print('meal search (%s): %d meals in %.1fs' % (meal_search.backend.name, count,
+                                                    time.time() - start))
+    rng = random.Random(42)
+    names = [name for name, in db.session.query(Meal.name).limit(1000) if name]
+    durations = []
+    for name in rng.sample(names, min(200, len(names))):
+        # 模拟输入了名字的前几个字
+        start = time.time()
+        meal_search.search_ids(name[:rng.randint(min(2, len(name)), len(name))])
+        durations.append((time.time() - start) * 1000)
+    durations.sort()
+    if durations:
+        print('search: p50 %.3fms, p99 %.3fms, max %.3fms' % (
+            durations[len(durations) // 2], durations[int(len(durations) * 0.99)], durations[-1]))
+
+
+@manager.option('--begin', dest='begin', default=None, help='first day, YYYY-MM-DD')
+@manager.option('--end', dest='end', default=None, help='last day, YYYY-MM-DD')
+@manager.option('--chunk-days', dest='chunk_days', type=int, default=None,
+                help='days recomputed per transaction')
+def analytics_rebuild(begin=None, end=None, chunk_days=None):
+    """从订单重建每日统计（order_daily_stats），默认所有订单，网站运行时也可以执行"""
+    import time
+    from app.analytics import rebuild, parse_date
+    start = time.time()
+    total = 0
+    with db.engine.connect() as conn:
+        for first, last, rows in rebuild(conn, begin and parse_date(begin), end and parse_date(end),
+                                         chunk_days or app.config['ANALYTICS_REBUILD_CHUNK_DAYS']):
+            total += rows
+            print('%s ~ %s: %d rows' % (first, last, rows))
+    print('order_daily_stats: %d rows in %.1fs' % (total, time.time() - start))
+
+
+@manager.command
+def explain(zipcode='94536', user_id=1):
+    """打印主要视图查询的执行计划"""
+    import datetime
+    from app.models import Order, Meal, MealZipcode, Zipcode, ChefApply
+    user_id = int(user_id)
+    today = datetime.date.today()
+    zip = Zipcode.query.filter_by(zipcode=zipcode).first()
+    zip_id = zip.id if zip else 0
+    queries = [
+        ('client.menu zipcode', Zipcode.query.filter_by(zipcode=zipcode)),
+        ('client.menu meals', db.session.query(Meal.id, Meal.name, Meal.description)
+            .filter(Meal.is_selected == True)
+            .filter(Meal.id == MealZipcode.meal_id)
+            .filter(MealZipcode.zipcode_id == zip_id)
+            .filter(MealZipcode.begin_date <= today)
+            .filter(MealZipcode.end_date >= today)),
+        ('chef.orders', Order.load_relations(Order.query.filter_by(chef_id=user_id)
+                                             .order_by(Order.id.desc()))),
+        ('client.orders', Order.load_relations(Order.query.filter_by(client_id=user_id)
+                                               .order_by(Order.id.desc()))),
+        ('chef.meal_list', Meal.query.filter_by(chef_id=user_id).order_by(Meal.id.desc())),
+        ('admin.meals zipcode', Meal.query.filter(Meal.id == MealZipcode.meal_id)
+            .filter(MealZipcode.zipcode_id == zip_id)),
+        ('chef.before_request apply', ChefApply.query.filter_by(applicant_id=user_id)),
+    ]
+    dialect = db.engine.dialect
+    prefix = 'EXPLAIN QUERY PLAN' if dialect.name == 'sqlite' else 'EXPLAIN'
+    for name, query in queries:
+        compiled = query.with_labels().statement.compile(dialect=dialect)
+        if compiled.positional:
+            params = tuple(compiled.params[key] for key in compiled.positiontup)
+        else:
+            params = compiled.params
+        print('== %s' % name)
+        for row in db.engine.execute('%s %s' % (prefix, compiled), params):
+            print('   ' + ' | '.join(str(column) for column in row))
+
+
+@manager.command
+def test():
+    """运行 tests/ 下的单元测试，使用 TestingConfig"""
+    import unittest
+    tests = unittest.TestLoader().discover('tests')
+    unittest.TextTestRunner(verbosity=2).run(tests)
+
+
 if __name__ == '__main__':
     manager.run()
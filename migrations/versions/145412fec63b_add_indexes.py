@@ -0,0 +1,106 @@
+"""add indexes on meal_zipcode date windows and foreign key columns
+
+Revision ID: 145412fec63b
+Revises: None
+Create Date: 2026-10-18 15:51:28.781773
+
+Databases created before this revision were built with db.create_all();
+run `python manage.py db stamp head` on a fresh create_all()
+database instead of upgrading it.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '145412fec63b'
+down_revision = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+zipcode_table = sa.table('zipcode', sa.column('id'), sa.column('zipcode'))
+order_table = sa.table('order', sa.column('zip_id'))
+meal_zipcode_table = sa.table('meal_zipcode', sa.column('meal_id'), sa.column('zipcode_id'))
+
+foreign_keys = [
+    ('fk_chef_apply_applicant_id_user', 'chef_apply', 'user', 'applicant_id'),
+    ('fk_meal_chef_id_user', 'meal', 'user', 'chef_id'),
+    ('fk_order_meal_id_meal', 'order', 'meal', 'meal_id'),
+    ('fk_order_zip_id_zipcode', 'order', 'zipcode', 'zip_id'),
+    ('fk_order_client_id_user', 'order', 'user', 'client_id'),
+    ('fk_order_chef_id_user', 'order', 'user', 'chef_id'),
+]
+
+
+def merge_duplicate_zipcodes():
+    """point orders and meal_zipcodes at the oldest row of each zipcode, then drop the rest"""
+    conn = op.get_bind()
+    duplicates = conn.execute(
+        sa.select([zipcode_table.c.zipcode, sa.func.min(zipcode_table.c.id)])
+        .group_by(zipcode_table.c.zipcode)
+        .having(sa.func.count() > 1)).fetchall()
+    for zipcode, keep_id in duplicates:
+        duplicate_ids = [row[0] for row in conn.execute(
+            sa.select([zipcode_table.c.id])
+            .where(zipcode_table.c.zipcode == zipcode)
+            .where(zipcode_table.c.id != keep_id))]
+        conn.execute(order_table.update()
+                     .where(order_table.c.zip_id.in_(duplicate_ids))
+                     .values(zip_id=keep_id))
+        # a meal may be linked to several duplicates: keep one link per meal, or
+        # re-pointing them all at keep_id violates the (meal_id, zipcode_id) primary key
+        seen_meal_ids = set()
+        extra_links = {}
+        for meal_id, zipcode_id in conn.execute(
+                sa.select([meal_zipcode_table.c.meal_id, meal_zipcode_table.c.zipcode_id])
+                .where(meal_zipcode_table.c.zipcode_id.in_(duplicate_ids))
+                .order_by(meal_zipcode_table.c.zipcode_id)):
+            if meal_id in seen_meal_ids:
+                extra_links.setdefault(zipcode_id, []).append(meal_id)
+            else:
+                seen_meal_ids.add(meal_id)
+        for zipcode_id, meal_ids in extra_links.items():
+            conn.execute(meal_zipcode_table.delete()
+                         .where(meal_zipcode_table.c.zipcode_id == zipcode_id)
+                         .where(meal_zipcode_table.c.meal_id.in_(meal_ids)))
+        kept_meal_ids = sa.select([meal_zipcode_table.c.meal_id]) \
+            .where(meal_zipcode_table.c.zipcode_id == keep_id)
+        conn.execute(meal_zipcode_table.delete()
+                     .where(meal_zipcode_table.c.zipcode_id.in_(duplicate_ids))
+                     .where(meal_zipcode_table.c.meal_id.in_(kept_meal_ids)))
+        conn.execute(meal_zipcode_table.update()
+                     .where(meal_zipcode_table.c.zipcode_id.in_(duplicate_ids))
+                     .values(zipcode_id=keep_id))
+        conn.execute(zipcode_table.delete()
+                     .where(zipcode_table.c.id.in_(duplicate_ids)))
+
+
+def upgrade():
+    merge_duplicate_zipcodes()
+    op.create_index(op.f('ix_zipcode_zipcode'), 'zipcode', ['zipcode'], unique=True)
+    op.create_index('ix_meal_zipcode_zipcode_id_dates', 'meal_zipcode',
+                    ['zipcode_id', 'begin_date', 'end_date'], unique=False)
+    op.create_index(op.f('ix_order_chef_id'), 'order', ['chef_id'], unique=False)
+    op.create_index(op.f('ix_order_client_id'), 'order', ['client_id'], unique=False)
+    op.create_index(op.f('ix_order_meal_id'), 'order', ['meal_id'], unique=False)
+    op.create_index(op.f('ix_order_zip_id'), 'order', ['zip_id'], unique=False)
+    op.create_index(op.f('ix_chef_apply_applicant_id'), 'chef_apply', ['applicant_id'], unique=False)
+    op.create_index(op.f('ix_meal_chef_id'), 'meal', ['chef_id'], unique=False)
+    # SQLite cannot add constraints to an existing table
+    if op.get_bind().dialect.name != 'sqlite':
+        for name, source, referent, column in foreign_keys:
+            op.create_foreign_key(name, source, referent, [column], ['id'])
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        for name, source, referent, column in reversed(foreign_keys):
+            op.drop_constraint(name, source, type_='foreignkey')
+    op.drop_index(op.f('ix_meal_chef_id'), table_name='meal')
+    op.drop_index(op.f('ix_chef_apply_applicant_id'), table_name='chef_apply')
+    op.drop_index(op.f('ix_order_zip_id'), table_name='order')
+    op.drop_index(op.f('ix_order_meal_id'), table_name='order')
+    op.drop_index(op.f('ix_order_client_id'), table_name='order')
+    op.drop_index(op.f('ix_order_chef_id'), table_name='order')
+    op.drop_index('ix_meal_zipcode_zipcode_id_dates', table_name='meal_zipcode')
+    op.drop_index(op.f('ix_zipcode_zipcode'), table_name='zipcode')
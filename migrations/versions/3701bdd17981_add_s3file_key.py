@@ -0,0 +1,24 @@
+"""add s3file key
+
+Revision ID: 3701bdd17981
+Revises: 24fa9c0761c1
+Create Date: 2026-10-18 16:07:26.884478
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3701bdd17981'
+down_revision = '24fa9c0761c1'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('s3file', sa.Column('key', sa.String(length=512), nullable=True))
+
+
+def downgrade():
+    # SQLite cannot drop a column in place
+    with op.batch_alter_table('s3file') as batch_op:
+        batch_op.drop_column('key')
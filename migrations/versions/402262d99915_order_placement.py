@@ -0,0 +1,42 @@
+"""order placement: idempotency key, daily capacity
+
+Revision ID: 402262d99915
+Revises: 3701bdd17981
+Create Date: 2026-10-18 16:20:48.108797
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '402262d99915'
+down_revision = '3701bdd17981'
+
+from alembic import op
+import sqlalchemy as sa
+
+# batch mode recreates the table from reflection, which loses CHECK constraints
+order_status = sa.Column('status', sa.Enum('UNHANDLED', 'HANDLED', 'COMPLETED', 'CANCELED'))
+
+
+def upgrade():
+    op.create_table('meal_daily_count',
+    sa.Column('meal_id', sa.Integer(), nullable=False),
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('ordered', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['meal_id'], ['meal.id'], ),
+    sa.PrimaryKeyConstraint('meal_id', 'date')
+    )
+    op.add_column('meal', sa.Column('daily_capacity', sa.Integer(), nullable=True))
+    # SQLite cannot add a constraint in place
+    with op.batch_alter_table('order', reflect_args=[order_status]) as batch_op:
+        batch_op.add_column(sa.Column('idempotency_key', sa.String(length=64), nullable=True))
+        batch_op.create_unique_constraint('uq_order_client_id_idempotency_key',
+                                          ['client_id', 'idempotency_key'])
+
+
+def downgrade():
+    with op.batch_alter_table('order', reflect_args=[order_status.copy()]) as batch_op:
+        batch_op.drop_constraint('uq_order_client_id_idempotency_key', type_='unique')
+        batch_op.drop_column('idempotency_key')
+    with op.batch_alter_table('meal', reflect_args=[sa.Column('is_selected', sa.Boolean())]) as batch_op:
+        batch_op.drop_column('daily_capacity')
+    op.drop_table('meal_daily_count')
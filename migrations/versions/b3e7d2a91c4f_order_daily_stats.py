@@ -0,0 +1,38 @@
+"""order analytics: order_daily_stats rollup, order.create_date index
+
+Revision ID: b3e7d2a91c4f
+Revises: 5c0e9a7d21b4
+Create Date: 2026-10-18 22:41:07.530118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b3e7d2a91c4f'
+down_revision = '5c0e9a7d21b4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('order_daily_stats',
+    sa.Column('chef_id', sa.Integer(), nullable=False),
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('meal_id', sa.Integer(), nullable=False),
+    sa.Column('zip_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=16), nullable=False),
+    sa.Column('orders', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['chef_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['meal_id'], ['meal.id'], ),
+    sa.ForeignKeyConstraint(['zip_id'], ['zipcode.id'], ),
+    sa.PrimaryKeyConstraint('chef_id', 'date', 'meal_id', 'zip_id', 'status')
+    )
+    op.create_index(op.f('ix_order_daily_stats_date'), 'order_daily_stats', ['date'], unique=False)
+    op.create_index(op.f('ix_order_create_date'), 'order', ['create_date'], unique=False)
+    # existing orders are counted by: python manage.py analytics_rebuild
+
+
+def downgrade():
+    op.drop_index(op.f('ix_order_create_date'), table_name='order')
+    op.drop_index(op.f('ix_order_daily_stats_date'), table_name='order_daily_stats')
+    op.drop_table('order_daily_stats')
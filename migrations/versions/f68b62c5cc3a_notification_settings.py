@@ -0,0 +1,26 @@
+"""notification settings: user phone, digest mode
+
+Revision ID: f68b62c5cc3a
+Revises: 402262d99915
+Create Date: 2026-10-18 18:05:12.417306
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f68b62c5cc3a'
+down_revision = '402262d99915'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('user', sa.Column('phone', sa.String(length=20), nullable=True))
+    op.add_column('user', sa.Column('notify_digest', sa.Boolean(), nullable=True))
+
+
+def downgrade():
+    # SQLite cannot drop a column in place
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('notify_digest')
+        batch_op.drop_column('phone')
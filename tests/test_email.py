@@ -0,0 +1,256 @@
+# -*- coding:utf-8 -*-
+import asyncore
+import datetime
+import smtpd
+import smtplib
+import socket
+import threading
+import time
+import unittest
+
+from app import create_app, db
+from app.email import send_email, claim_mails, due_mail_ids, send_batch, mail_workers
+from app.models import MailOutbox, User
+
+
+class FakeConnection(object):
+    """代替Flask-Mail的SMTP连接，fail为True时每次发送都抛出SMTP异常"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.sent = []
+        self.closed = False
+
+    def send(self, message):
+        if self.fail:
+            raise smtplib.SMTPServerDisconnected('connection lost')
+        self.sent.append(message)
+
+    def __exit__(self, *args):
+        self.closed = True
+
+
+class SmtpStandIn(smtpd.SMTPServer):
+    """本地的SMTP替代服务，收到的邮件记在messages里：[(客户端地址, 收件人列表, 内容)]"""
+
+    def __init__(self, host, port):
+        smtpd.SMTPServer.__init__(self, (host, port), None)
+        self.messages = []
+        self.thread = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.messages.append((peer, rcpttos, data))
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        # 关闭服务和所有连接之后asyncore.loop退出
+        asyncore.close_all()
+        self.thread.join(5)
+
+
+class MailOutboxTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        # 只启动轮询线程，不启动发送线程，邮件由测试自己领取和发送
+        self.app.config['MAIL_WORKERS'] = 0
+        self.app.config['MAIL_POLL_INTERVAL'] = 3600
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        mail_workers.stop(5)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def enqueue(self, count=1):
+        user = User(nickname='john', email='john@example.com')
+        outboxes = [send_email(user.email, u'欢迎', 'email/welcome', user=user)
+                    for i in range(count)]
+        db.session.commit()
+        return [outbox.id for outbox in outboxes]
+
+    def queued(self):
+        ids = set()
+        while not mail_workers.queue.empty():
+            ids.add(mail_workers.queue.get_nowait())
+        return ids
+
+    def outbox(self, id):
+        db.session.expire_all()
+        return MailOutbox.query.get(id)
+
+    def test_enqueue(self):
+        ids = self.enqueue(2)
+        self.assertEqual(self.queued(), set(ids))
+        outbox = self.outbox(ids[0])
+        self.assertEqual(outbox.status, 'pending')
+        self.assertEqual(outbox.attempts, 0)
+        self.assertEqual(outbox.recipient, 'john@example.com')
+        self.assertTrue(outbox.subject.startswith(self.app.config['MAIL_SUBJECT_PREFIX']))
+        self.assertTrue('john' in outbox.body)
+        self.assertEqual(due_mail_ids(10), ids)
+
+    def test_enqueue_after_commit(self):
+        user = User(nickname='john', email='john@example.com')
+        db.session.add(user)
+        outbox = send_email(user.email, u'欢迎', 'email/welcome', user=user)
+        db.session.flush()
+        # 调用方提交之前不通知发送线程
+        self.assertEqual(self.queued(), set())
+        db.session.commit()
+        self.assertEqual(self.queued(), set([outbox.id]))
+        self.assertEqual(User.query.filter_by(email='john@example.com').count(), 1)
+
+    def test_rollback_discards(self):
+        send_email('john@example.com', u'欢迎', 'email/welcome', user=User(nickname='john'))
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(self.queued(), set())
+        self.assertEqual(MailOutbox.query.count(), 0)
+
+    def test_claim_once(self):
+        ids = self.enqueue(2)
+        claimed = claim_mails(ids, 'worker-1')
+        self.assertEqual(sorted(outbox.id for outbox in claimed), ids)
+        self.assertTrue(all(outbox.status == 'sending' for outbox in claimed))
+        self.assertEqual(claim_mails(ids, 'worker-2'), [])
+        self.assertEqual(due_mail_ids(10), [])
+
+    def test_send(self):
+        ids = self.enqueue(2)
+        connection = FakeConnection()
+        self.assertTrue(send_batch(claim_mails(ids, 'worker-1'), connection) is connection)
+        db.session.commit()
+        self.assertEqual(len(connection.sent), 2)
+        outbox = self.outbox(ids[0])
+        self.assertEqual(outbox.status, 'sent')
+        self.assertTrue(outbox.sent_date is not None)
+        self.assertTrue(outbox.claimed_by is None)
+
+    def test_retry_with_backoff(self):
+        id, = self.enqueue()
+        delay = self.app.config['MAIL_RETRY_DELAY']
+        for attempt in (1, 2):
+            connection = FakeConnection(fail=True)
+            before = datetime.datetime.now()
+            self.assertTrue(send_batch(claim_mails([id], 'worker-1'), connection) is None)
+            db.session.commit()
+            self.assertTrue(connection.closed)
+            outbox = self.outbox(id)
+            self.assertEqual(outbox.status, 'pending')
+            self.assertEqual(outbox.attempts, attempt)
+            self.assertTrue('connection lost' in outbox.last_error)
+            wait = outbox.next_attempt_at - before
+            self.assertTrue(datetime.timedelta(seconds=delay * 2 ** (attempt - 1)) <= wait <
+                            datetime.timedelta(seconds=delay * 2 ** (attempt - 1) + 1))
+            # 没到重试时间不能领取
+            self.assertEqual(claim_mails([id], 'worker-1'), [])
+            self.assertEqual(due_mail_ids(10), [])
+            outbox.next_attempt_at = datetime.datetime.now() - datetime.timedelta(seconds=1)
+            db.session.commit()
+        self.assertEqual(due_mail_ids(10), [id])
+
+    def test_give_up_after_max_attempts(self):
+        id, = self.enqueue()
+        max_attempts = self.app.config['MAIL_MAX_ATTEMPTS']
+        for attempt in range(max_attempts):
+            outbox = self.outbox(id)
+            self.assertEqual(outbox.status, 'pending')
+            outbox.next_attempt_at = datetime.datetime.now() - datetime.timedelta(seconds=1)
+            db.session.commit()
+            send_batch(claim_mails([id], 'worker-1'), FakeConnection(fail=True))
+            db.session.commit()
+        outbox = self.outbox(id)
+        self.assertEqual(outbox.status, 'failed')
+        self.assertEqual(outbox.attempts, max_attempts)
+        outbox.next_attempt_at = datetime.datetime.now() - datetime.timedelta(seconds=1)
+        db.session.commit()
+        self.assertEqual(claim_mails([id], 'worker-1'), [])
+        self.assertEqual(due_mail_ids(10), [])
+
+    def test_reclaim_after_claim_timeout(self):
+        stale, fresh = self.enqueue(2)
+        claim_mails([stale, fresh], 'worker-1')
+        outbox = self.outbox(stale)
+        outbox.claimed_at = datetime.datetime.now() - datetime.timedelta(
+            seconds=self.app.config['MAIL_CLAIM_TIMEOUT'] + 1)
+        db.session.commit()
+        self.assertEqual(due_mail_ids(10), [stale])
+        outbox = self.outbox(stale)
+        self.assertEqual(outbox.status, 'pending')
+        self.assertTrue(outbox.claimed_by is None)
+        self.assertEqual(self.outbox(fresh).status, 'sending')
+        self.assertEqual([claimed.id for claimed in claim_mails([stale], 'worker-2')], [stale])
+
+
+class SmtpTestCase(unittest.TestCase):
+    """经过Flask-Mail发送到 TestingConfig 的 MAIL_SERVER:MAIL_PORT 上的本地SMTP替代服务"""
+
+    def setUp(self):
+        self.app = create_app('testing')
+        try:
+            self.server = SmtpStandIn(self.app.config['MAIL_SERVER'], self.app.config['MAIL_PORT'])
+        except socket.error as e:
+            self.skipTest('can not listen on %s:%s: %s' % (self.app.config['MAIL_SERVER'],
+                                                          self.app.config['MAIL_PORT'], e))
+        self.server.start()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        mail_workers.stop(5)
+        self.server.stop()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def wait_sent(self, ids, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            db.session.expire_all()
+            statuses = set(outbox.status for outbox in
+                           MailOutbox.query.filter(MailOutbox.id.in_(ids)))
+            if statuses == set(['sent']):
+                return
+            db.session.commit()
+            time.sleep(0.05)
+        self.fail('mails %s are not sent in %d seconds' % (ids, timeout))
+
+    def test_send_through_worker_pool(self):
+        users = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(3)]
+        outboxes = [send_email(user.email, u'欢迎', 'email/welcome', user=user) for user in users]
+        db.session.commit()
+        ids = [outbox.id for outbox in outboxes]
+        self.wait_sent(ids)
+        self.assertEqual(sorted(rcpttos for peer, rcpttos, data in self.server.messages),
+                         [[user.email] for user in users])
+        self.assertTrue(all('Content-Type: multipart/alternative' in data
+                            for peer, rcpttos, data in self.server.messages))
+
+    def test_send_batch_reuses_connection(self):
+        # 不启动发送线程，由测试自己发送
+        self.app.config['MAIL_WORKERS'] = 0
+        outboxes = [send_email('user%d@example.com' % i, u'欢迎', 'email/welcome',
+                               user=User(nickname='user%d' % i)) for i in range(3)]
+        db.session.commit()
+        ids = [outbox.id for outbox in outboxes]
+        connection = send_batch(claim_mails(ids, 'worker-1'))
+        db.session.commit()
+        self.assertTrue(connection is not None)
+        connection.__exit__(None, None, None)
+        self.assertEqual([self.outbox_status(id) for id in ids], ['sent'] * 3)
+        # 三封邮件经过同一个SMTP连接
+        self.assertEqual(len(set(peer for peer, rcpttos, data in self.server.messages)), 1)
+        self.assertEqual(len(self.server.messages), 3)
+
+    def outbox_status(self, id):
+        db.session.expire_all()
+        return MailOutbox.query.get(id).status
@@ -0,0 +1,109 @@
+# -*- coding:utf-8 -*-
+import datetime
+import unittest
+
+from app import create_app, db, notifier
+from app.models import User, Meal, Zipcode, MealZipcode, Order
+from app.notify import RateLimiter
+from app.ordering import place_order
+
+
+class NotifyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        notifier.digests.clear()
+        self.chef = User(nickname='chef', email='chef@example.com', password='cat',
+                         phone='5550001')
+        self.client = User(nickname='client', email='client@example.com', password='dog')
+        zipcode = Zipcode(zipcode='94536')
+        db.session.add_all([self.chef, self.client, zipcode])
+        db.session.commit()
+        self.meal = Meal(name='noodle', description='spicy', chef_id=self.chef.id)
+        db.session.add(self.meal)
+        db.session.commit()
+        today = datetime.date.today()
+        db.session.add(MealZipcode(meal_id=self.meal.id, zipcode_id=zipcode.id,
+                                   begin_date=today, end_date=today))
+        db.session.commit()
+
+    def tearDown(self):
+        notifier.digests.clear()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def order(self):
+        order, created = place_order(self.meal, '94536', self.client.id, 'addr', '5550002')
+        return order
+
+    def transition(self, order, status, role):
+        order = Order.query.get(order.id)
+        order.transition(status, role)
+        db.session.commit()
+
+    def sent(self, channel='email'):
+        notifier.flush()
+        sent = notifier.transports[channel].sent
+        notifier.transports[channel].clear()
+        return sent
+
+    def test_new_order_notifies_chef(self):
+        self.order()
+        emails = self.sent()
+        self.assertEqual([email['to'] for email in emails], ['chef@example.com'])
+        self.assertTrue(u'新订单' in emails[0]['subject'])
+        self.assertTrue('addr' in emails[0]['body'])
+        self.assertEqual([sms['to'] for sms in self.sent('sms')], ['5550001'])
+
+    def test_shipping_notifies_client(self):
+        order = self.order()
+        self.sent()
+        self.sent('sms')
+        self.transition(order, 'HANDLED', 'chef')
+        emails = self.sent()
+        self.assertEqual([email['to'] for email in emails], ['client@example.com'])
+        self.assertTrue(u'已发货' in emails[0]['subject'])
+        self.assertEqual([sms['to'] for sms in self.sent('sms')], ['5550002'])
+
+    def test_cancel_notifies_chef_and_client(self):
+        order = self.order()
+        self.sent()
+        self.transition(order, 'CANCELED', 'client')
+        emails = self.sent()
+        self.assertEqual(sorted(email['to'] for email in emails),
+                         ['chef@example.com', 'client@example.com'])
+        self.assertTrue(all(u'已取消' in email['subject'] for email in emails))
+
+    def test_digest_chef_gets_one_merged_notice(self):
+        self.chef.notify_digest = True
+        db.session.commit()
+        first = self.order()
+        self.order()
+        self.transition(first, 'CANCELED', 'client')
+        emails = self.sent()
+        chef_emails = [email for email in emails if email['to'] == 'chef@example.com']
+        self.assertEqual(len(chef_emails), 1)
+        self.assertTrue(u'3个订单更新' in chef_emails[0]['subject'])
+        self.assertEqual([sms['body'] for sms in self.sent('sms')
+                          if sms['to'] == '5550001'],
+                         [u'【每日三餐】新订单2个，取消1个，详见邮件'])
+        # 客户的取消通知不受大厨摘要模式影响
+        self.assertEqual([email['to'] for email in emails if email['to'] != 'chef@example.com'],
+                         ['client@example.com'])
+
+    def test_rate_limit_moves_chef_notices_to_digest_and_drops_client_notices(self):
+        notifier.limiter = RateLimiter(2, 3600)
+        orders = [self.order() for i in range(3)]
+        for order in orders:
+            self.transition(order, 'HANDLED', 'chef')
+        emails = self.sent()
+        chef_subjects = [email['subject'] for email in emails if email['to'] == 'chef@example.com']
+        # 前两个新订单单独通知，第三个转入摘要
+        self.assertEqual(len(chef_subjects), 3)
+        self.assertEqual(sum(1 for subject in chef_subjects if u'新订单' in subject), 2)
+        self.assertEqual(sum(1 for subject in chef_subjects if u'1个订单更新' in subject), 1)
+        # 客户的第三个发货通知被丢弃
+        self.assertEqual(len([email for email in emails if email['to'] == 'client@example.com']), 2)
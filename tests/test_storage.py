@@ -0,0 +1,171 @@
+# -*- coding:utf-8 -*-
+import io
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+import uuid
+
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import NotFound
+
+from app import create_app, db, storage
+from app.models import S3file
+from app.storage import LocalBackend, MemoryBackend, S3Backend
+
+
+class StorageTestCase(object):
+    """每个后端的上传、下载测试，子类的 backend 创建要测试的后端"""
+    path = 'chef_apply_files/'
+
+    def backend(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        storage.backend = self.backend()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def upload(self, files):
+        s3files = S3file.files2s3([FileStorage(io.BytesIO(data), filename=name)
+                                   for name, data in files], self.path)
+        for s3file in s3files:
+            if s3file.fail_reason is None:
+                s3file.url = storage.url(s3file.key)
+                db.session.add(s3file)
+        db.session.commit()
+        return s3files
+
+    def download(self, s3file, headers=None):
+        with self.app.test_request_context(headers=headers):
+            response = S3file.query.get(s3file.id).send()
+            response.direct_passthrough = False
+            return response.status_code, response.get_data(), response.headers
+
+    def test_round_trip(self):
+        files = [('menu.txt', b'noodle\n' * 10), ('photo.jpg', os.urandom(300 * 1024))]
+        s3files = self.upload(files)
+        self.assertEqual([s3file.fail_reason for s3file in s3files], [None, None])
+        self.assertTrue(s3files[0].key.startswith(self.path))
+        self.assertTrue(s3files[0].key.endswith('menu.txt'))
+        for s3file, (name, data) in zip(s3files, files):
+            status, body, headers = self.download(s3file)
+            self.assertEqual(status, 200)
+            self.assertEqual(body, data)
+        self.assertEqual(self.download(s3files[1])[2]['Content-Type'], 'image/jpeg')
+
+    def test_range(self):
+        s3file, = self.upload([('menu.txt', b'0123456789' * 10)])
+        status, body, headers = self.download(s3file, {'Range': 'bytes=10-19'})
+        self.assertEqual(status, 206)
+        self.assertEqual(body, b'0123456789')
+        self.assertEqual(headers['Content-Range'], 'bytes 10-19/100')
+
+    def test_not_modified(self):
+        s3file, = self.upload([('menu.txt', b'noodle')])
+        etag = self.download(s3file)[2]['ETag']
+        self.assertEqual(self.download(s3file, {'If-None-Match': etag})[0], 304)
+
+    def test_too_large(self):
+        s3files = self.upload([('small.txt', b'a'),
+                               ('huge.zip', b'b' * self.app.config['MAX_CONTENT_LENGTH'])])
+        self.assertEqual(s3files[0].fail_reason, None)
+        self.assertEqual(s3files[1].fail_reason, u'文件超过10MB')
+        self.assertEqual(self.download(s3files[0])[1], b'a')
+
+    def test_missing(self):
+        s3file, = self.upload([('menu.txt', b'noodle')])
+        storage.delete(s3file.key)
+        with self.app.test_request_context():
+            self.assertRaises(NotFound, S3file.query.get(s3file.id).send)
+
+
+class MemoryStorageTestCase(StorageTestCase, unittest.TestCase):
+    def backend(self):
+        return MemoryBackend()
+
+
+class LocalStorageTestCase(StorageTestCase, unittest.TestCase):
+    def backend(self):
+        self.root = tempfile.mkdtemp()
+        return LocalBackend({'STORAGE_ROOT': self.root})
+
+    def tearDown(self):
+        StorageTestCase.tearDown(self)
+        shutil.rmtree(self.root)
+
+    def test_saved_under_root(self):
+        s3file, = self.upload([('menu.txt', b'noodle')])
+        with open(os.path.join(self.root, s3file.key), 'rb') as f:
+            self.assertEqual(f.read(), b'noodle')
+
+
+class S3StorageTestCase(unittest.TestCase):
+    """上传到 TestingConfig 的 S3_HOST:S3_PORT 上的本地S3替代服务，没有运行时跳过"""
+
+    def setUp(self):
+        self.app = create_app('testing')
+        address = (self.app.config['S3_HOST'], self.app.config['S3_PORT'])
+        try:
+            socket.create_connection(address, 1).close()
+        except socket.error as e:
+            self.skipTest('no S3 stand-in at %s:%s: %s' % (address + (e,)))
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        storage.backend = S3Backend(self.app.config)
+        # 替代服务上的数据不会清除，每个测试用不同的目录
+        self.path = 'test-%s/' % uuid.uuid4().hex
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def upload(self, files):
+        return S3file.files2s3([FileStorage(io.BytesIO(data), filename=name)
+                                for name, data in files], self.path)
+
+    def test_round_trip(self):
+        chunk = self.app.config['S3_MULTIPART_CHUNK']
+        files = [('menu.txt', b'noodle\n' * 10),
+                 ('photo.jpg', os.urandom(300 * 1024)),
+                 ('apply.pdf', os.urandom(chunk + 1024))]
+        s3files = self.upload(files)
+        self.assertEqual([s3file.fail_reason for s3file in s3files], [None, None, None])
+        for s3file, (name, data) in zip(s3files, files):
+            self.assertTrue(s3file.key.endswith(name))
+            self.assertEqual(storage.backend.bucket.get_key(s3file.key).get_contents_as_string(),
+                             data)
+        # S3的下载交给S3，返回公开的url
+        s3file = s3files[0]
+        s3file.url = storage.url(s3file.key)
+        db.session.add(s3file)
+        db.session.commit()
+        with self.app.test_request_context():
+            response = S3file.query.get(s3file.id).send()
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.headers['Location'].endswith(s3file.key))
+
+    def test_multipart(self):
+        chunk = self.app.config['S3_MULTIPART_CHUNK']
+        s3file, = self.upload([('apply.pdf', os.urandom(chunk + 1024))])
+        key, = storage.backend.bucket.list(prefix=self.path)
+        # multipart上传的etag是 md5-分块数
+        self.assertTrue(key.etag.strip('"').endswith('-2'))
+
+    def test_too_large(self):
+        s3files = self.upload([('small.txt', b'a'),
+                               ('huge.zip', b'b' * self.app.config['MAX_CONTENT_LENGTH'])])
+        self.assertEqual(s3files[0].fail_reason, None)
+        self.assertEqual(s3files[1].fail_reason, u'文件超过10MB')
+        self.assertEqual([key.name for key in storage.backend.bucket.list(prefix=self.path)],
+                         [s3files[0].key])